@@ -0,0 +1,228 @@
+"""
+Bagelbot attendance analytics - turns meeting history into columnar arrays and answers attendance
+questions with vectorized NumPy operations.
+"""
+import csv
+import json
+
+import numpy as np
+
+
+class Attendance:
+    """Meeting history as columns, with one row per person per meeting.
+
+    Attributes:
+        people (list): Names, indexed by the values in `person`
+        dates (np.ndarray): datetime64[D] date of every meeting
+        canceled (np.ndarray): bool, whether every meeting was canceled
+        person (np.ndarray): int32 index into `people` for every row
+        meeting (np.ndarray): int32 index into `dates` for every row
+        group (np.ndarray): int32 group number within the meeting for every row
+
+    Args:
+        meetings (iterable): Meetings, as stored in the store's `history`
+        people (Optional[list]): Names to include even if they have never attended
+    """
+
+    def __init__(self, meetings, people=None):
+        self.people = list(people or [])
+        ids = {name: i for i, name in enumerate(self.people)}
+        dates, canceled, person, meeting, group = [], [], [], [], []
+        for m, past in enumerate(meetings):
+            dates.append(past["date"])
+            canceled.append(bool(past.get("canceled")))
+            for g, members in enumerate(past["attendees"]):
+                for name in members:
+                    if name not in ids:
+                        ids[name] = len(self.people)
+                        self.people.append(name)
+                    person.append(ids[name])
+                    meeting.append(m)
+                    group.append(g)
+
+        self.dates = np.array(dates, dtype="datetime64[D]")
+        self.canceled = np.array(canceled, dtype=bool)
+        self.person = np.array(person, dtype=np.int32)
+        self.meeting = np.array(meeting, dtype=np.int32)
+        self.group = np.array(group, dtype=np.int32)
+
+    def _in_range(self, start=None, end=None):
+        """bool mask of meetings on or after `start` and before `end`."""
+        mask = np.ones(len(self.dates), dtype=bool)
+        if start is not None:
+            mask &= self.dates >= np.datetime64(start, "D")
+        if end is not None:
+            mask &= self.dates < np.datetime64(end, "D")
+        return mask
+
+    def presence(self, start=None, end=None):
+        """A people x meetings matrix of who attended which (not canceled) meeting.
+
+        Args:
+            start (Optional[date]): Only include meetings on or after this date
+            end (Optional[date]): Only include meetings before this date
+
+        Returns:
+            np.ndarray: bool matrix, with one column per held meeting in date order
+        """
+        held = np.flatnonzero(self._in_range(start, end) & ~self.canceled)
+        column = np.full(len(self.dates), -1)
+        column[held] = np.arange(len(held))
+        rows = column[self.meeting] >= 0
+        matrix = np.zeros((len(self.people), len(held)), dtype=bool)
+        matrix[self.person[rows], column[self.meeting[rows]]] = True
+        return matrix
+
+    def totals(self, start=None, end=None):
+        """How many meetings each person attended.
+
+        Returns:
+            np.ndarray: Meetings attended, indexed like `people`
+        """
+        rows = self._in_range(start, end)[self.meeting]
+        return np.bincount(self.person[rows], minlength=len(self.people))
+
+    def participation(self, start=None, end=None):
+        """The share of held (not canceled) meetings each person attended.
+
+        Returns:
+            np.ndarray: Participation rate between 0 and 1, indexed like `people`
+        """
+        held = np.count_nonzero(self._in_range(start, end) & ~self.canceled)
+        return self.totals(start, end) / held if held else np.zeros(len(self.people))
+
+    def cancellation_rate(self, start=None, end=None):
+        """The share of meetings that were canceled.
+
+        Returns:
+            float: Cancellation rate between 0 and 1
+        """
+        canceled = self.canceled[self._in_range(start, end)]
+        return float(canceled.mean()) if len(canceled) else 0.0
+
+    def streaks(self, start=None, end=None):
+        """The longest and current runs of back-to-back held meetings each person attended.
+
+        Returns:
+            tuple: (longest, current) np.ndarrays, indexed like `people`
+        """
+        matrix = self.presence(start, end)
+        padded = np.zeros((matrix.shape[0], matrix.shape[1] + 2), dtype=np.int8)
+        padded[:, 1:-1] = matrix
+        edges = np.diff(padded, axis=1)
+        # np.nonzero is row-major, so the n-th run start in a row lines up with its n-th run end
+        start_rows, start_cols = np.nonzero(edges == 1)
+        _, end_cols = np.nonzero(edges == -1)
+        lengths = end_cols - start_cols
+
+        longest = np.zeros(matrix.shape[0], dtype=np.int64)
+        np.maximum.at(longest, start_rows, lengths)
+        current = np.zeros(matrix.shape[0], dtype=np.int64)
+        ongoing = end_cols == matrix.shape[1]
+        current[start_rows[ongoing]] = lengths[ongoing]
+        return longest, current
+
+    def last_attended(self):
+        """The date each person last attended a meeting.
+
+        Returns:
+            np.ndarray: datetime64[D], NaT for people who never attended
+        """
+        last = np.full(len(self.people), np.datetime64("NaT"), dtype="datetime64[D]")
+        if len(self.person):
+            order = np.argsort(self.meeting, kind="stable")
+            last[self.person[order]] = self.dates[self.meeting[order]]
+        return last
+
+    def dates_attended(self, index):
+        """Every date one person attended a meeting.
+
+        Args:
+            index (int): Index into `people`
+
+        Returns:
+            np.ndarray: datetime64[D] dates in order
+        """
+        return np.sort(self.dates[self.meeting[self.person == index]])
+
+    def pair_counts(self, start=None, end=None):
+        """Count how many times each pair of people have been in the same group.
+
+        Returns:
+            tuple: (a, b, times) np.ndarrays, indexes into `people` with a < b
+        """
+        rows = np.flatnonzero(self._in_range(start, end)[self.meeting])
+        key = self.meeting[rows].astype(np.int64) * (int(self.group.max(initial=0)) + 1) + self.group[rows]
+        order = np.argsort(key, kind="stable")
+        key, person = key[order], self.person[order].astype(np.int64)
+
+        codes = []
+        for offset in range(1, len(key)):
+            same = key[offset:] == key[:-offset]
+            if not same.any():
+                break
+            a, b = person[:-offset][same], person[offset:][same]
+            codes.append(np.minimum(a, b) * len(self.people) + np.maximum(a, b))
+        if not codes:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty, empty
+        pairs, times = np.unique(np.concatenate(codes), return_counts=True)
+        return pairs // len(self.people), pairs % len(self.people), times
+
+    def summary(self, start=None, end=None):
+        """Per-person attendance stats.
+
+        Returns:
+            list: A dict per person with their totals, participation rate, streaks and last attended date
+        """
+        totals = self.totals(start, end)
+        participation = self.participation(start, end)
+        longest, current = self.streaks(start, end)
+        last = self.last_attended()
+        return [
+            {
+                "name": name,
+                "total": int(totals[i]),
+                "participation": round(float(participation[i]), 4),
+                "longest_streak": int(longest[i]),
+                "current_streak": int(current[i]),
+                "last_attended": None if np.isnat(last[i]) else str(last[i]),
+            }
+            for i, name in enumerate(self.people)
+        ]
+
+    def pair_summary(self, start=None, end=None):
+        """Who met whom, and how many times.
+
+        Returns:
+            list: A dict per pair of people who have met
+        """
+        a, b, times = self.pair_counts(start, end)
+        return [
+            {"a": self.people[i], "b": self.people[j], "times": int(t)} for i, j, t in zip(a, b, times)
+        ]
+
+
+def write_csv(rows, f):
+    """Write a list of dicts (e.g. from `Attendance.summary`) as CSV.
+
+    Args:
+        rows (list): Dicts that all have the same keys
+        f (file): Where to write to
+    """
+    if not rows:
+        return
+    writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def write_json(rows, f):
+    """Write a list of dicts (e.g. from `Attendance.summary`) as JSON.
+
+    Args:
+        rows (list): Dicts to write
+        f (file): Where to write to
+    """
+    json.dump(rows, f, indent=2)
+    f.write("\n")
@@ -3,27 +3,100 @@
 Simple script for generating some simple meeting attendance statistics
 using history of past meetings.
 """
+import sys
+
+import numpy as np
+
+from analytics import Attendance, write_csv, write_json
 from utils import open_store
 
-store = open_store()
-everyone = store["everyone"]
-history = store["history"]
-store.close()
-
-attendance = {p: {"total": 0, "dates": []} for p in everyone}
-for meeting in history:
-    for pair in meeting["attendees"]:
-        for person in pair:
-            if person in attendance:
-                attendance[person]["total"] += 1
-                attendance[person]["dates"].append(meeting["date"])
-
-for person, info in attendance.iteritems():
-    print("=== {} ===".format(person))
-    print(" Total Attended: {}".format(info["total"]))
-    print(
-        " Meeting Dates: {}".format(
-            ", ".join(d.strftime("%Y-%m-%d") for d in sorted(info["dates"]))
+
+def print_breakdown(attendance, start=None, end=None):
+    """Print a human readable breakdown of everyone's attendance.
+
+    Args:
+        attendance (Attendance): Meeting history
+        start (Optional[date]): Only include meetings on or after this date
+        end (Optional[date]): Only include meetings before this date
+    """
+    a, b, times = attendance.pair_counts(start, end)
+    met = {}
+    for i, j, t in zip(a, b, times):
+        met.setdefault(i, []).append((attendance.people[j], t))
+        met.setdefault(j, []).append((attendance.people[i], t))
+
+    print("Cancellation rate: {:.0%}".format(attendance.cancellation_rate(start, end)))
+    print()
+    for i, info in enumerate(attendance.summary(start, end)):
+        dates = attendance.dates_attended(i)
+        if start is not None:
+            dates = dates[dates >= np.datetime64(start, "D")]
+        if end is not None:
+            dates = dates[dates < np.datetime64(end, "D")]
+        print("=== {} ===".format(info["name"]))
+        print(" Total Attended: {}".format(info["total"]))
+        print(" Participation: {:.0%}".format(info["participation"]))
+        print(
+            " Longest Streak: {}, Current Streak: {}".format(
+                info["longest_streak"], info["current_streak"]
+            )
+        )
+        print(" Meeting Dates: {}".format(", ".join(str(d) for d in dates)))
+        print(
+            " Met With: {}".format(
+                ", ".join("{} ({}x)".format(other, t) for other, t in sorted(met.get(i, [])))
+            )
         )
+        print()
+
+
+def main(args):
+    """
+    Load the history from the store and print (or export) attendance stats for it.
+
+    Args:
+        args (ArgumentParser args): Parsed arguments that impact how the breakdown is generated
+    """
+    store = open_store(readonly=True)
+    try:
+        attendance = Attendance(store["history"].iter_all(), people=store.get("everyone", []))
+    finally:
+        store.close()
+
+    if args.pairs:
+        rows = attendance.pair_summary(args.since, args.until)
+    else:
+        rows = attendance.summary(args.since, args.until)
+
+    if args.format == "csv":
+        write_csv(rows, sys.stdout)
+    elif args.format == "json":
+        write_json(rows, sys.stdout)
+    else:
+        print_breakdown(attendance, args.since, args.until)
+
+
+if __name__ == "__main__":
+    import argparse
+    from datetime import date
+
+    parser = argparse.ArgumentParser(description="Attendance statistics for past meetings.")
+    parser.add_argument(
+        "--since",
+        type=date.fromisoformat,
+        help="only include meetings on or after this date (YYYY-MM-DD)",
     )
-    print()
+    parser.add_argument(
+        "--until",
+        type=date.fromisoformat,
+        help="only include meetings before this date (YYYY-MM-DD)",
+    )
+    parser.add_argument(
+        "--format", "-f", choices=["text", "csv", "json"], default="text", help="output format"
+    )
+    parser.add_argument(
+        "--pairs",
+        action="store_true",
+        help="export who-met-whom counts instead of per-person stats (csv/json only)",
+    )
+    main(parser.parse_args())
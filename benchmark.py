@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+"""
+Bagelbot benchmarks - times meeting generation, attendance checks and the Slack directory refresh
+against synthetic stores and a stubbed SlackClient, at sizes from a team to a whole org.
+"""
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import date, timedelta
+
+from config import EMAIL_DOMAIN
+from check_attendance import check_attendance
+from generate_meeting import create_meetings, format_attendees
+from history import recent_conflicts
+from outbox import DEFAULT_RATE_LIMIT, GLOBAL_RATE_LIMITS, PER_CHANNEL, RATE_LIMITS, get_outbox
+from pairing import partition
+from sharding import sharded_partition
+from slack_api import SlackAPI
+from storage import Store
+from utils import update_everyone_from_slack
+
+DEFAULT_MEMBERS = [50, 500, 2000]
+DEFAULT_YEARS = [1, 5]
+DEFAULT_SIZES = [2, 3]
+TZ_OFFSETS = [-28800, -18000, 0, 3600, 19800]
+# Seconds each entry point may spend importing its modules on a cold start
+STARTUP_BUDGETS = {
+    "check_store": 0.1,
+    "attendance_breakdown": 0.3,
+    "generate_meeting": 0.15,
+    "check_attendance": 0.2,
+    "service": 0.25,
+}
+
+
+class StubSlackClient(SlackAPI):
+    """Stands in for SlackAPI, answering the API calls bagelbot makes from memory.
+
+    Every user that's pinged replies 'yes' (or 'no' for roughly `out_rate` of them) right away.
+    Calls are counted by method, and for methods Slack limits per channel, by channel too.
+
+    Args:
+        users (list): Slack user objects to serve from 'users.list' and 'conversations.members'
+        out_rate (Optional[float]): Share of users who reply 'no' to the attendance check
+    """
+
+    def __init__(self, users, out_rate=0.1):
+        super().__init__("stub")
+        self.users = users
+        self.by_name = {u["name"]: u for u in users}
+        self.out_rate = out_rate
+        self.calls = Counter()
+        self.channel_calls = Counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def rtm_connect(self):
+        return True
+
+    def rtm_read(self):
+        with self.lock:
+            events, self.events = self.events, []
+        return events
+
+    def request(self, method, data, wait_ratelimited=True):
+        with self.lock:
+            self.calls[method] += 1
+            if method in PER_CHANNEL:
+                self.channel_calls[method, data.get("channel")] += 1
+        if method in ("conversations.members", "users.list"):
+            start = int(data.get("cursor") or 0)
+            stop = start + data.get("limit", 100)
+            page = self.users[start:stop]
+            return {
+                "ok": True,
+                "members": [u["id"] for u in page] if method == "conversations.members" else page,
+                "response_metadata": {"next_cursor": str(stop) if stop < len(self.users) else ""},
+            }
+        if method == "users.info":
+            return {"ok": True, "user": next(u for u in self.users if u["id"] == data["user"])}
+        if method == "chat.postMessage":
+            channel = data["channel"]
+            if channel.startswith("@"):
+                user = self.by_name[channel[1:]]
+                channel = "D" + user["id"]
+                reply = "no" if random.random() < self.out_rate else "yes"
+                with self.lock:
+                    self.events.append(
+                        {"type": "message", "channel": channel, "ts": "2", "text": reply}
+                    )
+            return {"ok": True, "channel": channel, "ts": "1"}
+        return {"ok": True}
+
+
+def throttle_seconds(calls, channel_calls):
+    """Work out the least time Slack's rate limits would stretch a batch of API calls over.
+
+    Args:
+        calls (Counter): How many calls were made, by method
+        channel_calls (Counter): How many calls were made, by (method, channel) for PER_CHANNEL methods
+
+    Returns:
+        float: Seconds the busiest rate limit takes to allow its calls, after its burst
+    """
+    buckets = [
+        (count, RATE_LIMITS.get(method, DEFAULT_RATE_LIMIT))
+        for method, count in calls.items()
+        if method not in PER_CHANNEL
+    ]
+    buckets += [(count, RATE_LIMITS[method]) for (method, _), count in channel_calls.items()]
+    buckets += [(calls[method], limit) for method, limit in GLOBAL_RATE_LIMITS.items()]
+    return max(
+        (max(0, count - burst) * 60.0 / per_minute for count, (per_minute, burst) in buckets),
+        default=0.0,
+    )
+
+
+def synthetic_users(members):
+    """Make up Slack user objects.
+
+    Args:
+        members (int): How many users to make
+
+    Returns:
+        list: Slack user objects, all in EMAIL_DOMAIN and spread over TZ_OFFSETS
+    """
+    return [
+        {
+            "id": "U{:08d}".format(i),
+            "name": "user{}".format(i),
+            "updated": 1,
+            "tz_offset": TZ_OFFSETS[i % len(TZ_OFFSETS)],
+            "profile": {"email": "user{}@{}".format(i, EMAIL_DOMAIN)},
+        }
+        for i in range(members)
+    ]
+
+
+def synthetic_store(path, users, years, size):
+    """Create a store with `years` of weekly history for `users`.
+
+    Args:
+        path (str): Where to create the store
+        users (list): Slack user objects
+        years (int): How many years of weekly meetings to make up
+        size (int): Pair size
+
+    Returns:
+        Store: The open store
+    """
+    store = Store(path)
+    names = [u["name"] for u in users]
+    store["everyone"] = names
+    first = date.today() - timedelta(weeks=52 * years)
+    for week in range(52 * years):
+        attending = random.sample(names, int(len(names) * 0.8))
+        groups = [
+            frozenset(attending[i : i + size]) for i in range(0, len(attending) - size + 1, size)
+        ]
+        store["history"].append({"date": first + timedelta(weeks=week), "attendees": groups})
+    return store
+
+
+def measure(func, memory=True):
+    """Run `func`, recording its wall time and peak Python memory.
+
+    Args:
+        func (callable): What to measure, it can return a dict of extra results
+        memory (Optional[bool]): Trace memory allocations too (this slows `func` down)
+
+    Returns:
+        dict: `seconds` and `peak_bytes`, plus whatever `func` returned
+    """
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    extra = func() or {}
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return dict(extra, seconds=round(seconds, 4), peak_bytes=peak)
+
+
+def run_case(members, years, size, workdir, memory=True):
+    """Benchmark every operation for one roster size, history length and pair size.
+
+    Args:
+        members (int): Roster size
+        years (int): Years of weekly history
+        size (int): Pair size
+        workdir (str): Where to create the synthetic store
+        memory (Optional[bool]): Trace peak memory for every operation
+
+    Returns:
+        list: A result dict per operation
+    """
+    users = synthetic_users(members)
+    path = os.path.join(workdir, "bench-{}-{}-{}.sqlite3".format(members, years, size))
+    case = {"members": members, "years": years, "size": size}
+
+    built = {}
+
+    def build():
+        built["store"] = synthetic_store(path, users, years, size)
+
+    results = [dict(case, op="build_store", **measure(build, memory))]
+    store = built["store"]
+    sc = StubSlackClient(users)
+    # Time bagelbot's own work: how long Slack's rate limits would add is worked out separately
+    get_outbox(sc).scale_rate_limits(None)
+
+    def throttled(func):
+        # Run `func`, adding how long Slack would have throttled the calls it made to its results
+        calls, channel_calls = Counter(sc.calls), Counter(sc.channel_calls)
+        extra = func()
+        seconds = throttle_seconds(sc.calls - calls, sc.channel_calls - channel_calls)
+        return dict(extra, throttle_seconds=round(seconds, 4))
+
+    def refresh():
+        update_everyone_from_slack(store, sc)
+        return {"api_calls": sum(sc.calls.values())}
+
+    results.append(dict(case, op="update_everyone_from_slack", **measure(refresh, memory)))
+
+    def solve():
+        stats = {}
+        names = store["everyone"]
+        window = (len(names) * (len(names) - 1)) // size
+        groups = partition(names, size, recent_conflicts(store, names, window), stats=stats)
+        return {"attempts": stats.get("steps", 0), "solved": groups is not None}
+
+    results.append(dict(case, op="partition", **measure(solve, memory)))
+
+    def solve_sharded():
+        stats = {}
+        names = store["everyone"]
+        window = (len(names) * (len(names) - 1)) // size
+        attributes = {u["name"]: u["tz_offset"] for u in users}
+        conflicts = recent_conflicts(store, names, window)
+        groups = sharded_partition(names, size, attributes, conflicts, stats=stats)
+        return {"leftovers": stats.get("leftovers", 0), "solved": groups is not None}
+
+    results.append(dict(case, op="sharded_partition", **measure(solve_sharded, memory)))
+
+    def generate():
+        attempts = 1
+        if not create_meetings(store, sc, size=size, force_create=True):
+            attempts += 1
+            create_meetings(store, sc, size=size, force_create=True, any_pair=True)
+        return {"attempts": attempts, "any_pair": attempts > 1}
+
+    results.append(dict(case, op="create_meetings", **measure(lambda: throttled(generate), memory)))
+
+    names = store["everyone"]
+
+    def fmt():
+        for i in range(0, len(names) - size + 1, size):
+            format_attendees(names[i : i + size])
+
+    results.append(dict(case, op="format_attendees", **measure(fmt, memory)))
+
+    def attendance():
+        before = sc.calls.get("chat.postMessage", 0)
+        meeting = check_attendance(store, sc)
+        return {
+            "messages": sc.calls.get("chat.postMessage", 0) - before,
+            "out": len(meeting["out"]),
+        }
+
+    results.append(
+        dict(case, op="check_attendance", **measure(lambda: throttled(attendance), memory))
+    )
+
+    store.close()
+    size_bytes = os.path.getsize(path)
+    for result in results:
+        result["store_bytes"] = size_bytes
+    os.remove(path)
+    return results
+
+
+def git_commit():
+    """The current git commit, so results can be compared between commits."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def import_times(module):
+    """Import a module in a fresh interpreter, and measure what its imports cost.
+
+    Args:
+        module (str): The module to import, e.g. 'generate_meeting'
+
+    Returns:
+        dict: The module's total import `seconds`, and the `heaviest` top level packages it pulled in
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    total = 0
+    packages = {}
+    # Lines look like "import time:  self [us] | cumulative | imported package", nested ones indented
+    for line in result.stderr.splitlines():
+        # Anything else on stderr, like a warning, isn't part of the report
+        if "import time:" not in line:
+            continue
+        own, cumulative, name = line.partition("import time:")[2].split("|")
+        if not own.strip().isdigit():
+            continue
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(own)
+        if name.strip() == module:
+            total = int(cumulative)
+    heaviest = sorted(packages.items(), key=lambda p: -p[1])[:5]
+    return {
+        "seconds": total / 1e6,
+        "heaviest": [(package, round(us / 1e6, 4)) for package, us in heaviest],
+    }
+
+
+def startup_report(budgets=None):
+    """Print how long each entry point takes to import, against its startup budget.
+
+    Args:
+        budgets (Optional[dict]): Seconds allowed per entry point, defaults to STARTUP_BUDGETS
+
+    Returns:
+        bool: True if every entry point is within its budget
+    """
+    ok = True
+    print("{:<22} {:>9} {:>9}  {}".format("entry point", "import", "budget", "heaviest"))
+    for module, budget in (budgets or STARTUP_BUDGETS).items():
+        times = import_times(module)
+        over = times["seconds"] > budget
+        ok = ok and not over
+        print(
+            "{:<22} {:>8.3f}s {:>8.3f}s  {}{}".format(
+                module,
+                times["seconds"],
+                budget,
+                ", ".join("{} {:.3f}s".format(p, s) for p, s in times["heaviest"]),
+                "  OVER BUDGET" if over else "",
+            )
+        )
+    return ok
+
+
+def compare(baseline, results):
+    """Print how results compare to a baseline run.
+
+    Args:
+        baseline (list): Result dicts from a previous run
+        results (list): Result dicts from this run
+    """
+
+    def key(result):
+        return result["op"], result["members"], result["years"], result["size"]
+
+    before = {key(r): r for r in baseline}
+    print(
+        "{:<28} {:>7} {:>5} {:>4} {:>10} {:>10} {:>8}".format(
+            "op", "members", "years", "size", "before", "after", "change"
+        )
+    )
+    for result in results:
+        old = before.get(key(result))
+        if not old:
+            continue
+        change = result["seconds"] / old["seconds"] if old["seconds"] else float("inf")
+        print(
+            "{:<28} {:>7} {:>5} {:>4} {:>9.3f}s {:>9.3f}s {:>7.2f}x".format(
+                result["op"],
+                result["members"],
+                result["years"],
+                result["size"],
+                old["seconds"],
+                result["seconds"],
+                change,
+            )
+        )
+
+
+def main(args):
+    """
+    Run every benchmark case and write the results as JSON lines. Slack calls are sent without
+    waiting on rate limits, so `seconds` is bagelbot's own time; `throttle_seconds` is how much
+    longer Slack's rate limits would have stretched the calls out over.
+
+    Args:
+        args (ArgumentParser args): Parsed arguments that pick the benchmark cases
+    """
+    if args.startup:
+        sys.exit(0 if startup_report() else 1)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    random.seed(args.seed)
+    commit = git_commit()
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for members in args.members:
+            for years in args.years:
+                for size in args.sizes:
+                    for result in run_case(members, years, size, workdir, not args.no_memory):
+                        result["commit"] = commit
+                        results.append(result)
+                        print(json.dumps(result), file=sys.stderr)
+
+    with open(args.output, "w") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare([json.loads(line) for line in f if line.strip()], results)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark bagelbot at different org sizes.")
+    parser.add_argument(
+        "--members", type=int, nargs="+", default=DEFAULT_MEMBERS, help="roster sizes"
+    )
+    parser.add_argument(
+        "--years", type=int, nargs="+", default=DEFAULT_YEARS, help="years of weekly history"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="pair sizes")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the synthetic data")
+    parser.add_argument(
+        "--output", "-o", default="benchmark.jsonl", help="where to write the results"
+    )
+    parser.add_argument("--compare", "-c", help="a previous results file to compare against")
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="don't trace peak memory (it slows everything down)",
+    )
+    parser.add_argument(
+        "--startup",
+        action="store_true",
+        help="report each entry point's import time against its budget instead",
+    )
+    main(parser.parse_args())
@@ -0,0 +1,100 @@
+"""
+Bagelbot channels - the settings for each Slack channel the service runs meetings in.
+"""
+import os
+from collections import namedtuple
+
+from config import (
+    ATTENDANCE_TIME_LIMIT,
+    CHANNELS,
+    PAIRING_SIZE,
+    SLACK_CHANNEL,
+    SLACK_CHANNEL_ID,
+    SLACK_SIGNING_SECRET,
+    SLACK_TOKEN,
+    STORE_FILE,
+)
+from scheduler import load_schedules
+
+Channel = namedtuple(
+    "Channel",
+    [
+        "name",
+        "channel",
+        "channel_id",
+        "token",
+        "signing_secret",
+        "store_file",
+        "pairing_size",
+        "attendance_time_limit",
+        "jobs",
+    ],
+)
+SETTINGS = frozenset(Channel._fields) - {"jobs"} | {"schedules"}
+
+
+def default_store_file(name):
+    """Get the store a channel uses when it doesn't configure one, e.g. `meetings-eng.sqlite3`.
+
+    Args:
+        name (str): The channel's name
+
+    Returns:
+        str: A file name based on STORE_FILE
+    """
+    root, ext = os.path.splitext(STORE_FILE)
+    return "{}-{}{}".format(root, name, ext)
+
+
+def load_channels(channels=None):
+    """Get the configured channels as `Channel`s.
+
+    Note:
+        If CHANNELS isn't set in config.py, there's a single channel made from the SLACK_CHANNEL,
+        SLACK_CHANNEL_ID, SLACK_TOKEN, SLACK_SIGNING_SECRET, STORE_FILE, PAIRING_SIZE,
+        ATTENDANCE_TIME_LIMIT and SCHEDULES settings.
+
+    Args:
+        channels (Optional[list]): Dicts of channel settings, defaults to CHANNELS
+
+    Returns:
+        list: The `Channel`s, in the order they were configured
+
+    Raises:
+        ValueError: If there are no channels, or a channel has unknown settings or shares a name or
+            store with another
+    """
+    if channels is None:
+        channels = CHANNELS
+    if channels is None:
+        channels = [{"name": "default", "store_file": STORE_FILE}]
+    if not channels:
+        raise ValueError("CHANNELS is empty, list at least one channel (or leave it as None).")
+
+    loaded = []
+    for settings in channels:
+        unknown = set(settings) - SETTINGS
+        if unknown:
+            raise ValueError(
+                "Unknown settings for channel {}: {}".format(settings.get("name"), sorted(unknown))
+            )
+        name = settings["name"]
+        loaded.append(
+            Channel(
+                name=name,
+                channel=settings.get("channel", SLACK_CHANNEL),
+                channel_id=settings.get("channel_id", SLACK_CHANNEL_ID),
+                token=settings.get("token", SLACK_TOKEN),
+                signing_secret=settings.get("signing_secret", SLACK_SIGNING_SECRET),
+                store_file=settings.get("store_file", default_store_file(name)),
+                pairing_size=settings.get("pairing_size", PAIRING_SIZE),
+                attendance_time_limit=settings.get("attendance_time_limit", ATTENDANCE_TIME_LIMIT),
+                jobs=load_schedules(settings.get("schedules")),
+            )
+        )
+
+    for field in ("name", "store_file"):
+        values = [getattr(channel, field) for channel in loaded]
+        if len(set(values)) != len(values):
+            raise ValueError("Every channel needs its own {}.".format(field))
+    return loaded
@@ -2,131 +2,365 @@
 """
 Bagelbot script for checking for attendance for an upcoming bagelbot meeting.
 """
+import asyncio
 import logging
 import sys
 import time
 from datetime import datetime, timedelta
+from functools import partial
 
-from config import ATTENDANCE_TIME_LIMIT
-from utils import YES, NO, initialize, nostdout, download_shelve_from_s3, upload_shelve_to_s3
+import metrics
+from config import ATTENDANCE_TIME_LIMIT, SLACK_SIGNING_SECRET
+from outbox import get_outbox
+from slack_events import EventHub, EventsServer, rtm_events
+from utils import (
+    YES,
+    NO,
+    initialize,
+    nostdout,
+    download_store_from_s3,
+    sync_store,
+    upload_store_to_s3,
+)
 
+CHECKPOINT = "attendance"
+CHECKPOINT_INTERVAL = 1
+PING = "attendance_ping"  # Outbox kind of the pings, so the ones still unsent can be cancelled
+EARLY_REPLIES = 5  # Messages kept per DM that might answer a ping we haven't heard back about
 
-def check_attendance(store, sc, users=None):
+
+def check_attendance(store, sc, users=None, **options):
     """Pings all slack users with the email address stored in config.py.
 
     It asks if they are available for today's meeting, and waits for a pre-determined amount of time.
     If all users respond, or if the time limit is reached, the script exits
     and writes today's upcoming meeting to the store.
 
+    Note:
+        Replies are read from the Events API endpoint (when SLACK_SIGNING_SECRET is set) or the RTM
+        connection, and each one is handled as soon as it arrives.
+
+    Args:
+        store (instance): A persistent, dictionary-like object used to keep information about past/future meetings
+        sc (SlackClient): An instance of SlackClient
+        users (list): A list of users to ping for role call (overrides store['everyone'])
+        **options: Any other arguments for `collect_attendance`
+
+    Returns:
+        dict: Today's upcoming meeting, or None if we couldn't connect to Slack
+    """
+    return asyncio.run(collect_attendance(store, sc, users=users, **options))
+
+
+def attendance_in_progress(store, now=None):
+    """Get today's attendance check from the store's checkpoint, if its window is still open.
+
+    Args:
+        store (instance): A persistent, dictionary-like object used to keep information about past/future meetings
+        now (Optional[datetime]): The current time
+
+    Returns:
+        dict: The checkpointed attendance check, or None
+    """
+    now = now or datetime.now()
+    state = store.get(CHECKPOINT)
+    if state and state["date"] == now.date() and state["deadline"] > now:
+        return state
+    return None
+
+
+async def collect_attendance(
+    store, sc, users=None, events=None, hub=None, rtm=None, time_limit=ATTENDANCE_TIME_LIMIT
+):
+    """Asyncio version of `check_attendance`.
+
+    Note:
+        Progress is checkpointed to the store under `attendance` as replies arrive. If today's window
+        is still open when this is called again (e.g. after a restart), it picks up where it left off:
+        nobody is pinged twice, and replies sent in the meantime are read from their DM history.
+        Everyone is checkpointed as pending before their ping is queued, so a ping that went out
+        without being checkpointed is found in their DM history rather than sent again.
+
     Args:
         store (instance): A persistent, dictionary-like object used to keep information about past/future meetings
         sc (SlackClient): An instance of SlackClient
         users (list): A list of users to ping for role call (overrides store['everyone'])
+        events (Optional[asyncio.Queue]): Read Slack events from this queue instead of connecting to Slack
+        hub (Optional[EventHub]): Read Slack events from this shared hub instead of connecting to Slack
+        rtm (Optional[SlackClient]): Read RTM events over this client's connection instead of `sc`'s,
+            even if SLACK_SIGNING_SECRET is set
+        time_limit (Optional[int]): Seconds to wait for replies, defaults to ATTENDANCE_TIME_LIMIT
+
+    Returns:
+        dict: Today's upcoming meeting, or None if we couldn't connect to Slack
     """
-    start = datetime.now()
-    todays_meeting = {"date": start.date(), "available": [], "out": []}
-    if not users:
-        users = store["everyone"]
-    user_len = len(users)
-    messages_sent = {}
-
-    if sc.rtm_connect():
-        for user in users:
-            logging.info("Pinging %s...", user)
-            message = sc.api_call(
-                "chat.postMessage",
-                channel="@" + user,
-                as_user=True,
-                text="Will you be available for today's ({:%Y-%m-%d}) :coffee: shuffle? [yes/no] - Please reply within 1 hour!".format(
-                    todays_meeting["date"]
-                ),
+    loop = asyncio.get_running_loop()
+    now = datetime.now()
+    state = attendance_in_progress(store, now)
+    resumed = state is not None
+    if resumed:
+        logging.info("Resuming the attendance check that's open until %s.", state["deadline"])
+    else:
+        state = {
+            "date": now.date(),
+            "started": time.time(),
+            "deadline": now + timedelta(seconds=time_limit),
+            "users": list(users or store["everyone"]),
+            "available": set(),
+            "out": set(),
+            # DM channel -> the user and ts of pings that haven't been answered yet
+            "pinged": {},
+            # Users whose ping was queued, but not yet known to have been sent
+            "pending": set(),
+        }
+    deadline = loop.time() + (state["deadline"] - now).total_seconds()
+    users = state["users"]
+    user_len = len(set(users))
+    available, out, pinged = state["available"], state["out"], state["pinged"]
+    pending = state.setdefault("pending", set())
+    early_replies = {}
+    ack_latency = []
+
+    source = None
+    if events is None:
+        events = asyncio.Queue()
+        if hub is not None:
+            hub.subscribe(loop, events)
+            source = hub
+        elif SLACK_SIGNING_SECRET and rtm is None:
+            source = EventsServer(events)
+            await source.start()
+        elif await loop.run_in_executor(None, (rtm or sc).rtm_connect):
+            source = loop.create_task(rtm_events(rtm or sc, events))
+        else:
+            logging.info("Connection Failed, invalid token?")
+            return None
+
+    outbox = get_outbox(sc)
+    last_checkpoint = None
+    dirty = True
+
+    def checkpoint():
+        nonlocal last_checkpoint, dirty
+        store[CHECKPOINT] = state
+        last_checkpoint = loop.time()
+        dirty = False
+
+    def sent(user, future):
+        if future.cancelled():
+            # The window closed before it went out
+            return
+        message = None if future.exception() else future.result()
+        loop.call_soon_threadsafe(
+            events.put_nowait, {"type": "ping_sent", "user": user, "message": message}
+        )
+
+    def caught_up(channel, future):
+        response = None if future.exception() else future.result()
+        if not response or not response.get("ok"):
+            logging.warning("Couldn't read replies to %s sent while we were away.", channel)
+            return
+        # History is newest first, and includes our own acknowledgements
+        for message in reversed(response["messages"]):
+            if "bot_id" not in message:
+                loop.call_soon_threadsafe(events.put_nowait, dict(message, channel=channel))
+
+    def reopened(user, future):
+        response = None if future.exception() else future.result()
+        if not response or not response.get("ok"):
+            loop.call_soon_threadsafe(
+                events.put_nowait, {"type": "ping_reconciled", "user": user, "channel": None}
             )
-            message["user"] = user
-            messages_sent[message["channel"]] = message
+            return
+        channel = response["channel"]["id"]
+        history = outbox.send(
+            "conversations.history",
+            channel=channel,
+            oldest="{:.6f}".format(state.get("started", 0)),
+        )
+        history.add_done_callback(partial(reconciled, user, channel))
+
+    def reconciled(user, channel, future):
+        response = None if future.exception() else future.result()
+        event = {"type": "ping_reconciled", "user": user, "channel": channel, "messages": None}
+        if response and response.get("ok"):
+            # History is newest first
+            event["messages"] = list(reversed(response["messages"]))
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    def ping(user):
+        logging.info("Pinging %s...", user)
+        outbox.post_message(
+            kind=PING,
+            channel="@" + user,
+            as_user=True,
+            text="Will you be available for today's ({:%Y-%m-%d}) :coffee: shuffle? [yes/no] - Please reply within 1 hour!".format(
+                state["date"]
+            ),
+        ).add_done_callback(partial(sent, user))
+
+    def acknowledged(received, _):
+        ack_latency.append(loop.time() - received)
+        metrics.observe("attendance_ack_seconds", ack_latency[-1])
+
+    if resumed:
+        for channel, sent_ping in pinged.items():
+            history = outbox.send("conversations.history", channel=channel, oldest=sent_ping["ts"])
+            history.add_done_callback(partial(caught_up, channel))
+        # These pings may have gone out before we were stopped, look for them before sending again
+        for user in pending:
+            outbox.send("conversations.open", users=user).add_done_callback(partial(reopened, user))
+
+    waiting = {sent_ping["user"] for sent_ping in pinged.values()} | pending
+    to_ping = [u for u in users if u not in available and u not in out and u not in waiting]
+    # Checkpoint who's about to be pinged before any ping can go out
+    pending.update(to_ping)
+    checkpoint()
+    for user in to_ping:
+        ping(user)
+
+    def handle(event):
+        nonlocal dirty
+        logging.debug(event)
+
+        if event["type"] == "ping_reconciled":
+            user, messages = event["user"], event.get("messages")
+            if messages is None:
+                # Better to miss them than to ping them twice
+                logging.warning("Couldn't tell if %s was pinged, counting them as out.", user)
+                pending.discard(user)
+                out.add(user)
+                dirty = True
+                return
+            ours = [m for m in messages if "bot_id" in m]
+            if not ours:
+                ping(user)
+                return
+            logging.info("%s was already pinged before we were stopped.", user)
+            pending.discard(user)
+            pinged[event["channel"]] = {"user": user, "ts": ours[0]["ts"]}
+            dirty = True
+            for message in messages:
+                if "bot_id" not in message:
+                    handle(dict(message, type="message", channel=event["channel"]))
+            return
+
+        if event["type"] == "ping_sent":
+            message = event["message"]
+            pending.discard(event["user"])
+            if not message or not message.get("ok"):
+                logging.warning("Couldn't ping %s, counting them as out.", event["user"])
+                out.add(event["user"])
+                dirty = True
+                return
+            pinged[message["channel"]] = {"user": event["user"], "ts": message["ts"]}
+            dirty = True
+            # Handle anything they said before we heard back that the ping went out
+            for early in early_replies.pop(message["channel"], []):
+                handle(early)
+            return
+
+        if event["type"] != "message" or "text" not in event:
+            return
+        if event["channel"] not in pinged:
+            # Only a DM from a person can answer a ping, and only while one is still on its way
+            if pending and event["channel"].startswith("D") and "bot_id" not in event:
+                early = early_replies.setdefault(event["channel"], [])
+                early.append(event)
+                del early[:-EARLY_REPLIES]
+            return
+        if float(event["ts"]) <= float(pinged[event["channel"]]["ts"]):
+            return
 
-        logging.info("Waiting for responses...")
-        while True:
+        lower_txt = event["text"].lower().strip()
+        user = pinged[event["channel"]]["user"]
+        logging.info("%s responded with '%s'", user, event["text"].encode("ascii", "ignore"))
+
+        if lower_txt in YES:
+            available.add(user)
+            text = "Your presence has been acknowledged! Thank you! :tada:"
+            metrics.inc("attendance_replies_total", answer="yes")
+        elif lower_txt in NO:
+            out.add(user)
+            text = "Your absence has been acknowledged! You will be missed! :cry:"
+            metrics.inc("attendance_replies_total", answer="no")
+        else:
+            return
+
+        # Someone's waiting to hear back, so this goes ahead of any pings still queued
+        outbox.post_message(
+            urgent=True, channel=event["channel"], as_user=True, text=text
+        ).add_done_callback(partial(acknowledged, loop.time()))
+        # User has responded to bagelbot, don't listen to this channel anymore.
+        pinged.pop(event["channel"])
+        dirty = True
+
+    logging.info("Waiting for responses...")
+    try:
+        while len(available) + len(out) < user_len:
+            timeout = deadline - loop.time()
+            if dirty:
+                timeout = min(timeout, last_checkpoint + CHECKPOINT_INTERVAL - loop.time())
             try:
-                events = sc.rtm_read()
-
-                for event in events:
-                    logging.debug(event)
-
-                    if (
-                        event["type"] == "message"
-                        and event["channel"] in messages_sent
-                        and float(event["ts"]) > float(messages_sent[event["channel"]]["ts"])
-                    ):
-                        lower_txt = event["text"].lower().strip()
-                        user = messages_sent[event["channel"]]["user"]
-                        logging.info(
-                            "%s responded with '%s'", user, event["text"].encode("ascii", "ignore")
-                        )
-
-                        user_responded = False
-                        if lower_txt in YES:
-                            user_responded = True
-                            todays_meeting["available"].append(user)
-                            sc.api_call(
-                                "chat.postMessage",
-                                channel=event["channel"],
-                                as_user=True,
-                                text="Your presence has been acknowledged! Thank you! :tada:",
-                            )
-                        elif lower_txt in NO:
-                            user_responded = True
-                            todays_meeting["out"].append(user)
-                            sc.api_call(
-                                "chat.postMessage",
-                                channel=event["channel"],
-                                as_user=True,
-                                text="Your absence has been acknowledged! You will be missed! :cry:",
-                            )
-
-                        if user_responded:
-                            # User has responded to bagelbot, don't listen to this channel anymore.
-                            messages_sent.pop(event["channel"])
-            except:
-                logging.exception("Something went wrong reading Slack RTM Events.")
-
-            all_accounted_for = (
-                len(todays_meeting["available"]) + len(todays_meeting["out"]) == user_len
-            )
-            if (
-                datetime.now() > (start + timedelta(seconds=ATTENDANCE_TIME_LIMIT))
-                or all_accounted_for
-            ):
-                if not all_accounted_for:
-                    # Move any remaining users over to 'out' at the end of the time limit - assuming they aren't available
-                    todays_meeting["out"] += [
-                        u
-                        for u in users
-                        if u not in todays_meeting["available"] and u not in todays_meeting["out"]
-                    ]
-
-                logging.info(
-                    "Finished! These people aren't available today: %s",
-                    ", ".join(todays_meeting["out"]),
-                )
-                # Store this upcoming meeting under a separate key for use by generate_meeting.py upon actual meeting generation.
-                store["upcoming"] = todays_meeting
-                break
-            else:
-                time.sleep(1)
-    else:
-        logging.info("Connection Failed, invalid token?")
+                event = await asyncio.wait_for(events.get(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                if loop.time() >= deadline:
+                    break
+                checkpoint()
+                continue
+            try:
+                handle(event)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Something went wrong handling a Slack event: %s", event)
+            if dirty and loop.time() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                checkpoint()
+    finally:
+        early_replies.clear()
+        if isinstance(source, EventHub):
+            hub.unsubscribe(events)
+        elif isinstance(source, EventsServer):
+            await source.close()
+        elif source:
+            source.cancel()
+
+    metrics.observe("attendance_seconds", (datetime.now() - now).total_seconds())
+    # Anyone who hasn't said they're available by the end of the time limit is assumed not to be
+    todays_meeting = {
+        "date": state["date"],
+        "available": [u for u in users if u in available],
+        "out": [u for u in users if u not in available],
+    }
+
+    logging.info(
+        "Finished! These people aren't available today: %s", ", ".join(todays_meeting["out"])
+    )
+    # Store this upcoming meeting under a separate key for use by generate_meeting.py upon actual meeting generation.
+    store["upcoming"] = todays_meeting
+    store.pop(CHECKPOINT, None)
+    # Anyone who hasn't been pinged by now would only be asked after the answers are in
+    outbox.cancel(PING)
+    await loop.run_in_executor(None, outbox.flush)
+    outbox.log_stats()
+    if ack_latency:
+        logging.info(
+            "Acknowledged %s replies in %.3fs on average (slowest %.3fs).",
+            len(ack_latency),
+            sum(ack_latency) / len(ack_latency),
+            max(ack_latency),
+        )
+    return todays_meeting
 
 
 def main(args):
     """
-    Initialize the shelf, possibly sync to s3, then check attendance, close
-    the shelf and maybe sync the shelf again.
+    Initialize the store, possibly sync to s3, then check attendance, close
+    the store and maybe sync the store again.
 
     Args:
         args (ArgumentParser args): Parsed arguments that impact how the check_attandance runs
     """
     if args.s3_sync:
-        download_shelve_from_s3()
+        download_store_from_s3()
 
     if args.debug:
         logging.basicConfig(stream=sys.stdout, level=logging.DEBUG, format="%(message)s")
@@ -137,9 +371,11 @@ def main(args):
     try:
         check_attendance(store, sc, users=args.users)
     finally:
+        sync_store(store)
         store.close()
         if args.s3_sync:
-            upload_shelve_to_s3()
+            upload_store_to_s3()
+        metrics.export("check_attendance")
 
 
 if __name__ == "__main__":
@@ -168,7 +404,7 @@ if __name__ == "__main__":
         "--s3-sync",
         "-s",
         action="store_true",
-        help="Synchronize SHELVE_FILE with AWS S3 before and after checking attendance.",
+        help="Synchronize STORE_FILE with AWS S3 before and after checking attendance.",
     )
     parsed_args = parser.parse_args()
 
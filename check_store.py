@@ -1,15 +1,24 @@
 #!/usr/bin/env python
 """
-Simple script for checking what all is in `meetings.shelve` - our
-persistent object for storing meeting history.
+Simple script for checking what all is in `meetings.sqlite3` - our
+persistent store for meeting history.
 """
 from pprint import pprint
 
 from utils import open_store
 
-store = open_store()
-for key in store:
-    print(" == {} == ".format(key))
-    pprint(store[key])
-    print()
-store.close()
+
+def main():
+    """Print everything in the store."""
+    store = open_store(readonly=True)
+    try:
+        for key in store:
+            print(" == {} == ".format(key))
+            pprint(store[key])
+            print()
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,18 +4,59 @@ from datetime import timedelta
 EMAIL_DOMAIN = "example.com"
 SLACK_TOKEN = "yourtoken"
 SLACK_CHANNEL = "#general"
-SHELVE_FILE = "meetings.shelve"
+SLACK_CHANNEL_ID = "C0123456789"
+SLACK_SIGNING_SECRET = None
+EVENTS_HOST = "0.0.0.0"
+EVENTS_PORT = 3000
+DIRECTORY_MAX_AGE = 4 * 60 * 60  # Seconds a cached Slack profile is trusted before it's read again
+SLACK_RECORD_FILE = None  # Record every Slack API call and event to this file, see slack_replay.py
+SLACK_REPLAY_FILE = None  # Answer Slack API calls and events from this recording instead of Slack
+SLACK_REPLAY_SPEED = 1.0  # How many times faster than recorded to replay
+STORE_FILE = "meetings.sqlite3"
+SHELVE_FILE = "meetings.shelve"  # Only read to migrate to STORE_FILE
+STORE_LOCK_TIMEOUT = 10 * 60  # Seconds a script waits for another one to finish writing the store
+HISTORY_RETENTION = None  # Keep this many recent meetings in the store and archive older ones
 ATTENDANCE_TIME_LIMIT = 60 * 60
 PAIRING_SIZE = 3
+PAIRING_TIME_BUDGET = None  # Seconds to search for the most novel pairings, None takes the first
+PAIRING_WORKERS = None  # Processes to look for pairings in, defaults to one per core
+ROTATION = False  # Plan weeks of pairings for everyone ahead and follow them, see rotation.py
+ROTATION_WEEKS = 52  # The most weeks a rotation plans
+# Pair big rosters in shards by a Slack user or profile field, e.g. "tz_offset", see sharding.py
+PAIRING_SHARD_BY = None
+PAIRING_SHARD_ACROSS = False  # Mix every value in each shard instead, keeping equal ones apart
+PAIRING_SHARD_SIZE = 500  # The most people in a shard
+OUTBOX_WORKERS = 8
+METRICS_DIR = None  # Write Prometheus textfiles here, e.g. node_exporter's textfile collector directory
+METRICS_PORT = None  # Serve Prometheus metrics over HTTP from service.py on this port
+PROFILE_DIR = "profiles"  # Where service.py writes profiling reports, see profiling.py
+PROFILE_CONTROL_FILE = "bagelbot.profile"  # service.py profiles itself while this file exists
+PROFILE_INTERVAL = 0.01  # Seconds between stack samples while profiling
 GOOGLE_HANGOUT_URL = "https://g.co/meet/"
 S3_BUCKET = None
 S3_PREFIX = None
+UPLOAD_DELAY = 5  # Seconds service.py waits for more changes to a store before uploading it to S3
+UPLOAD_MAX_DELAY = 60  # Most seconds service.py delays an upload while the store keeps changing
 FREQUENCY = timedelta(days=0)
 TIMEZONE = "US/Central"
 ATTENDANCE_TIME = {"hour": 11, "minute": 28, "weekday": 0}
 ATTENDANCE_TIME_ALT = {"hour": 11, "minute": 28, "weekday": 0}
 MEETING_TIME = {"hour": 14, "minute": 29, "weekday": 0}
 MEETING_TIME_ALT = {"hour": 14, "minute": 29, "weekday": 0}
+# Any number of {"job": "attendance" or "meeting", "hour": ..., "minute": ..., "weekday": ...} dicts.
+# Defaults to the ATTENDANCE_TIME(_ALT) and MEETING_TIME(_ALT) settings above when None.
+SCHEDULES = None
+# How late a missed scheduled run (e.g. while the service was down) can still be caught up. A run
+# that was due while the channel's previous job (e.g. an attendance check) was running is measured
+# from when that job finished.
+SCHEDULE_GRACE = timedelta(minutes=30)
+# Run meetings for several channels from one service.py. Each is a dict with a unique "name" and any of
+# "channel", "channel_id", "token", "signing_secret", "store_file", "pairing_size",
+# "attendance_time_limit" and "schedules", which default to the settings above ("store_file"
+# defaults to e.g. "meetings-<name>.sqlite3"). A channel in another workspace needs that workspace's
+# "token" and, for the Events API, its app's "signing_secret".
+# Defaults to a single channel using the settings above when None.
+CHANNELS = None
 
 if os.path.exists("config_private.py"):
     # Use config_private for your own personal settings - default to be git ignored.
@@ -0,0 +1,343 @@
+"""
+Bagelbot fake Slack - a local stand-in for the parts of Slack's Web API bagelbot uses, with simulated
+users who reply to attendance pings through the Events API or RTM, so everything can be load tested
+without touching a real workspace.
+"""
+import base64
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import random
+import threading
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from urllib.parse import parse_qs
+
+import requests
+
+from outbox import DEFAULT_RATE_LIMIT, GLOBAL_RATE_LIMITS, PER_CHANNEL, RATE_LIMITS, TokenBucket
+from slack_events import sign_request
+
+DELIVERY_WORKERS = 8
+RTM_PATH = "/rtm"
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class FakeSlack:
+    """Serves 'conversations.members', 'users.list', 'users.info', 'chat.postMessage' and
+    'rtm.connect' from memory.
+
+    Every direct message to a user gets a 'yes' (or 'no' for roughly `out_rate` of them) after a
+    random delay, except for roughly `silent_rate` of users who never reply. Replies are delivered
+    to `events_url` as signed Events API requests, and to every RTM websocket that's connected.
+    Calls over Slack's rate limits (times `rate_scale`) get a 429 with a Retry-After (divided by
+    `rate_scale`), like the real thing.
+
+    Args:
+        users (list): Slack user objects, all of them are members of every channel
+        signing_secret (str): Secret to sign event requests with
+        events_url (Optional[str]): Where to deliver events, can also be set after starting
+        reply_delay (Optional[tuple]): Minimum and maximum seconds before a user replies
+        out_rate (Optional[float]): Share of users who reply 'no'
+        silent_rate (Optional[float]): Share of users who don't reply at all
+        rate_scale (Optional[float]): Multiplier for Slack's rate limits, None to not rate limit
+    """
+
+    def __init__(
+        self,
+        users,
+        signing_secret,
+        events_url=None,
+        reply_delay=(0, 1),
+        out_rate=0.1,
+        silent_rate=0.0,
+        rate_scale=1.0,
+    ):
+        self.users = users
+        self.by_id = {u["id"]: u for u in users}
+        self.by_name = {u["name"]: u for u in users}
+        self.signing_secret = signing_secret
+        self.events_url = events_url
+        self.reply_delay = reply_delay
+        self.out_rate = out_rate
+        self.silent_rate = silent_rate
+        self.rate_scale = rate_scale
+
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.ts = itertools.count(1)
+        self.event_ids = itertools.count(1)
+        self.calls = {}
+        self.rate_limited = 0
+        self.posted = []
+        self.replied = {}
+        self.ack_latency = []
+
+        self.rtm_feeds = []
+        self.pending = []
+        self.wakeup = threading.Condition(self.lock)
+        self.delivery = ThreadPoolExecutor(DELIVERY_WORKERS)
+        self.session = requests.Session()
+        self.server = None
+
+    @property
+    def url(self):
+        """The Web API's base URL, for `SlackAPI(url=...)`."""
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}/api/".format(host, port)
+
+    def start(self, host="127.0.0.1", port=0):
+        """Start serving the Web API and delivering replies from background threads.
+
+        Args:
+            host (Optional[str]): Address to listen on
+            port (Optional[int]): Port to listen on, defaults to any free port
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                params = {k: v[-1] for k, v in parse_qs(body.decode()).items()}
+                status, headers, response = fake.handle(self.path.rsplit("/", 1)[-1], params)
+                payload = json.dumps(response).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                if self.path != RTM_PATH or "Sec-WebSocket-Key" not in self.headers:
+                    self.send_error(404)
+                    return
+                key = self.headers["Sec-WebSocket-Key"] + WEBSOCKET_GUID
+                self.send_response(101)
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                accept = base64.b64encode(hashlib.sha1(key.encode()).digest()).decode()
+                self.send_header("Sec-WebSocket-Accept", accept)
+                self.end_headers()
+                self.wfile.flush()
+                fake.stream_rtm(self.wfile)
+                self.close_connection = True
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self._deliver, daemon=True).start()
+        logging.info("Fake Slack serving %s users at %s", len(self.users), self.url)
+
+    def close(self):
+        """Stop serving."""
+        with self.lock:
+            for feed in self.rtm_feeds:
+                feed.put(None)
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        self.delivery.shutdown(wait=False)
+
+    def stats(self):
+        """Get what the fake has seen so far.
+
+        Returns:
+            dict: Calls per method, 429s returned, messages posted per second, and how long acknowledgements took
+        """
+        with self.lock:
+            posted = [when for when, _ in self.posted]
+            latency = sorted(self.ack_latency)
+            calls = dict(self.calls)
+            rate_limited = self.rate_limited
+        elapsed = posted[-1] - posted[0] if len(posted) > 1 else 0
+        return {
+            "calls": calls,
+            "rate_limited": rate_limited,
+            "posted": len(posted),
+            "posted_per_second": round(len(posted) / elapsed, 1) if elapsed else None,
+            "acks": len(latency),
+            "ack_p50": percentile(latency, 0.5),
+            "ack_p95": percentile(latency, 0.95),
+            "ack_max": latency[-1] if latency else None,
+        }
+
+    def handle(self, method, params):
+        """Answer one Web API call.
+
+        Args:
+            method (str): The Slack API method
+            params (dict): The call's form parameters
+
+        Returns:
+            tuple: (HTTP status, headers, response dict)
+        """
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            retry_after = self._rate_limit(method, params)
+            if retry_after:
+                self.rate_limited += 1
+        if retry_after:
+            # Slack asks for whole seconds, which are scaled like the limits are
+            seconds = max(1, round(retry_after * self.rate_scale)) / self.rate_scale
+            headers = {"Retry-After": "{:g}".format(seconds)}
+            return 429, headers, {"ok": False, "error": "ratelimited"}
+
+        if method in ("conversations.members", "users.list"):
+            start = int(params.get("cursor") or 0)
+            stop = start + int(params.get("limit", 100))
+            page = self.users[start:stop]
+            if method == "conversations.members":
+                page = [u["id"] for u in page]
+            metadata = {"next_cursor": str(stop) if stop < len(self.users) else ""}
+            return 200, {}, {"ok": True, "members": page, "response_metadata": metadata}
+        if method == "users.info":
+            user = self.by_id.get(params.get("user"))
+            if not user:
+                return 200, {}, {"ok": False, "error": "user_not_found"}
+            return 200, {}, {"ok": True, "user": user}
+        if method == "chat.postMessage":
+            return 200, {}, self._post_message(params)
+        if method == "rtm.connect":
+            host, port = self.server.server_address[:2]
+            url = "ws://{}:{}{}".format(host, port, RTM_PATH)
+            return 200, {}, {"ok": True, "url": url}
+        return 200, {}, {"ok": False, "error": "unknown_method"}
+
+    def stream_rtm(self, wfile):
+        """Send events over an RTM websocket until it's closed, or the fake is.
+
+        Args:
+            wfile (file): The upgraded connection to write websocket frames to
+        """
+        feed = Queue()
+        with self.lock:
+            self.rtm_feeds.append(feed)
+        try:
+            feed.put({"type": "hello"})
+            while True:
+                event = feed.get()
+                if event is None:
+                    break
+                wfile.write(websocket_frame(json.dumps(event).encode()))
+                wfile.flush()
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.rtm_feeds.remove(feed)
+
+    def _rate_limit(self, method, params):
+        if self.rate_scale is None:
+            return 0
+        limits = [(method, RATE_LIMITS.get(method, DEFAULT_RATE_LIMIT))]
+        if method in PER_CHANNEL:
+            limits = [((method, params.get("channel")), RATE_LIMITS[method])]
+            if method in GLOBAL_RATE_LIMITS:
+                limits.insert(0, (method, GLOBAL_RATE_LIMITS[method]))
+        for key, (per_minute, burst) in limits:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(per_minute * self.rate_scale, burst)
+            retry_after = self.buckets[key].try_acquire()
+            if retry_after:
+                return retry_after
+        return 0
+
+    def _post_message(self, params):
+        channel = params.get("channel", "")
+        now = time.monotonic()
+        with self.lock:
+            ts = "{}.000000".format(next(self.ts))
+            self.posted.append((now, channel))
+            if channel in self.replied:
+                self.ack_latency.append(now - self.replied.pop(channel))
+        if channel.startswith("@"):
+            user = self.by_name.get(channel[1:])
+            if not user:
+                return {"ok": False, "error": "channel_not_found"}
+            channel = "D" + user["id"]
+            if random.random() >= self.silent_rate:
+                reply = "no" if random.random() < self.out_rate else "yes"
+                self._schedule(random.uniform(*self.reply_delay), user, channel, reply)
+        return {"ok": True, "channel": channel, "ts": ts}
+
+    def _schedule(self, delay, user, channel, text):
+        with self.wakeup:
+            event = {"type": "message", "channel": channel, "user": user["id"], "text": text}
+            heapq.heappush(self.pending, (time.monotonic() + delay, next(self.event_ids), event))
+            self.wakeup.notify()
+
+    def _deliver(self):
+        while True:
+            with self.wakeup:
+                while not self.pending or self.pending[0][0] > time.monotonic():
+                    timeout = self.pending[0][0] - time.monotonic() if self.pending else None
+                    self.wakeup.wait(timeout)
+                _, event_id, event = heapq.heappop(self.pending)
+                event["ts"] = "{}.000000".format(next(self.ts))
+            self.delivery.submit(self._send_event, event_id, event)
+
+    def _send_event(self, event_id, event):
+        with self.lock:
+            self.replied[event["channel"]] = time.monotonic()
+            for feed in self.rtm_feeds:
+                feed.put(event)
+        if not self.events_url:
+            return
+        body = json.dumps(
+            {"type": "event_callback", "event_id": "Ev{}".format(event_id), "event": event}
+        ).encode()
+        timestamp = str(int(time.time()))
+        headers = {
+            "Content-Type": "application/json",
+            "X-Slack-Request-Timestamp": timestamp,
+            "X-Slack-Signature": sign_request(self.signing_secret, timestamp, body),
+        }
+        try:
+            self.session.post(self.events_url, data=body, headers=headers, timeout=10)
+        except requests.RequestException as e:
+            logging.warning("Couldn't deliver an event to %s: %s", self.events_url, e)
+
+
+def websocket_frame(payload):
+    """Wrap a message in an unmasked websocket text frame, as a server sends them.
+
+    Args:
+        payload (bytes): The message
+
+    Returns:
+        bytes: The frame
+    """
+    if len(payload) < 126:
+        header = struct.pack("!BB", 0x81, len(payload))
+    elif len(payload) < 1 << 16:
+        header = struct.pack("!BBH", 0x81, 126, len(payload))
+    else:
+        header = struct.pack("!BBQ", 0x81, 127, len(payload))
+    return header + payload
+
+
+def percentile(values, share):
+    """Pick a percentile from sorted values.
+
+    Args:
+        values (list): Sorted numbers
+        share (float): Which percentile, between 0 and 1
+
+    Returns:
+        float: The value, or None if there are none
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * share))]
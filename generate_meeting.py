@@ -3,13 +3,35 @@
 Bagelbot script for generating an upcoming bagelbot meeting.
 """
 import logging
-import random
 import sys
 from datetime import date
 from uuid import uuid4
 
-from config import GOOGLE_HANGOUT_URL, PAIRING_SIZE, SLACK_CHANNEL
-from utils import YES, NO, initialize, nostdout, download_shelve_from_s3, upload_shelve_to_s3
+from config import (
+    GOOGLE_HANGOUT_URL,
+    PAIRING_SHARD_ACROSS,
+    PAIRING_SHARD_BY,
+    PAIRING_SIZE,
+    PAIRING_TIME_BUDGET,
+    PAIRING_WORKERS,
+    ROTATION,
+    SLACK_CHANNEL,
+)
+import metrics
+from history import meeting_ages, record_meeting, recent_conflicts
+from outbox import get_outbox
+from pairing import best_partition, group_sizes, partition
+from rotation import advance_rotation, planned_groups
+from sharding import member_attributes, sharded_partition
+from utils import (
+    YES,
+    NO,
+    initialize,
+    nostdout,
+    download_store_from_s3,
+    sync_store,
+    upload_store_to_s3,
+)
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(message)s")
 
@@ -20,12 +42,28 @@ def get_google_hangout_url():
 
 
 def create_meetings(
-    store, sc, size=PAIRING_SIZE, whos_out=None, pairs=None, force_create=False, any_pair=False
+    store,
+    sc,
+    size=PAIRING_SIZE,
+    whos_out=None,
+    pairs=None,
+    force_create=False,
+    any_pair=False,
+    channel=SLACK_CHANNEL,
+    budget=PAIRING_TIME_BUDGET,
+    rotation=ROTATION,
+    shard_by=PAIRING_SHARD_BY,
+    shard_across=PAIRING_SHARD_ACROSS,
 ):
     """Randomly generates sets of pairs for (usually) 1 on 1 meetings for a Slack team.
 
     Given the `size`, list of all users and who is out today, it generates a randomized set of people
-    to per group to meet and chat. It tries not to redo any groups from the past nCr weeks (experimental).
+    to per group to meet and chat. Nobody is grouped with someone they've already met in the past nCr weeks,
+    or if no such grouping can be found, in the past half as many weeks, and so on down to last week.
+    With a `budget`, candidate pairings are generated on every core for that long, and the one whose
+    people met least recently wins. With `rotation`, groups come from a rotation planned ahead for
+    everyone instead, repaired around who is out. With `shard_by`, people are paired within (or
+    with `shard_across`, across) shards of their Slack attribute, see `sharded_partition`.
 
     Args:
         store (instance): A persistent, dictionary-like object used to keep information about past/future meetings
@@ -35,9 +73,18 @@ def create_meetings(
         pairs (list): List of slack users explictly pair up (elements of list are in the form of 'username+username')
         force_create (Optional[bool]): If True, generate the meeting and write it to storage without asking if it should.
         any_pair (Optional[bool]): If True, generate any pairing - regardless if it's happened in the past or not
+        channel (Optional[str]): The Slack channel to post the meeting in, defaults to SLACK_CHANNEL
+        budget (Optional[float]): Seconds to search for the most novel pairings, defaults to
+            PAIRING_TIME_BUDGET. None takes the first pairings found.
+        rotation (Optional[bool]): If True, follow the planned rotation when it fits today,
+            defaults to ROTATION in config.py
+        shard_by (Optional[str]): A Slack user field cached in the directory to shard people by,
+            e.g. 'tz_offset', defaults to PAIRING_SHARD_BY. None pairs everyone in one pool.
+        shard_across (Optional[bool]): Mix people in each shard instead, keeping those with the
+            same attribute apart, defaults to PAIRING_SHARD_ACROSS
 
     Returns:
-        bool: True if successful, False otherwise.
+        bool: True if successful, False if no pairing avoids even the last meeting's groups.
     """
     if whos_out is None:
         whos_out = []
@@ -51,30 +98,26 @@ def create_meetings(
         whos_out = whos_out + store["upcoming"]["out"]
         found_upcoming = True
 
-    names = [n for n in store["everyone"] if n not in whos_out]
+    out = set(whos_out)
+    names = [n for n in store["everyone"] if n not in out]
     max_pair_size = size
 
     # == Handle Explicit Pairs ==
-    for _, explicit_pair in enumerate(pairs):
-        local_names = names[:]
-        pairing = []
-
-        try:
-            members = explicit_pair.split("+")
-            for member in members:
-                local_names.remove(member)
-                pairing.append(member)
-        except:
+    remaining = set(names)
+    for explicit_pair in pairs:
+        pairing = frozenset(explicit_pair.split("+"))
+        if len(pairing) != explicit_pair.count("+") + 1 or not pairing <= remaining:
             sys.exit(
                 "ERROR: The following explicit pair was either malformed, contained invalid user names, or has members listed as being out: {}".format(
                     explicit_pair
                 )
             )
 
-        # Store difference of names (remaining people to pair)
+        # Take them out of the remaining people to pair
         max_pair_size = max(max_pair_size, len(pairing))
-        names = [n for n in names if n in local_names]
-        todays_meeting["attendees"].append(frozenset(pairing))
+        remaining -= pairing
+        todays_meeting["attendees"].append(pairing)
+    names = [n for n in names if n in remaining]
 
     # == Set up Random Pairing Numbers ==
     names_len = len(names)
@@ -83,71 +126,56 @@ def create_meetings(
             del store["upcoming"]
         # Write out as a canceled meeting
         todays_meeting["canceled"] = True
-        store["history"].append(todays_meeting)
-        sc.api_call(
-            "chat.postMessage",
-            channel=SLACK_CHANNEL,
+        record_meeting(store, todays_meeting)
+        get_outbox(sc).post_message(
+            channel=channel,
             as_user=True,
             text="Today's :coffee: has been canceled - not enough people are available!",
-        )
+        ).result()
         logging.warning("Not enough people to have a meeting, canceling request.")
         return True
 
-    number_of_pairings = names_len // size
-    out_remainder = names_len % size
-    max_pair_size = max(max_pair_size, names_len + out_remainder + 1)
-    logging.info("Going to generate %s pairs for today's meeting...", number_of_pairings)
-    # Get the nCr of meetings and try not to repeat a pairing
+    sizes = group_sizes(names_len, size)
+    max_pair_size = max(max_pair_size, names_len + names_len % size + 1)
+    logging.info("Going to generate %s pairs for today's meeting...", len(sizes))
+    # Get the nCr of meetings and don't repeat anyone who met in them, or if that can't be done,
+    # anyone who met in half as many, and so on down to just the last meeting
     nCr = (names_len * (names_len - 1)) // size
-    previous_pairings = (
-        [set(pair) for p in store["history"][-nCr:] for pair in p["attendees"]]
-        if "history" in store
-        else []
-    )
+    # (a window longer than the history is the same as the whole history)
+    window = 0 if any_pair else min(nCr, store["history"].total)
 
     # == Handle Random Pairs ==
-    attempts = 1
-    max_attempts = 25
-    while number_of_pairings:
-        # Only add an extra person per group unless at the last pair,
-        # then clear out all remaining people into the last group.
-        if out_remainder > 0 and number_of_pairings:
-            if number_of_pairings > 1:
-                remainder = 1
-                out_remainder -= 1
-            else:
-                remainder = out_remainder
-                out_remainder = 0
-        else:
-            remainder = 0
-
-        local_size = size + remainder
-        local_names = names[:]
-        pairing = []
-
-        while local_size:
-            name = random.choice(local_names)
-            local_names.remove(name)
-            pairing.append(name)
-            local_size -= 1
-
-        if not any_pair:
-            pairing = frozenset(pairing)
-            if pairing in previous_pairings and attempts <= max_attempts:
-                logging.info(
-                    "Generated already existing pair, going to try again (%s attempt(s) so far)",
-                    attempts,
-                )
-                attempts += 1
-                continue
-            elif attempts > max_attempts:
-                logging.warning("Max randomizing attempts reached, Got to start over again!!!!")
-                return False
-
-        # Store difference of names (remaining people to pair)
-        names = [n for n in names if n in local_names]
-        todays_meeting["attendees"].append(pairing)
-        number_of_pairings -= 1
+    if any_pair:
+        metrics.inc("pairing_any_pair_total")
+    pairings = None
+    if rotation and not any_pair:
+        pairings = planned_groups(store, names, size, window=window)
+    from_rotation = pairings is not None
+    if from_rotation:
+        metrics.inc("pairing_rotation_total")
+    while pairings is None:
+        previous_pairings = recent_conflicts(store, names, window) if window else {}
+        stats = {}
+        pairings = generate_pairings(
+            store, names, size, previous_pairings, budget, shard_by, shard_across, stats
+        )
+        if pairings is not None or window <= 1:
+            break
+        step_limit = stats.get("step_limit", False)
+        logging.warning(
+            "Couldn't generate pairings without repeating one from the last %s meetings (%s),"
+            " trying the last %s.",
+            window,
+            "the solver hit its step limit" if step_limit else "no such pairing exists",
+            window // 2,
+        )
+        metrics.inc("pairing_window_shrunk_total", step_limit=step_limit)
+        window //= 2
+    if pairings is None:
+        logging.warning("Couldn't generate pairings without repeating a past one!")
+        metrics.inc("pairing_no_solution_total")
+        return False
+    todays_meeting["attendees"] += pairings
 
     # == Log Pairs ==
     logging.info("\n== Pairings for %s ==\n", todays_meeting["date"].strftime("%Y-%m-%d"))
@@ -157,25 +185,22 @@ def create_meetings(
     logging.info(pretty_attendees)
     pretty_whos_out = format_attendees([o[0] + "." + o[1:] for o in whos_out], at=False)
     logging.info("(Who's out: %s)", pretty_whos_out)
-    if names:
-        # names should be empty if everyone is paired.
-        sys.exit("\n ERROR: These people were not paired: {}".format(", ".join(names)))
 
     # == Generate meeting and Save ==
     while True:
         if force_create:
             answer = "yes"
         else:
-            answer = input("\nAccept and write to shelf storage? (y/n) ").lower()
+            answer = input("\nAccept and write to storage? (y/n) ").lower()
 
         if answer in YES:
             if found_upcoming:
                 del store["upcoming"]
 
-            if "history" not in store:
-                store["history"] = []
-            store["history"].append(todays_meeting)
-            send_to_slack(pretty_attendees, pretty_whos_out, sc)
+            record_meeting(store, todays_meeting)
+            if from_rotation:
+                advance_rotation(store)
+            send_to_slack(pretty_attendees, pretty_whos_out, sc, channel)
             break
         elif answer in NO:
             logging.info("NOT saving these pairings.")
@@ -186,6 +211,50 @@ def create_meetings(
     return True
 
 
+def generate_pairings(
+    store, names, size, conflicts, budget=None, shard_by=None, shard_across=False, stats=None
+):
+    """Split `names` into groups with whichever solver `create_meetings` was asked to use.
+
+    Args:
+        store (instance): A persistent, dictionary-like object used to keep information about past/future meetings
+        names (list): People to split into groups
+        size (int): Pair size
+        conflicts (dict): Maps a name to the names they must not be grouped with
+        budget (Optional[float]): Seconds to search for the most novel pairings, see `best_partition`
+        shard_by (Optional[str]): A Slack user field to shard people by, see `sharded_partition`
+        shard_across (Optional[bool]): Mix people in each shard instead
+        stats (Optional[dict]): If given, the solver's stats are recorded in it
+
+    Returns:
+        list: A list of frozensets (one per group), or None if no valid grouping was found
+    """
+    stats = {} if stats is None else stats
+    if shard_by:
+        pairings = sharded_partition(
+            names,
+            size,
+            member_attributes(store, shard_by),
+            conflicts,
+            across=shard_across,
+            workers=PAIRING_WORKERS,
+            stats=stats,
+        )
+        metrics.observe("pairing_shard_leftovers", stats.get("leftovers", 0))
+    elif budget:
+        ages = meeting_ages(store, names)
+        pairings = best_partition(
+            names, size, ages, budget, conflicts, workers=PAIRING_WORKERS, stats=stats
+        )
+        metrics.observe("pairing_candidates", stats.get("candidates", 0))
+        if pairings is not None:
+            metrics.observe("pairing_repeat_penalty", stats["penalty"])
+    else:
+        pairings = partition(names, size, conflicts, stats=stats)
+        metrics.observe("pairing_steps", stats.get("steps", 0))
+    return pairings
+
+
 def format_attendees(l, t=5, at=True):
     """Auxiliary function to format a list of names into proper English. It also appends
     a random google hangout URL at the end of '@' mentioned attendees.
@@ -215,67 +284,70 @@ def format_attendees(l, t=5, at=True):
     return att + " - " + get_google_hangout_url() if at else att
 
 
-def send_to_slack(pretty_attendees, pretty_whos_out, sc):
+def send_to_slack(pretty_attendees, pretty_whos_out, sc, channel=SLACK_CHANNEL):
     """Send today's meeting lineup to the specified SLACK_CHANNEL
 
     Args:
         pretty_attendees (list): A list of strings (generated name pairs)
         pretty_whos_out (list): A list of strings (people not in today's meetings)
         sc (SlackClient): An instance of SlackClient
+        channel (Optional[str]): The Slack channel to post in, defaults to SLACK_CHANNEL
     """
-    sc.api_call(
-        "chat.postMessage",
-        channel=SLACK_CHANNEL,
+    outbox = get_outbox(sc)
+    outbox.post_message(
+        channel=channel,
         as_user=True,
         text="Today's :coffee: pairs are below!",
     )
-    sc.api_call(
-        "chat.postMessage",
-        channel=SLACK_CHANNEL,
+    posted = outbox.post_message(
+        channel=channel,
         as_user=True,
         text=pretty_attendees,
         link_names=True,
     )
     if pretty_whos_out:
-        sc.api_call(
-            "chat.postMessage",
-            channel=SLACK_CHANNEL,
+        posted = outbox.post_message(
+            channel=channel,
             as_user=True,
             text="(Who's out: {})".format(pretty_whos_out),
         )
-    logging.info("Slack message posted to %s!", SLACK_CHANNEL)
+    # Messages to the same channel are sent in order, so the last one being done means they all are
+    posted.result()
+    logging.info("Slack message posted to %s!", channel)
 
 
 def main(args):
     """
-    Initialize the shelf, possibly sync to s3, then generate a meeting, close
-    the shelf and maybe sync the shelf again.
+    Initialize the store, possibly sync to s3, then generate a meeting, close
+    the store and maybe sync the store again.
 
     Args:
         args (ArgumentParser args): Parsed arguments that impact how the generate_meeting runs
     """
     if args.s3_sync:
-        download_shelve_from_s3()
+        download_store_from_s3()
 
     store, sc = initialize(update_everyone=True)
     try:
-        max_attempts, attempt = 100, 1
-        success = False
-        while not success:
-            success = create_meetings(
-                store,
-                sc,
-                size=args.size,
-                whos_out=args.whos_out,
-                pairs=args.pairs,
-                force_create=args.force_create,
-                any_pair=attempt > max_attempts,
-            )
-            attempt += 1
+        options = dict(
+            size=args.size,
+            whos_out=args.whos_out,
+            pairs=args.pairs,
+            force_create=args.force_create,
+            budget=args.budget,
+            rotation=args.rotation,
+            shard_by=args.shard_by,
+            shard_across=args.shard_across,
+        )
+        if not create_meetings(store, sc, **options):
+            logging.warning("Falling back to pairing anyone, regardless of past meetings.")
+            create_meetings(store, sc, any_pair=True, **options)
     finally:
+        sync_store(store)
         store.close()
         if args.s3_sync:
-            upload_shelve_to_s3()
+            upload_store_to_s3()
+        metrics.export("generate_meeting")
 
 
 if __name__ == "__main__":
@@ -315,6 +387,32 @@ if __name__ == "__main__":
         default=PAIRING_SIZE,
         help="size of pairings (default set in config.py)",
     )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=PAIRING_TIME_BUDGET,
+        help="seconds to search for the most novel pairings (default set in config.py)",
+    )
+    parser.add_argument(
+        "--rotation",
+        action="store_true",
+        default=ROTATION,
+        help="follow a no-repeat rotation planned ahead for everyone (default set in config.py)",
+    )
+    parser.add_argument(
+        "--shard-by",
+        metavar="FIELD",
+        default=PAIRING_SHARD_BY,
+        help="pair people in shards by a Slack user field, e.g. tz_offset or title"
+        " (default set in config.py)",
+    )
+    parser.add_argument(
+        "--shard-across",
+        action="store_true",
+        default=PAIRING_SHARD_ACROSS,
+        help="mix people in each shard, keeping those with the same field apart"
+        " (default set in config.py)",
+    )
     parser.add_argument(
         "--force-create",
         action="store_true",
@@ -326,7 +424,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--s3-sync",
         action="store_true",
-        help="Synchronize SHELVE_FILE with AWS S3 before and after checking attendance.",
+        help="Synchronize STORE_FILE with AWS S3 before and after checking attendance.",
     )
     parsed_args = parser.parse_args()
 
@@ -0,0 +1,89 @@
+"""
+Bagelbot helpers for keeping meeting history and the index of who has met whom.
+"""
+import metrics
+from config import HISTORY_RETENTION
+
+
+def record_meeting(store, meeting, retention=HISTORY_RETENTION):
+    """Append a meeting to the store's `history`, which also updates the pair index with it.
+
+    Meetings older than the last `retention` are then moved to the store's archive.
+
+    Args:
+        store (instance): A persistent, dictionary-like object used to keep information about past/future meetings
+        meeting (dict): The meeting to store
+        retention (Optional[int]): How many meetings to keep in the store, None to keep them all
+    """
+    history = store["history"]
+    history.append(meeting)
+    metrics.inc("meetings_total", canceled=bool(meeting.get("canceled")))
+    if retention is not None:
+        for _ in history.archive(retention):
+            metrics.inc("archive_segments_total")
+
+
+def last_met(store, a, b):
+    """Look up when two people were last in the same group.
+
+    Args:
+        store (instance): A persistent, dictionary-like object used to keep information about past/future meetings
+        a (str): A slack username
+        b (str): Another slack username
+
+    Returns:
+        tuple: (meeting number, date, times met), or None if they have never met
+    """
+    return store.last_met(a, b)
+
+
+def met_within(store, a, b, window):
+    """Check if two people have been in the same group in the last `window` meetings.
+
+    Args:
+        store (instance): A persistent, dictionary-like object used to keep information about past/future meetings
+        a (str): A slack username
+        b (str): Another slack username
+        window (int): How many of the most recent meetings to look at
+
+    Returns:
+        bool: True if they met inside the window
+    """
+    met = store.last_met(a, b)
+    return met is not None and met[0] >= store["history"].total - window
+
+
+def meeting_ages(store, names):
+    """Find how long ago each person last met each of the others.
+
+    Args:
+        store (instance): A persistent, dictionary-like object used to keep information about past/future meetings
+        names (list): Slack usernames to look up
+
+    Returns:
+        dict: Maps each name to {other name: how many meetings ago they last met}, counting the
+            most recent meeting as 1 ago
+    """
+    names = set(names)
+    total = store["history"].total
+    ages = {}
+    for a, b, number, _, _ in store.pairs():
+        if a in names and b in names:
+            ages.setdefault(a, {})[b] = total - number
+    return ages
+
+
+def recent_conflicts(store, names, window):
+    """Find who each person has already met in the last `window` meetings.
+
+    Args:
+        store (instance): A persistent, dictionary-like object used to keep information about past/future meetings
+        names (list): Slack usernames to look up
+        window (int): How many of the most recent meetings to look at
+
+    Returns:
+        dict: Maps each name to the set of people they met inside the window
+    """
+    names = set(names)
+    met = store.met(since=store["history"].total - window)
+    return {a: others for a, others in met.items() if a in names}
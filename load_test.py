@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Bagelbot load test - runs a full attendance window and meeting generation against a local fake
+Slack with thousands of simulated users, and reports latency and throughput. Replies come in
+through the Events API, or over RTM with --rtm.
+"""
+import json
+import logging
+import os
+import random
+import tempfile
+from uuid import uuid4
+
+from benchmark import measure, synthetic_users
+from check_attendance import check_attendance
+from fake_slack import FakeSlack
+from generate_meeting import create_meetings
+from outbox import get_outbox
+from slack_api import SlackAPI
+from slack_events import EventHub, serve_events_in_background
+from storage import Store
+from utils import update_everyone_from_slack
+
+CHANNEL = "#load-test"
+CHANNEL_ID = "C0LOADTEST"
+
+
+def run(args):
+    """Run the load test.
+
+    Args:
+        args (ArgumentParser args): Parsed arguments that set up the simulated users
+
+    Returns:
+        dict: Timings for each phase, plus what the fake Slack saw
+    """
+    secret = uuid4().hex
+    rate_scale = None if args.no_rate_limit else args.rate_scale
+    fake = FakeSlack(
+        synthetic_users(args.users),
+        secret,
+        reply_delay=(args.min_delay, args.max_delay),
+        out_rate=args.out_rate,
+        silent_rate=args.silent_rate,
+        rate_scale=rate_scale,
+    )
+    fake.start()
+    hub = None
+    if not args.rtm:
+        hub = EventHub()
+        events = serve_events_in_background(hub, signing_secret=secret, host="127.0.0.1", port=0)
+        fake.events_url = "http://127.0.0.1:{}/".format(events.port)
+    sc = SlackAPI("load-test", url=fake.url)
+    # Pace calls to the fake's limits rather than the real Slack's
+    get_outbox(sc).scale_rate_limits(rate_scale)
+
+    results = {"users": args.users, "replies": "rtm" if args.rtm else "events"}
+    with tempfile.TemporaryDirectory() as workdir:
+        store = Store(os.path.join(workdir, "load-test.sqlite3"))
+        try:
+            results["update_everyone_from_slack"] = measure(
+                lambda: update_everyone_from_slack(store, sc, CHANNEL_ID), memory=False
+            )
+
+            def attendance():
+                rtm = sc if args.rtm else None
+                meeting = check_attendance(store, sc, hub=hub, rtm=rtm, time_limit=args.window)
+                return {"available": len(meeting["available"]), "out": len(meeting["out"])}
+
+            results["check_attendance"] = measure(attendance, memory=False)
+
+            def generate():
+                options = dict(size=args.size, force_create=True, channel=CHANNEL)
+                if not create_meetings(store, sc, **options):
+                    create_meetings(store, sc, any_pair=True, **options)
+                return {"groups": len(store["history"][-1]["attendees"])}
+
+            results["create_meetings"] = measure(generate, memory=False)
+        finally:
+            store.close()
+            fake.close()
+
+    results["slack"] = fake.stats()
+    return results
+
+
+def main(args):
+    """
+    Run the load test and print its results as JSON.
+
+    Args:
+        args (ArgumentParser args): Parsed arguments that set up the simulated users
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    random.seed(args.seed)
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Load test attendance checks and meeting generation against a fake Slack."
+    )
+    parser.add_argument("--users", type=int, default=2000, help="how many users to simulate")
+    parser.add_argument(
+        "--min-delay", type=float, default=0.0, help="fewest seconds before a user replies"
+    )
+    parser.add_argument(
+        "--max-delay", type=float, default=5.0, help="most seconds before a user replies"
+    )
+    parser.add_argument("--out-rate", type=float, default=0.1, help="share of users who say no")
+    parser.add_argument(
+        "--silent-rate", type=float, default=0.0, help="share of users who never reply"
+    )
+    parser.add_argument(
+        "--window", type=int, default=60, help="seconds to wait for attendance replies"
+    )
+    parser.add_argument("--size", type=int, default=2, help="pair size")
+    parser.add_argument(
+        "--rate-scale",
+        type=float,
+        default=1.0,
+        help="multiplier for Slack's rate limits, in the fake and bagelbot's outbox",
+    )
+    parser.add_argument(
+        "--no-rate-limit", action="store_true", help="don't simulate or pace to Slack's rate limits"
+    )
+    parser.add_argument(
+        "--rtm", action="store_true", help="read replies over RTM instead of the Events API"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the simulated users")
+    main(parser.parse_args())
@@ -0,0 +1,196 @@
+"""
+Bagelbot metrics - counters, gauges and timers for the bot's operations, exported in the
+Prometheus text format to a file or a local HTTP endpoint.
+"""
+import contextlib
+import logging
+import os
+import threading
+import time
+
+from config import METRICS_DIR
+
+PREFIX = "bagelbot_"
+
+# name: (type, help)
+METRICS = {
+    "slack_api_seconds": ("summary", "Time spent waiting on Slack API calls."),
+    "slack_api_errors_total": ("counter", "Slack API calls that didn't return ok."),
+    "slack_api_retries_total": ("counter", "Slack API calls retried after a rate limit or error."),
+    "outbox_queued": ("gauge", "Slack API calls waiting in the outbound queue."),
+    "outbox_retries_total": ("counter", "Slack API calls retried after being rate limited."),
+    "pairing_steps": ("summary", "Groups tried by the pairing solver per meeting."),
+    "pairing_candidates": ("summary", "Candidate pairings scored per meeting."),
+    "pairing_repeat_penalty": ("summary", "Repeat penalty of the pairings picked."),
+    "pairing_no_solution_total": ("counter", "Meetings where no pairing without repeats existed."),
+    "pairing_window_shrunk_total": (
+        "counter",
+        "Times the no-repeat window was halved, by whether the solver hit its step limit.",
+    ),
+    "pairing_any_pair_total": ("counter", "Meetings generated allowing repeat pairings."),
+    "pairing_rotation_total": ("counter", "Meetings whose groups came from the planned rotation."),
+    "pairing_shard_leftovers": ("summary", "People left over by the shards, paired across them."),
+    "meetings_total": ("counter", "Meetings written to history."),
+    "archive_segments_total": ("counter", "History archive segments written."),
+    "attendance_seconds": ("summary", "How long attendance windows stayed open."),
+    "attendance_replies_total": ("counter", "Attendance replies, by answer."),
+    "attendance_ack_seconds": ("summary", "Time from an attendance reply to its acknowledgement."),
+    "store_lease_seconds": ("summary", "Time spent waiting for the store's writer lease."),
+    "store_sync_seconds": ("summary", "Time spent syncing the store to disk."),
+    "store_bytes": ("gauge", "Size of the store file."),
+    "s3_bytes_total": ("counter", "Bytes transferred to and from S3, by direction."),
+    "s3_skipped_total": ("counter", "S3 transfers skipped because nothing changed, by direction."),
+    "s3_seconds": ("summary", "Time spent on S3 transfers, by direction."),
+    "s3_upload_lag_seconds": ("summary", "Time from a store changing to it being uploaded to S3."),
+    "s3_upload_pending": ("gauge", "Stores waiting to be uploaded to S3."),
+    "s3_upload_failures_total": ("counter", "Background S3 uploads that failed, by reason."),
+    "job_seconds": ("summary", "Time spent running scheduled jobs, by job."),
+    "job_last_run_timestamp_seconds": ("gauge", "When each scheduled job last finished."),
+    "scheduler_sleep_seconds": ("gauge", "How long the service last slept waiting for a job."),
+}
+
+
+def _escape(value):
+    # Label values escape backslashes (first), double quotes and newlines
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Registry:
+    """Holds the current value of every metric, by name and labels."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _update(self, name, labels, update):
+        if name not in METRICS:
+            raise KeyError("Unknown metric: {}".format(name))
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            series[key] = update(series.get(key))
+
+    def inc(self, name, value=1, **labels):
+        """Add to a counter.
+
+        Args:
+            name (str): The metric's name (without PREFIX)
+            value (Optional[float]): How much to add
+            **labels: The metric's labels
+        """
+        self._update(name, labels, lambda old: (old or 0) + value)
+
+    def set(self, name, value, **labels):
+        """Set a gauge.
+
+        Args:
+            name (str): The metric's name (without PREFIX)
+            value (float): The new value
+            **labels: The metric's labels
+        """
+        self._update(name, labels, lambda old: value)
+
+    def observe(self, name, value, **labels):
+        """Record one observation of a summary (e.g. a duration).
+
+        Args:
+            name (str): The metric's name (without PREFIX)
+            value (float): The observed value
+            **labels: The metric's labels
+        """
+        self._update(name, labels, lambda old: (old[0] + 1, old[1] + value) if old else (1, value))
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """A context that observes how many seconds it took.
+
+        Args:
+            name (str): The metric's name (without PREFIX)
+            **labels: The metric's labels
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics
+        """
+        lines = []
+        with self.lock:
+            for name in sorted(self.values):
+                kind, doc = METRICS[name]
+                lines.append("# HELP {}{} {}".format(PREFIX, name, doc))
+                lines.append("# TYPE {}{} {}".format(PREFIX, name, kind))
+                for key, value in sorted(self.values[name].items()):
+                    labels = ",".join('{}="{}"'.format(k, _escape(v)) for k, v in key)
+                    labels = "{" + labels + "}" if labels else ""
+                    if kind == "summary":
+                        lines.append("{}{}_count{} {}".format(PREFIX, name, labels, value[0]))
+                        lines.append("{}{}_sum{} {}".format(PREFIX, name, labels, value[1]))
+                    else:
+                        lines.append("{}{}{} {}".format(PREFIX, name, labels, value))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Atomically write every metric to a file, e.g. for node_exporter's textfile collector.
+
+        Args:
+            path (str): The file to write
+        """
+        partial = path + ".tmp"
+        with open(partial, "w") as f:
+            f.write(self.render())
+        os.replace(partial, path)
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve the metrics over HTTP from a background thread.
+
+        Args:
+            port (int): The port to listen on
+            host (Optional[str]): The address to listen on
+
+        Returns:
+            ThreadingHTTPServer: The running server
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=invalid-name
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info("Serving metrics on http://%s:%s/metrics", host, port)
+        return server
+
+
+REGISTRY = Registry()
+inc = REGISTRY.inc
+set_gauge = REGISTRY.set
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+
+
+def export(script):
+    """Write the metrics to METRICS_DIR (if it's set) as `bagelbot_<script>.prom`.
+
+    Args:
+        script (str): Name of the entry point that's exporting
+    """
+    if METRICS_DIR:
+        REGISTRY.write_textfile(os.path.join(METRICS_DIR, "{}{}.prom".format(PREFIX, script)))
@@ -0,0 +1,330 @@
+"""
+Bagelbot outbound message queue - sends Slack API calls from a pool of workers while staying
+under Slack's rate limits.
+"""
+import logging
+import threading
+import time
+import weakref
+import zlib
+from concurrent.futures import Future
+from queue import Queue
+
+import metrics
+from config import OUTBOX_WORKERS
+
+# Requests per minute (and burst size) for the methods we call, see https://api.slack.com/docs/rate-limits
+RATE_LIMITS = {
+    "chat.postMessage": (60, 3),  # Special tier: about one message per second per channel, short bursts ok
+    "conversations.members": (100, 10),  # Tier 4
+    "users.info": (100, 10),  # Tier 4
+    "users.list": (20, 2),  # Tier 2
+    "rtm.connect": (1, 1),  # Tier 1
+}
+DEFAULT_RATE_LIMIT = (50, 5)  # Tier 3
+PER_CHANNEL = frozenset(["chat.postMessage"])
+# Workspace-wide limits for methods whose RATE_LIMITS are per channel
+GLOBAL_RATE_LIMITS = {"chat.postMessage": (300, 10)}  # Slack allows several hundred a minute
+DEFAULT_RETRY_AFTER = 1
+RATELIMITED_RETRIES = 5  # Times a rate limited call is retried before it fails
+URGENT_WORKERS = 2  # Workers that only send urgent calls, so they never wait behind a backlog
+
+_outboxes = weakref.WeakKeyDictionary()
+_outboxes_lock = threading.Lock()
+
+
+class TokenBucket:
+    """Hands out tokens at a steady rate, allowing short bursts.
+
+    Args:
+        per_minute (int): How many tokens are handed out each minute
+        burst (int): How many tokens can be saved up
+    """
+
+    def __init__(self, per_minute, burst=1):
+        self.rate = per_minute / 60.0
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.urgent = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self, urgent=False):
+        """Take a token if one is available, without blocking.
+
+        Args:
+            urgent (Optional[bool]): Take the token even if urgent callers are waiting for one
+
+        Returns:
+            float: 0 if a token was taken, otherwise how many seconds until one will be available
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.urgent and not urgent:
+                # Leave the tokens for the urgent callers, and check back once they've had theirs
+                return 1 / self.rate
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, urgent=False):
+        """Block until a token is available and take it.
+
+        Args:
+            urgent (Optional[bool]): Go ahead of everyone who isn't urgent
+        """
+        if urgent:
+            with self.lock:
+                self.urgent += 1
+        try:
+            while True:
+                wait = self.try_acquire(urgent)
+                if not wait:
+                    return
+                time.sleep(wait)
+        finally:
+            if urgent:
+                with self.lock:
+                    self.urgent -= 1
+
+    def pause(self, seconds):
+        """Don't hand out any tokens for the next `seconds` (used when Slack says to Retry-After).
+
+        Args:
+            seconds (float): How long to hold off for
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class Outbox:
+    """A queue of outbound Slack API calls, sent by a pool of worker threads.
+
+    Calls to the same channel always go through the same worker, so they're sent in the order
+    they were queued. Each method (and for chat.postMessage, each channel) gets its own token
+    bucket based on Slack's rate limit tiers, and chat.postMessage also shares a workspace-wide
+    one. Rate limited calls are retried after the `Retry-After` Slack asks for, up to
+    RATELIMITED_RETRIES times, after which their future fails with a SlackAPIError.
+
+    Urgent calls (like replies to someone who's waiting) are sent by their own workers, and take
+    tokens ahead of everything else, so they never wait behind a backlog. Calls can be tagged with
+    a `kind`, so any of them that haven't been sent yet can be cancelled together.
+
+    Args:
+        sc (SlackClient): An instance of SlackClient
+        workers (Optional[int]): How many worker threads to send with
+    """
+
+    def __init__(self, sc, workers=OUTBOX_WORKERS):
+        self.sc = sc
+        self.buckets = {}
+        self.rate_scale = 1.0
+        self.lock = threading.Lock()
+        self.queues = [Queue() for _ in range(workers)]
+        self.urgent_queues = [Queue() for _ in range(URGENT_WORKERS)]
+        self.unsent = {}
+        self.started = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.cancelled = 0
+        for q in self.queues:
+            threading.Thread(target=self._work, args=(q,), daemon=True).start()
+        for q in self.urgent_queues:
+            threading.Thread(target=self._work, args=(q, True), daemon=True).start()
+
+    def send(self, method, kind=None, urgent=False, **kwargs):
+        """Queue up a Slack API call.
+
+        Args:
+            method (str): The Slack API method, e.g. 'chat.postMessage'
+            kind (Optional[str]): A tag for the call, so it can be cancelled with `cancel`
+            urgent (Optional[bool]): Send the call ahead of anything that isn't urgent
+            **kwargs: Arguments for the API method
+
+        Returns:
+            Future: Resolves to the API response once the call has been made
+        """
+        future = Future()
+        channel = str(kwargs.get("channel", ""))
+        with self.lock:
+            if self.started is None:
+                self.started = time.monotonic()
+            if kind is not None:
+                self.unsent.setdefault(kind, set()).add(future)
+        queues = self.urgent_queues if urgent else self.queues
+        queues[zlib.crc32(channel.encode()) % len(queues)].put((method, kwargs, future, kind))
+        metrics.set_gauge("outbox_queued", self.depth())
+        return future
+
+    def post_message(self, kind=None, urgent=False, **kwargs):
+        """Queue up a 'chat.postMessage' call.
+
+        Args:
+            kind (Optional[str]): A tag for the message, so it can be cancelled with `cancel`
+            urgent (Optional[bool]): Send the message ahead of anything that isn't urgent
+            **kwargs: Arguments for 'chat.postMessage'
+
+        Returns:
+            Future: Resolves to the API response once the message has been sent
+        """
+        return self.send("chat.postMessage", kind=kind, urgent=urgent, **kwargs)
+
+    def cancel(self, kind):
+        """Cancel every call tagged with `kind` that hasn't started being sent yet.
+
+        Their futures are cancelled, and the workers skip them.
+
+        Args:
+            kind (str): The tag the calls were queued with
+
+        Returns:
+            int: How many calls were cancelled
+        """
+        with self.lock:
+            futures = self.unsent.pop(kind, set())
+        cancelled = sum(future.cancel() for future in futures)
+        with self.lock:
+            self.cancelled += cancelled
+        if cancelled:
+            logging.info("Cancelled %s unsent %s calls.", cancelled, kind)
+        return cancelled
+
+    def scale_rate_limits(self, scale):
+        """Send calls `scale` times faster (or slower) than Slack's rate limits allow.
+
+        For benchmarks and load tests against a stand-in for Slack.
+
+        Args:
+            scale (Optional[float]): What to multiply every limit by, None turns them off
+        """
+        with self.lock:
+            self.rate_scale = scale
+            self.buckets = {}
+
+    def flush(self):
+        """Block until everything queued so far has been sent (or skipped, if it was cancelled)."""
+        for q in self.queues + self.urgent_queues:
+            q.join()
+
+    def depth(self):
+        """How many calls are waiting to be sent."""
+        return sum(q.qsize() for q in self.queues + self.urgent_queues)
+
+    def stats(self):
+        """Get the outbox's counters.
+
+        Returns:
+            dict: Calls sent, failed, retried and cancelled, the current queue depth, and calls sent
+            per second
+        """
+        elapsed = time.monotonic() - self.started if self.started else 0
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "cancelled": self.cancelled,
+            "queued": self.depth(),
+            "per_second": self.sent / elapsed if elapsed else 0.0,
+        }
+
+    def log_stats(self):
+        """Log the outbox's counters."""
+        logging.info(
+            "Outbox: %(sent)s sent, %(failed)s failed, %(retried)s retried, %(cancelled)s cancelled,"
+            " %(queued)s queued (%(per_second).1f/s)",
+            self.stats(),
+        )
+
+    def _count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _bucket(self, key, limit):
+        with self.lock:
+            if key not in self.buckets:
+                per_minute, burst = limit
+                self.buckets[key] = TokenBucket(per_minute * self.rate_scale, burst)
+            return self.buckets[key]
+
+    def _buckets(self, method, kwargs):
+        # Every bucket a call needs a token from
+        if self.rate_scale is None:
+            return []
+        if method not in PER_CHANNEL:
+            return [self._bucket(method, RATE_LIMITS.get(method, DEFAULT_RATE_LIMIT))]
+        buckets = [self._bucket((method, kwargs.get("channel")), RATE_LIMITS[method])]
+        if method in GLOBAL_RATE_LIMITS:
+            buckets.append(self._bucket(method, GLOBAL_RATE_LIMITS[method]))
+        return buckets
+
+    def _call(self, method, kwargs):
+        # Rate limited calls are retried here, with every bucket paused, rather than by a SlackAPI
+        if hasattr(self.sc, "request"):
+            return self.sc.request(method, kwargs, wait_ratelimited=False)
+        return self.sc.api_call(method, **kwargs)
+
+    def _work(self, q, urgent=False):
+        while True:
+            method, kwargs, future, kind = q.get()
+            with self.lock:
+                self.unsent.get(kind, set()).discard(future)
+            if not future.set_running_or_notify_cancel():
+                q.task_done()
+                metrics.set_gauge("outbox_queued", self.depth())
+                continue
+            try:
+                buckets = self._buckets(method, kwargs)
+                for attempt in range(RATELIMITED_RETRIES + 1):
+                    for bucket in buckets:
+                        bucket.acquire(urgent)
+                    response = self._call(method, kwargs)
+                    if response.get("error") != "ratelimited" or attempt == RATELIMITED_RETRIES:
+                        break
+                    retry_after = float(
+                        response.get("headers", {}).get("Retry-After", DEFAULT_RETRY_AFTER)
+                    )
+                    logging.warning("Rate limited on %s, retrying in %ss.", method, retry_after)
+                    self._count("retried")
+                    metrics.inc("outbox_retries_total", method=method)
+                    for bucket in buckets:
+                        bucket.pause(retry_after)
+
+                if response.get("error") == "ratelimited":
+                    from slack_api import SlackAPIError
+
+                    raise SlackAPIError(method, response)
+                if response.get("ok"):
+                    self._count("sent")
+                else:
+                    self._count("failed")
+                    logging.warning("%s failed: %s", method, response.get("error"))
+                future.set_result(response)
+            except Exception as e:  # pylint: disable=broad-except
+                self._count("failed")
+                future.set_exception(e)
+            finally:
+                q.task_done()
+                metrics.set_gauge("outbox_queued", self.depth())
+
+
+def get_outbox(sc):
+    """Get the shared Outbox for a SlackClient, creating it the first time.
+
+    Args:
+        sc (SlackClient): An instance of SlackClient
+
+    Returns:
+        Outbox: The SlackClient's outbox
+    """
+    with _outboxes_lock:
+        if sc not in _outboxes:
+            _outboxes[sc] = Outbox(sc)
+        return _outboxes[sc]
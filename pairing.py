@@ -0,0 +1,393 @@
+"""
+Bagelbot pairing engine - splits people into groups without repeating past co-attendance.
+"""
+import logging
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+
+MAX_SEARCH_STEPS = 200000
+
+
+def group_sizes(count, size):
+    """Work out how many groups to make and how big each one is.
+
+    Every group is `size` people, except that leftover people are handed out one per group,
+    with the last group taking whatever is still remaining.
+
+    Args:
+        count (int): Number of people to split into groups
+        size (int): Pair size
+
+    Returns:
+        list: The size of every group, in the order they are filled
+    """
+    number_of_pairings = count // size
+    out_remainder = count % size
+    sizes = []
+    while number_of_pairings:
+        if out_remainder > 0:
+            if number_of_pairings > 1:
+                remainder = 1
+                out_remainder -= 1
+            else:
+                remainder = out_remainder
+                out_remainder = 0
+        else:
+            remainder = 0
+        sizes.append(size + remainder)
+        number_of_pairings -= 1
+    return sizes
+
+
+def build_conflicts(groups):
+    """Turn a list of past groups into a lookup of who has already met whom.
+
+    Args:
+        groups (iterable): Past groups, each an iterable of names
+
+    Returns:
+        dict: Maps each name to the set of names they have shared a group with
+    """
+    conflicts = {}
+    for group in groups:
+        for a, b in combinations(group, 2):
+            if a == b:
+                continue
+            conflicts.setdefault(a, set()).add(b)
+            conflicts.setdefault(b, set()).add(a)
+    return conflicts
+
+
+def partition(names, size, conflicts=None, rng=None, max_steps=MAX_SEARCH_STEPS, stats=None):
+    """Randomly split `names` into groups where nobody shares a group with someone they've met.
+
+    This is a randomized backtracking search. Groups are built around the person with the fewest
+    compatible people left, and a branch is abandoned as soon as somebody can no longer be placed.
+    If the search runs out of branches, no valid grouping exists. If it runs out of steps first,
+    one might, and `step_limit` is set in `stats`.
+
+    Note:
+        People are numbered in their shuffled order, and the search works on integer bitsets of
+        those numbers, so checking who is blocked or still unassigned costs a few word operations
+        instead of a set lookup per person.
+
+    Args:
+        names (list): People to split into groups
+        size (int): Pair size (leftovers are spread out as described in `group_sizes`)
+        conflicts (Optional[dict]): Maps a name to the names they must not be grouped with
+        rng (Optional[random.Random]): Source of randomness, defaults to the `random` module
+        max_steps (Optional[int]): Give up after trying this many groups
+        stats (Optional[dict]): If given, the number of groups tried is recorded under `steps`,
+            and `step_limit` is set if the search gave up before trying every option
+
+    Returns:
+        list: A list of frozensets (one per group), or None if no valid grouping was found
+    """
+    rng = rng or random
+    order = list(names)
+    rng.shuffle(order)
+    number = {name: i for i, name in enumerate(order)}
+    conflicts = conflicts or {}
+    blocked = [0] * len(order)
+    blocked_by = [0] * len(order)
+    for person, name in enumerate(order):
+        for other in conflicts.get(name, ()):
+            if other in number:
+                blocked[person] |= 1 << number[other]
+                blocked_by[number[other]] |= 1 << person
+
+    sizes = group_sizes(len(order), size)
+    if not sizes:
+        return []
+    remaining_sizes = {}
+    for s in sizes:
+        remaining_sizes[s] = remaining_sizes.get(s, 0) + 1
+    unassigned = (1 << len(order)) - 1
+    # How many unassigned people each person could still be grouped with is `count[p] - placed`.
+    # Placing a group only changes the counts of people who are blocked from someone in it, and
+    # unassigned people are kept in buckets by count, so the most constrained one is always at hand.
+    placed = 0
+    count = [len(order) - 1 - popcount(mask) for mask in blocked]
+    buckets = {}
+    for person, c in enumerate(count):
+        buckets[c] = buckets.get(c, 0) | 1 << person
+
+    def leave(person):
+        buckets[count[person]] &= ~(1 << person)
+        if not buckets[count[person]]:
+            del buckets[count[person]]
+
+    def join(person):
+        buckets[count[person]] = buckets.get(count[person], 0) | 1 << person
+
+    def cliques(pool, need):
+        if not need:
+            yield 0
+            return
+        for person in bits(pool):
+            pool &= ~(1 << person)
+            rest = pool & ~blocked[person]
+            if popcount(rest) < need - 1:
+                continue
+            for tail in cliques(rest, need - 1):
+                yield (1 << person) | tail
+
+    def candidate_groups():
+        lowest = buckets[min(buckets)]
+        anchor = (lowest & -lowest).bit_length() - 1
+        pool = unassigned & ~(1 << anchor) & ~blocked[anchor]
+        for s in sorted(remaining_sizes, reverse=True):
+            for tail in cliques(pool, s - 1):
+                yield s, (1 << anchor) | tail
+
+    def feasible():
+        if not unassigned:
+            return True
+        return min(buckets) - placed >= min(remaining_sizes) - 1
+
+    def blockers(group):
+        mask = 0
+        for member in bits(group):
+            mask |= blocked_by[member]
+        return mask & unassigned
+
+    def place(s, group):
+        nonlocal unassigned, placed
+        for member in bits(group):
+            leave(member)
+        unassigned &= ~group
+        placed += popcount(group)
+        for person in bits(blockers(group)):
+            leave(person)
+            count[person] += popcount(group & blocked[person])
+            join(person)
+        remaining_sizes[s] -= 1
+        if not remaining_sizes[s]:
+            del remaining_sizes[s]
+
+    def unplace(s, group):
+        nonlocal unassigned, placed
+        for person in bits(blockers(group)):
+            leave(person)
+            count[person] -= popcount(group & blocked[person])
+            join(person)
+        placed -= popcount(group)
+        unassigned |= group
+        for member in bits(group):
+            join(member)
+        remaining_sizes[s] = remaining_sizes.get(s, 0) + 1
+
+    if not feasible():
+        logging.info("Somebody has already met everyone else, no grouping without repeats exists.")
+        return None
+
+    chosen = []
+    stack = [candidate_groups()]
+    steps = 0
+    if stats is None:
+        stats = {}
+    while stack:
+        try:
+            s, group = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            if chosen:
+                unplace(*chosen.pop())
+            continue
+
+        steps += 1
+        stats["steps"] = steps
+        if steps > max_steps:
+            logging.warning(
+                "Step limit hit: gave up looking for pairings after trying %s groups.", max_steps
+            )
+            stats["step_limit"] = True
+            return None
+
+        place(s, group)
+        chosen.append((s, group))
+        if not unassigned:
+            logging.info("Found pairings after trying %s group(s).", steps)
+            groups = [frozenset(order[p] for p in bits(group)) for _, group in chosen]
+            rng.shuffle(groups)
+            return groups
+        if feasible():
+            stack.append(candidate_groups())
+        else:
+            unplace(*chosen.pop())
+
+    logging.info("Tried every option (%s groups), no grouping without repeats exists.", steps)
+    return None
+
+
+def join_groups(groups, people, size, conflicts=None):
+    """Add each person to the smallest group they have no conflicts in, up to one more than `size`.
+
+    Args:
+        groups (list): The groups to join, a list of frozensets
+        people (iterable): People to add
+        size (int): Pair size
+        conflicts (Optional[dict]): Maps a name to the names they must not be grouped with
+
+    Returns:
+        list: A list of frozensets, or None if somebody fits in no group
+    """
+    conflicts = conflicts or {}
+    groups = list(groups)
+    for person in sorted(people):
+        options = [
+            i
+            for i, group in enumerate(groups)
+            if len(group) <= size and not conflicts.get(person, set()) & group
+        ]
+        if not options:
+            return None
+        smallest = min(options, key=lambda i: len(groups[i]))
+        groups[smallest] = groups[smallest] | {person}
+    return groups
+
+
+def bits(mask):
+    """List the members of a bitset, lowest first.
+
+    Args:
+        mask (int): The bitset
+
+    Yields:
+        int: The number of each set bit
+    """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def popcount(mask):
+    """Count the members of a bitset.
+
+    Args:
+        mask (int): The bitset
+
+    Returns:
+        int: How many bits are set
+    """
+    return bin(mask).count("1")
+
+
+if hasattr(int, "bit_count"):
+    popcount = int.bit_count  # noqa: F811 - Python 3.10+ counts bits natively
+
+
+def repeat_penalty(groups, ages):
+    """Score how much a grouping repeats past meetings - lower is better, 0 means nobody has met.
+
+    Every pair that has met before adds `1 / age`, so meeting again after a long time costs
+    much less than meeting again right away.
+
+    Args:
+        groups (list): The grouping, a list of sets of names
+        ages (dict): Maps a name to {other name: how many meetings ago they last met, at least 1}
+
+    Returns:
+        float: The penalty
+    """
+    penalty = 0.0
+    for group in groups:
+        for a, b in combinations(group, 2):
+            age = ages.get(a, {}).get(b)
+            if age:
+                penalty += 1.0 / age
+    return penalty
+
+
+def quiet_worker():
+    """Only log warnings from a worker process, which would otherwise log every grouping it finds."""
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def _search(names, size, conflicts, ages, deadline, seed, max_steps):
+    rng = random.Random(seed)
+    best, best_penalty, candidates = None, None, 0
+    stats = {}
+    while True:
+        groups = partition(names, size, conflicts, rng=rng, max_steps=max_steps, stats=stats)
+        if groups is None:
+            break
+        candidates += 1
+        penalty = repeat_penalty(groups, ages)
+        if best is None or penalty < best_penalty:
+            best, best_penalty = groups, penalty
+        if not penalty or time.time() >= deadline:
+            break
+    return best, best_penalty, candidates, stats.get("step_limit", False)
+
+
+def best_partition(
+    names,
+    size,
+    ages,
+    budget,
+    conflicts=None,
+    workers=None,
+    rng=None,
+    max_steps=MAX_SEARCH_STEPS,
+    stats=None,
+):
+    """Generate random groupings on every core for `budget` seconds and pick the most novel one.
+
+    Each grouping is made by `partition`, so it still avoids `conflicts`, and is scored with
+    `repeat_penalty`. The search stops early if a grouping where nobody has met turns up.
+
+    Args:
+        names (list): People to split into groups
+        size (int): Pair size (leftovers are spread out as described in `group_sizes`)
+        ages (dict): Maps a name to {other name: how many meetings ago they last met}
+        budget (float): Seconds to spend searching
+        conflicts (Optional[dict]): Maps a name to the names they must not be grouped with
+        workers (Optional[int]): Processes to search in, defaults to one per core
+        rng (Optional[random.Random]): Where the searches' seeds come from, defaults to `random`
+        max_steps (Optional[int]): Give up on a grouping after trying this many groups
+        stats (Optional[dict]): If given, the number of groupings scored is recorded under
+            `candidates` and the best one's penalty under `penalty`, and `step_limit` is set if a
+            search gave up before trying every option
+
+    Returns:
+        list: A list of frozensets (one per group), or None if no valid grouping was found
+    """
+    rng = rng or random
+    workers = workers or os.cpu_count() or 1
+    deadline = time.time() + budget
+    searches = [
+        (names, size, conflicts, ages, deadline, rng.getrandbits(64), max_steps)
+        for _ in range(workers)
+    ]
+    if workers == 1:
+        logging.disable(logging.INFO)
+        try:
+            results = [_search(*search) for search in searches]
+        finally:
+            logging.disable(logging.NOTSET)
+    else:
+        with ProcessPoolExecutor(workers, initializer=quiet_worker) as pool:
+            results = list(pool.map(_search, *zip(*searches)))
+
+    found = [(penalty, groups) for groups, penalty, _, _ in results if groups is not None]
+    if stats is not None:
+        stats["candidates"] = sum(candidates for _, _, candidates, _ in results)
+        if any(step_limit for _, _, _, step_limit in results):
+            stats["step_limit"] = True
+    if not found:
+        logging.info("No grouping without repeats was found.")
+        return None
+    penalty, groups = min(found, key=lambda result: result[0])
+    if stats is not None:
+        stats["penalty"] = penalty
+    logging.info(
+        "Picked pairings with a repeat penalty of %.3f out of %s candidates.",
+        penalty,
+        stats["candidates"] if stats is not None else "many",
+    )
+    return groups
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+Bagelbot profiling - samples every thread's stack and traces memory allocations in a running
+service.py, switched on and off with a signal or a control file, and writes timestamped reports.
+"""
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from config import PROFILE_CONTROL_FILE, PROFILE_DIR, PROFILE_INTERVAL
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TRACE_FRAMES = 10  # Stack frames kept for each traced memory allocation
+TOP_ALLOCATIONS = 30  # Lines in each memory report
+CONTROL_POLL_SECONDS = 1
+
+
+class Profiler:
+    """Profiles the process it's in while switched on, from a thread of its own.
+
+    While on, every thread's stack is sampled each `interval` seconds, and memory allocations are
+    traced with tracemalloc. Switching it off, or asking for a report while it's on, writes:
+
+    - `<timestamp>-stacks.txt`: sampled stacks in the collapsed format flamegraph.pl reads, one
+      `thread;outermost;...;innermost count` line per distinct stack
+    - `<timestamp>-memory.txt`: the process's peak RSS, the biggest allocations by line, and how
+      they changed since the last report (only allocations made while profiling are traced)
+    - `<timestamp>-memory.snapshot`: the tracemalloc snapshot, to compare with `profiling.py`
+
+    SIGUSR1 switches it on and off and SIGUSR2 asks for a report. It's also on for as long as
+    `control_file` exists.
+
+    Args:
+        directory (Optional[str]): Where reports are written, defaults to PROFILE_DIR
+        control_file (Optional[str]): Profile while this file exists, defaults to
+            PROFILE_CONTROL_FILE
+        interval (Optional[float]): Seconds between stack samples, defaults to PROFILE_INTERVAL
+    """
+
+    def __init__(
+        self, directory=PROFILE_DIR, control_file=PROFILE_CONTROL_FILE, interval=PROFILE_INTERVAL
+    ):
+        self.directory = directory
+        self.control_file = control_file
+        self.interval = interval
+        self.active = False
+        self.requests = []
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self.tracing = False
+        self.previous = None
+        self.thread = None
+
+    def install(self):
+        """Start watching for signals and the control file.
+
+        Note:
+            Signal handlers can only be installed from the main thread, and not at all on Windows,
+            where only the control file works.
+
+        Returns:
+            Profiler: Itself
+        """
+        if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, self._on_signal)
+            signal.signal(signal.SIGUSR2, self._on_signal)
+        self.thread = threading.Thread(target=self._work, name="profiler", daemon=True)
+        self.thread.start()
+        return self
+
+    def toggle(self):
+        """Switch profiling on if it's off, or off (writing a report) if it's on."""
+        self.requests.append("toggle")
+
+    def report(self):
+        """Write a report of everything sampled since the last one, if profiling is on."""
+        self.requests.append("report")
+
+    def _on_signal(self, signum, frame):
+        # Only queue the request, the profiler's own thread does the work
+        self.requests.append("toggle" if signum == signal.SIGUSR1 else "report")
+
+    def _start(self):
+        logging.info("Profiling switched on, reports go to %s.", self.directory)
+        self.active = True
+        self.started = time.time()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+            self.tracing = True
+
+    def _stop(self):
+        self._write_report()
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+        self.previous = None
+        self.active = False
+        logging.info("Profiling switched off.")
+
+    def _work(self):
+        controlled = False
+        polled = 0
+        while True:
+            time.sleep(self.interval if self.active else CONTROL_POLL_SECONDS)
+            if self.active:
+                self._sample()
+
+            if self.control_file and time.time() - polled >= CONTROL_POLL_SECONDS:
+                polled = time.time()
+                exists = os.path.exists(self.control_file)
+                if exists != controlled:
+                    controlled = exists
+                    if exists != self.active:
+                        self.requests.append("toggle")
+
+            while self.requests:
+                request = self.requests.pop(0)
+                try:
+                    if request == "toggle" and self.active:
+                        self._stop()
+                    elif request == "toggle":
+                        self._start()
+                    elif self.active:
+                        self._write_report()
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception("Profiling failed to %s.", request)
+
+    def _sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _write_report(self):
+        os.makedirs(self.directory, exist_ok=True)
+        prefix = os.path.join(self.directory, time.strftime("%Y%m%d-%H%M%S"))
+
+        with open(prefix + "-stacks.txt", "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+        seconds = time.time() - self.started
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        snapshot.dump(prefix + "-memory.snapshot")
+        current, peak = tracemalloc.get_traced_memory()
+        with open(prefix + "-memory.txt", "w") as f:
+            f.write("Traced memory: {} bytes now, {} bytes at peak\n".format(current, peak))
+            if resource:
+                # ru_maxrss is in kilobytes on Linux
+                f.write(
+                    "Peak RSS: {} kB\n".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+                )
+            f.write("\nBiggest allocations:\n")
+            for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                f.write("{}\n".format(stat))
+            if self.previous is not None:
+                f.write("\nChanges since the last report:\n")
+                write_changes(f, self.previous, snapshot)
+
+        logging.info(
+            "Profiling report written to %s-*: %s samples over %.0fs, %s bytes traced.",
+            prefix,
+            self.samples,
+            seconds,
+            current,
+        )
+        self.previous = snapshot
+        self.stacks.clear()
+        self.samples = 0
+        self.started = time.time()
+
+
+def write_changes(f, old, new, top=TOP_ALLOCATIONS):
+    """Write how allocations changed between two tracemalloc snapshots, biggest changes first.
+
+    Args:
+        f (file): Where to write
+        old (tracemalloc.Snapshot): The earlier snapshot
+        new (tracemalloc.Snapshot): The later snapshot
+        top (Optional[int]): How many lines to write
+    """
+    for stat in new.compare_to(old, "lineno")[:top]:
+        f.write("{}\n".format(stat))
+
+
+def main(args):
+    """
+    Compare two memory snapshots written by the profiler.
+
+    Args:
+        args (ArgumentParser args): Parsed arguments naming the snapshots
+    """
+    old = tracemalloc.Snapshot.load(args.old)
+    new = tracemalloc.Snapshot.load(args.new)
+    write_changes(sys.stdout, old, new, args.top)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Compare two memory snapshots written by service.py's profiler."
+    )
+    parser.add_argument("old", help="the earlier *-memory.snapshot")
+    parser.add_argument("new", help="the later *-memory.snapshot")
+    parser.add_argument(
+        "--top", type=int, default=TOP_ALLOCATIONS, help="how many of the biggest changes to show"
+    )
+    main(parser.parse_args())
@@ -0,0 +1,201 @@
+"""
+Bagelbot rotation - plans weeks of groups for the whole roster up front, so nobody repeats within
+the rotation and each meeting is a lookup plus a small repair around whoever is out.
+"""
+import logging
+import random
+
+from config import ROTATION_WEEKS
+from history import recent_conflicts
+from pairing import build_conflicts, join_groups, partition
+
+ROTATION = "rotation"
+
+
+def round_robin(names, weeks):
+    """Plan 1 on 1s with the circle method, where everyone meets everyone else exactly once.
+
+    Args:
+        names (list): An even number of people
+        weeks (int): The most weeks to plan, there are never more than `len(names) - 1`
+
+    Returns:
+        list: The weeks, each a list of frozensets
+    """
+    fixed, rest = names[0], list(names[1:])
+    schedule = []
+    for _ in range(min(weeks, len(rest))):
+        line = [fixed] + rest
+        schedule.append([frozenset((line[i], line[-1 - i])) for i in range(len(line) // 2)])
+        rest = rest[-1:] + rest[:-1]
+    return schedule
+
+
+def plan_rotation(names, size, weeks=ROTATION_WEEKS, rng=None, conflicts=None):
+    """Plan up to `weeks` weeks of groups where nobody is grouped with the same person twice.
+
+    Pairs for an even number of people are a round robin. Anything else is planned a week at a
+    time, each week avoiding `conflicts` and everyone's groups from the weeks before, until no
+    such week exists. When `conflicts` rule out some of the round robin's weeks, both are planned
+    and the longer one wins.
+
+    Args:
+        names (list): Everyone in the rotation
+        size (int): Pair size
+        weeks (Optional[int]): The most weeks to plan, defaults to ROTATION_WEEKS
+        rng (Optional[random.Random]): Source of randomness, defaults to the `random` module
+        conflicts (Optional[dict]): Maps a name to the names they must not be grouped with in any
+            week, e.g. who they met recently
+
+    Returns:
+        list: The weeks, each a list of frozensets
+    """
+    rng = rng or random
+    names = list(names)
+    rng.shuffle(names)
+    conflicts = {person: set(met) for person, met in (conflicts or {}).items()}
+    robin = []
+    if size == 2 and len(names) % 2 == 0:
+        # Every pair is in one of the round robin's weeks, so any that met recently cost a week
+        full = round_robin(names, len(names) - 1 if conflicts else weeks)
+        robin = [
+            groups
+            for groups in full
+            if not any(conflicts.get(a, set()) & group for group in groups for a in group)
+        ][:weeks]
+        if len(robin) == min(weeks, len(full)):
+            return robin
+
+    schedule = []
+    while len(schedule) < weeks:
+        groups = partition(names, size, conflicts, rng=rng)
+        if not groups:
+            break
+        schedule.append(groups)
+        for person, met in build_conflicts(groups).items():
+            conflicts.setdefault(person, set()).update(met)
+    return max(robin, schedule, key=len)
+
+
+def repair_week(groups, names, size, conflicts=None, rng=None):
+    """Fit a planned week to the people who are actually here.
+
+    Planned groups that still have at least `size` people, and nobody in them with a conflict, are
+    kept as they are. Everyone else is regrouped among themselves, or if that can't be done, each
+    joins the smallest kept group they have no conflicts in, up to one more than `size`.
+
+    Args:
+        groups (list): The planned week
+        names (list): People to group today
+        size (int): Pair size
+        conflicts (Optional[dict]): Maps a name to the names they must not be grouped with
+        rng (Optional[random.Random]): Source of randomness, defaults to the `random` module
+
+    Returns:
+        list: A list of frozensets, or None if the week couldn't be repaired without a conflict
+    """
+    conflicts = conflicts or {}
+    here = set(names)
+    kept = []
+    loose = []
+    for group in groups:
+        group = group & here
+        if len(group) >= size and not any(conflicts.get(person, set()) & group for person in group):
+            kept.append(group)
+        else:
+            loose.extend(group)
+    planned = set().union(*groups) if groups else set()
+    loose.extend(name for name in names if name not in planned)
+    if not loose:
+        return kept
+
+    if len(loose) >= size:
+        regrouped = partition(loose, size, conflicts, rng=rng)
+        if regrouped is not None:
+            return kept + regrouped
+
+    return join_groups(kept, loose, size, conflicts)
+
+
+def planned_groups(store, names, size, weeks=ROTATION_WEEKS, window=0):
+    """Look up this week's groups in the store's rotation and repair them around who is here.
+
+    Nobody is grouped with someone they met in the meetings the rotation was planned around, or
+    since it started: planned groups that would repeat one are repaired. If the next week can't be
+    repaired, the first of the later weeks that can is moved up to take its place. A new rotation
+    is planned for `store["everyone"]` when there isn't one yet, when the roster or `size` has
+    changed since it was planned, or when none of its weeks are left to fit today. It's planned
+    around the last `window` meetings, but no more than `weeks` of them, so a small roster that has
+    already met everyone still gets a new rotation. If none of its weeks fit today, it's planned
+    around half as many meetings, and so on down to none.
+
+    Args:
+        store (instance): A persistent, dictionary-like object used to keep information about past/future meetings
+        names (list): People to group today
+        size (int): Pair size
+        weeks (Optional[int]): How many weeks a new rotation plans, defaults to ROTATION_WEEKS
+        window (Optional[int]): How many of the most recent meetings a new rotation avoids repeating
+            a group from
+
+    Returns:
+        list: A list of frozensets, or None if not even a new rotation fits today
+    """
+    roster = sorted(store["everyone"])
+    total = store["history"].total
+    rotation = store.get(ROTATION)
+    if rotation and rotation["roster"] == roster and rotation["size"] == size:
+        groups = _fit_week(store, rotation, names, size, total)
+        if groups is not None:
+            return groups
+        logging.info("No week left in the rotation fits who's here today.")
+
+    window = min(window, weeks)
+    while True:
+        logging.info(
+            "Planning a new rotation for %s people around the last %s meetings.",
+            len(roster),
+            window,
+        )
+        rotation = {
+            "roster": roster,
+            "size": size,
+            "weeks": plan_rotation(
+                roster, size, weeks, conflicts=recent_conflicts(store, roster, window)
+            ),
+            "start": total,
+            "window": window,
+            "next": 0,
+        }
+        logging.info("Planned %s weeks without repeats.", len(rotation["weeks"]))
+        groups = _fit_week(store, rotation, names, size, total)
+        if groups is not None or not window:
+            break
+        window //= 2
+    store[ROTATION] = rotation
+    return groups
+
+
+def _fit_week(store, rotation, names, size, total):
+    # Avoid the meetings the rotation was planned around, and every one since it started
+    window = rotation.get("window", 0) + total - rotation["start"]
+    conflicts = recent_conflicts(store, names, window)
+    weeks = rotation["weeks"]
+    for i in range(rotation["next"], len(weeks)):
+        groups = repair_week(weeks[i], names, size, conflicts)
+        if groups is not None:
+            if i != rotation["next"]:
+                weeks[i], weeks[rotation["next"]] = weeks[rotation["next"]], weeks[i]
+                store[ROTATION] = rotation
+            return groups
+    return None
+
+
+def advance_rotation(store):
+    """Move the store's rotation on to its next week, once this week's meeting is recorded.
+
+    Args:
+        store (instance): A persistent, dictionary-like object used to keep information about past/future meetings
+    """
+    rotation = store.get(ROTATION)
+    if rotation:
+        store[ROTATION] = dict(rotation, next=rotation["next"] + 1)
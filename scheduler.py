@@ -0,0 +1,147 @@
+"""
+Bagelbot scheduler - works out when each of the service's jobs is next due, so the service can
+sleep until exactly then.
+"""
+import logging
+from collections import namedtuple
+from datetime import datetime, time, timedelta
+
+from config import (
+    ATTENDANCE_TIME,
+    ATTENDANCE_TIME_ALT,
+    FREQUENCY,
+    MEETING_TIME,
+    MEETING_TIME_ALT,
+    SCHEDULE_GRACE,
+    SCHEDULES,
+)
+
+Job = namedtuple("Job", ["job", "weekday", "hour", "minute"])
+SCHEDULER_STATE = "scheduler"
+
+
+def load_schedules(schedules=None):
+    """Get the configured schedules as `Job`s.
+
+    Note:
+        If SCHEDULES isn't set in config.py, the ATTENDANCE_TIME(_ALT) and MEETING_TIME(_ALT)
+        settings are used instead.
+
+    Args:
+        schedules (Optional[list]): Dicts with `job`, `weekday`, `hour` and `minute` keys, defaults to SCHEDULES
+
+    Returns:
+        list: The unique `Job`s, in the order they were configured
+    """
+    if schedules is None:
+        schedules = SCHEDULES
+    if schedules is None:
+        schedules = [
+            dict(ATTENDANCE_TIME, job="attendance"),
+            dict(ATTENDANCE_TIME_ALT, job="attendance"),
+            dict(MEETING_TIME, job="meeting"),
+            dict(MEETING_TIME_ALT, job="meeting"),
+        ]
+    jobs = []
+    for schedule in schedules:
+        job = Job(**schedule)
+        if job not in jobs:
+            jobs.append(job)
+    return jobs
+
+
+def next_fire_time(job, after, tz, last_meeting=None, frequency=FREQUENCY):
+    """Work out the first time after `after` that a job should run.
+
+    Args:
+        job (Job): The job's schedule
+        after (datetime): A timezone aware datetime, the job runs strictly after this
+        tz (tzinfo): A pytz timezone the schedule is in
+        last_meeting (Optional[date]): Date of the last meeting, the job won't run until FREQUENCY after it
+        frequency (Optional[timedelta]): Minimum time between meetings, defaults to FREQUENCY
+
+    Returns:
+        datetime: When the job is next due, in `tz`
+    """
+    day = after.astimezone(tz).date()
+    if last_meeting is not None:
+        day = max(day, last_meeting + frequency)
+    day += timedelta(days=(job.weekday - day.weekday()) % 7)
+    while True:
+        when = tz.localize(datetime.combine(day, time(job.hour, job.minute)))
+        if when > after:
+            return when
+        day += timedelta(days=7)
+
+
+class Scheduler:
+    """Keeps track of which scheduled runs have been handled, and which one is due next.
+
+    Runs that were missed - because a previous job ran long, or the service was down - are
+    still due, as long as they're no older than `grace`. A run that came due while a previous
+    job was still running only counts as late from when that job finished, so e.g. a meeting
+    scheduled right after an ATTENDANCE_TIME_LIMIT long attendance check isn't dropped.
+
+    Args:
+        jobs (list): `Job`s to schedule
+        tz (tzinfo): A pytz timezone the schedules are in
+        last_checked (datetime): Runs up to this time have already been handled
+        grace (Optional[timedelta]): How late a missed run can still be caught up, defaults to SCHEDULE_GRACE
+    """
+
+    def __init__(self, jobs, tz, last_checked, grace=SCHEDULE_GRACE):
+        self.jobs = jobs
+        self.tz = tz
+        self.last_checked = last_checked
+        self.grace = grace
+        self.last_finished = None
+
+    def next_due(self, last_meeting=None):
+        """Find the next scheduled run that hasn't been handled yet.
+
+        Args:
+            last_meeting (Optional[date]): Date of the last meeting
+
+        Returns:
+            tuple: (datetime the run is due, `Job`), earliest first with ties in configured order
+        """
+        return min(
+            (
+                (next_fire_time(job, self.last_checked, self.tz, last_meeting), i, job)
+                for i, job in enumerate(self.jobs)
+            ),
+            key=lambda due: due[:2],
+        )[::2]
+
+    def handled(self, when, finished=None):
+        """Mark every run up to `when` as handled.
+
+        Args:
+            when (datetime): The time of the run that was just handled (or skipped)
+            finished (Optional[datetime]): When its job finished running
+        """
+        self.last_checked = max(self.last_checked, when)
+        if finished is not None:
+            self.last_finished = finished
+
+    def is_stale(self, when, now):
+        """Check if a missed run is too old to catch up on.
+
+        Note:
+            A run that was due while the previous job was still running is measured from when
+            that job finished rather than from when the run was due.
+
+        Args:
+            when (datetime): When the run was due
+            now (datetime): The current time
+
+        Returns:
+            bool: True if it should be skipped
+        """
+        late_since = when
+        if self.last_finished is not None and self.last_finished > when:
+            late_since = self.last_finished
+        if now - late_since > self.grace:
+            logging.warning("Skipping the run due at %s, it's more than %s late.", when, self.grace)
+            return True
+        return False
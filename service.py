@@ -1,116 +1,240 @@
 #!/usr/bin/env python
 """
-Bagelbot script that is designed to run constantly and check to see if role call should be ran and then if a meeting should be generated.
+Bagelbot script that is designed to run constantly and sleep until role call should be ran or a meeting should be generated.
 """
 import logging
 import sys
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 
 from pytz import timezone
 
-from config import ATTENDANCE_TIME, ATTENDANCE_TIME_ALT, FREQUENCY, MEETING_TIME, MEETING_TIME_ALT, S3_BUCKET, TIMEZONE
-from check_attendance import check_attendance
+import metrics
+from channels import load_channels
+from config import (
+    METRICS_PORT,
+    S3_BUCKET,
+    SLACK_RECORD_FILE,
+    SLACK_REPLAY_FILE,
+    TIMEZONE,
+)
+from check_attendance import attendance_in_progress, check_attendance
 from generate_meeting import create_meetings
+from profiling import Profiler
+from scheduler import SCHEDULER_STATE, Scheduler
+from slack_events import EventHub, serve_events_in_background
+from uploader import Uploader
 from utils import (
-    initialize,
-    download_shelve_from_s3,
+    download_store_from_s3,
+    get_slack_client,
+    open_store,
+    sync_store,
     update_everyone_from_slack,
-    upload_shelve_to_s3,
 )
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(message)s")
 DATE_FMT = "%Y-%m-%d"
+DATETIME_FMT = "%Y-%m-%d %H:%M %Z"
 
 
-def main():
+def last_meeting_date(store):
+    """Get the date of the last meeting in the store's history.
+
+    Args:
+        store (instance): A persistent, dictionary-like object used to keep information about past/future meetings
+
+    Returns:
+        date: The date of the last meeting, or None if there hasn't been one
     """
-    Initialize the shelf, possibly sync to s3, then check attendance, close
-    the shelf and maybe sync the shelf again.
+    history = store["history"]
+    return history[-1]["date"] if len(history) else None
+
+
+def run_attendance(runner):
+    """Check attendance for a channel's upcoming meeting."""
+    logging.info("Gonna check that attendance in %s!", runner.channel.channel)
+    update_everyone_from_slack(runner.store, runner.sc, runner.channel.channel_id)
+    check_attendance(
+        runner.store,
+        runner.sc,
+        hub=runner.hub,
+        # Every attendance check needs its own RTM connection, even when channels share a token
+        rtm=None if runner.hub else get_slack_client(runner.channel.token),
+        time_limit=runner.channel.attendance_time_limit,
+    )
+
+
+def run_meeting(runner):
+    """Generate today's meeting for a channel."""
+    logging.info("Let's try to generate a meeting in %s!", runner.channel.channel)
+    update_everyone_from_slack(runner.store, runner.sc, runner.channel.channel_id)
+    options = dict(
+        size=runner.channel.pairing_size, force_create=True, channel=runner.channel.channel
+    )
+    if not create_meetings(runner.store, runner.sc, **options):
+        logging.warning("Falling back to pairing anyone, regardless of past meetings.")
+        create_meetings(runner.store, runner.sc, any_pair=True, **options)
+
+
+JOBS = {"attendance": run_attendance, "meeting": run_meeting}
+
+
+class ChannelRunner:
+    """Runs one channel's scheduled jobs against its own store.
 
     Args:
-        args (ArgumentParser args): Parsed arguments that impact how the check_attandance runs
+        channel (Channel): The channel's settings
+        sc (SlackClient): Client for the channel's workspace, shared by every channel with the same token
+        tz (tzinfo): A pytz timezone the schedules are in
+        hub (Optional[EventHub]): Shared Events API event source for attendance checks
+        uploader (Optional[Uploader]): Uploads the store to S3 in the background after each job
+    """
+
+    def __init__(self, channel, sc, tz, hub=None, uploader=None):
+        self.channel = channel
+        self.sc = sc
+        self.tz = tz
+        self.hub = hub
+        self.uploader = uploader
+        if S3_BUCKET:
+            download_store_from_s3(channel.store_file)
+        self.store = open_store(channel.store_file)
+        self.scheduler = Scheduler(
+            channel.jobs,
+            tz,
+            self.store.get(SCHEDULER_STATE, {}).get("last_checked", datetime.now(tz)),
+        )
+
+    def next_due(self):
+        """Find this channel's next scheduled run.
+
+        Returns:
+            tuple: (datetime the run is due, `Job`)
+        """
+        return self.scheduler.next_due(last_meeting_date(self.store))
+
+    def run(self, job, when):
+        """Run a scheduled job (unless it's too late to), then save the store and queue its upload.
+
+        Args:
+            job (Job): The job to run
+            when (datetime): When it was due
+        """
+        try:
+            # An attendance check that was cut short by a restart is resumed however late it is
+            resuming = job.job == "attendance" and attendance_in_progress(self.store)
+            if resuming or not self.scheduler.is_stale(when, datetime.now(self.tz)):
+                with metrics.timer("job_seconds", job=job.job, channel=self.channel.name):
+                    JOBS[job.job](self)
+                metrics.set_gauge(
+                    "job_last_run_timestamp_seconds",
+                    time.time(),
+                    job=job.job,
+                    channel=self.channel.name,
+                )
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("The %s job for %s failed.", job.job, self.channel.name)
+        finally:
+            self.scheduler.handled(when, finished=datetime.now(self.tz))
+            self.store[SCHEDULER_STATE] = {"last_checked": self.scheduler.last_checked}
+
+            logging.info("Syncing %s to local storage.", self.channel.store_file)
+            sync_store(self.store)
+            if self.uploader:
+                self.uploader.request(self.channel.store_file)
+
+
+def main():
     """
-    if S3_BUCKET:
-        download_shelve_from_s3()
+    Open every channel's store, possibly syncing it from s3, then sleep until the next scheduled
+    job for any channel is due and run it on that channel's own thread, so one channel's long
+    attendance window doesn't hold up the others. Stores are uploaded to s3 in the background,
+    and whatever hasn't been uploaded yet is on the way out. Send SIGUSR1 (or create
+    PROFILE_CONTROL_FILE) to profile the service, see profiling.py. Slack traffic can be recorded
+    and replayed with SLACK_RECORD_FILE and SLACK_REPLAY_FILE, see slack_replay.py.
+    """
+    if METRICS_PORT:
+        metrics.REGISTRY.serve(METRICS_PORT)
+    Profiler().install()
 
     tz = timezone(TIMEZONE)
-    store, sc = initialize(update_everyone=True)
+    channels = load_channels()
+    # One Events API endpoint serves every channel with a signing secret, whatever its workspace
+    secrets = sorted({channel.signing_secret for channel in channels if channel.signing_secret})
+    hub = None
+    if secrets and SLACK_RECORD_FILE:
+        from slack_replay import RecordingHub, get_recorder
+
+        hub = RecordingHub(get_recorder(SLACK_RECORD_FILE))
+    elif secrets:
+        hub = EventHub()
+    if hub and not SLACK_REPLAY_FILE:
+        serve_events_in_background(hub, signing_secret=secrets)
 
+    uploader = Uploader() if S3_BUCKET else None
+    clients = {}
+    runners = []
+    for channel in channels:
+        if channel.token not in clients:
+            clients[channel.token] = get_slack_client(channel.token)
+            if hub and SLACK_REPLAY_FILE:
+                # Recorded events come from the recording instead of the Events API
+                clients[channel.token].feed(hub)
+        # Channels without a signing secret read attendance replies over RTM instead
+        events = hub if channel.signing_secret else None
+        runner = ChannelRunner(channel, clients[channel.token], tz, events, uploader)
+        update_everyone_from_slack(runner.store, runner.sc, channel.channel_id)
+        runners.append(runner)
+
+    executor = ThreadPoolExecutor(max_workers=len(runners), thread_name_prefix="job")
+    running = {}
     try:
         while True:
-            # Get current time, and date of our last meeting
-            now = datetime.now(tz)
-            logging.info("It's now %s,", now.strftime(DATE_FMT))
-            last_meeting = store["history"][-1]
-            logging.info("and the last meeting was on %s.", last_meeting["date"].strftime(DATE_FMT))
-
-            # Determine if it's time to check attendance
-            attendance_time = all(
-                [
-                    (now.date() - last_meeting["date"]) >= FREQUENCY,
-                    now.hour == ATTENDANCE_TIME["hour"],
-                    now.minute == ATTENDANCE_TIME["minute"],
-                    now.weekday() == ATTENDANCE_TIME["weekday"],
-                ]
-            ) or all(
-                [
-                    (now.date() - last_meeting["date"]) >= FREQUENCY,
-                    now.hour == ATTENDANCE_TIME_ALT["hour"],
-                    now.minute == ATTENDANCE_TIME_ALT["minute"],
-                    now.weekday() == ATTENDANCE_TIME_ALT["weekday"],
-                ]
-            )
-            logging.info("Is it attendance checking time? %s", attendance_time)
-
-            # Determine if it's time for a new meeting
-            meeting_time = all(
-                [
-                    (now.date() - last_meeting["date"]) >= FREQUENCY,
-                    now.hour == MEETING_TIME["hour"],
-                    now.minute == MEETING_TIME["minute"],
-                    now.weekday() == MEETING_TIME["weekday"],
-                ]
-            ) or all(
-                [
-                    (now.date() - last_meeting["date"]) >= FREQUENCY,
-                    now.hour == MEETING_TIME_ALT["hour"],
-                    now.minute == MEETING_TIME_ALT["minute"],
-                    now.weekday() == MEETING_TIME_ALT["weekday"],
-                ]
+            idle = [runner for runner in runners if runner not in running.values()]
+            due = min(
+                (runner.next_due() + (runner,) for runner in idle), key=lambda d: d[0], default=None
             )
-            logging.info("Is it meeting generating time? %s", meeting_time)
-
-            sync = False
-            if attendance_time:
-                logging.info("Gonna check that attendance!")
-                update_everyone_from_slack(store, sc)
-                check_attendance(store, sc)
-                sync = True
-            elif meeting_time:
-                logging.info("Let's try to generate a meeting!")
-                update_everyone_from_slack(store, sc)
-                max_attempts, attempt = 100, 1
-                success = False
-                while not success:
-                    success = create_meetings(
-                        store, sc, force_create=True, any_pair=attempt > max_attempts
+            wait_seconds = None
+            if due:
+                when, job, runner = due
+                wait_seconds = (when - datetime.now(tz)).total_seconds()
+                if wait_seconds > 0:
+                    logging.info(
+                        "Next up is %s for %s at %s, sleeping until then.",
+                        job.job,
+                        runner.channel.name,
+                        when.strftime(DATETIME_FMT),
                     )
-                    attempt += 1
-                sync = True
-
-            if sync:
-                logging.info("Syncing to local storage.")
-                store.sync()
-                if S3_BUCKET:
-                    logging.info("Uploading to s3.")
-                    upload_shelve_to_s3()
-
-            # Go to sleep for a minute and check again
-            logging.info("Going to sleep for a minute.")
-            time.sleep(60)
+                    metrics.set_gauge("scheduler_sleep_seconds", wait_seconds)
+
+            if due is None or wait_seconds > 0:
+                metrics.export("service")
+                if running:
+                    done, _ = wait(running, timeout=wait_seconds, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        running.pop(future)
+                    if done:
+                        metrics.export("service")
+                        continue
+                else:
+                    time.sleep(wait_seconds)
+
+            last_meeting = last_meeting_date(runner.store)
+            logging.info(
+                "Running %s for %s, whose last meeting was on %s.",
+                job.job,
+                runner.channel.name,
+                last_meeting.strftime(DATE_FMT) if last_meeting else "never",
+            )
+            running[executor.submit(runner.run, job, when)] = runner
     finally:
-        store.close()
+        executor.shutdown()
+        for runner in runners:
+            runner.store.close()
+        if uploader:
+            uploader.close()
+            metrics.export("service")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,237 @@
+"""
+Bagelbot sharded pairing - splits a big roster into shards by a Slack user attribute (like their
+timezone or title), pairs the shards in parallel and then pairs whoever is left over across them.
+"""
+import logging
+import math
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+from config import PAIRING_SHARD_SIZE
+from pairing import MAX_SEARCH_STEPS, join_groups, partition, quiet_worker
+from utils import DIRECTORY
+
+
+def member_attributes(store, attribute):
+    """Look up everyone's `attribute` in the store's cached Slack directory.
+
+    Args:
+        store (instance): A persistent, dictionary-like object used to keep information about past/future meetings
+        attribute (str): A field cached by `update_everyone_from_slack`, e.g. 'tz_offset'
+
+    Returns:
+        dict: Maps each name to their attribute, or None if it isn't known
+    """
+    return {
+        entry["name"]: entry.get("attributes", {}).get(attribute)
+        for entry in store.get(DIRECTORY, {}).values()
+    }
+
+
+def _order(value):
+    # Numbers (like tz_offset) sort numerically, so neighbouring shards are neighbouring bands
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (0, value, "")
+    return (1 if value is not None else 2, 0, str(value))
+
+
+def shard_names(names, attributes, shard_size=PAIRING_SHARD_SIZE, across=False, rng=None):
+    """Split people into shards of at most `shard_size` people.
+
+    Everyone in a shard has the same attribute, and values with more than `shard_size` people are
+    split evenly between as many shards as it takes. With `across`, people are dealt out in order
+    of their attribute instead, so every shard gets an even share of each value.
+
+    Args:
+        names (list): People to split into shards
+        attributes (dict): Maps a name to their attribute, missing names are treated as None
+        shard_size (Optional[int]): The most people in a shard, defaults to PAIRING_SHARD_SIZE
+        across (Optional[bool]): Mix every attribute in each shard
+        rng (Optional[random.Random]): Source of randomness, defaults to the `random` module
+
+    Returns:
+        list: The shards, each a list of names
+    """
+    rng = rng or random
+    by_value = {}
+    for name in names:
+        by_value.setdefault(attributes.get(name), []).append(name)
+    values = sorted(by_value, key=_order)
+    for value in values:
+        rng.shuffle(by_value[value])
+
+    if across:
+        everyone = [name for value in values for name in by_value[value]]
+        count = math.ceil(len(everyone) / shard_size)
+        return [everyone[i::count] for i in range(count)]
+
+    shards = []
+    for value in values:
+        people = by_value[value]
+        count = math.ceil(len(people) / shard_size)
+        shards.extend(people[i::count] for i in range(count))
+    return shards
+
+
+def conflicts_among(people, among, conflicts, attributes=None):
+    """Narrow `conflicts` down to `people`, and who they could be grouped with from `among`.
+
+    Args:
+        people (iterable): People to look up
+        among (iterable): Who they could be grouped with
+        conflicts (dict): Maps a name to the names they must not be grouped with
+        attributes (Optional[dict]): If given, people with the same (known) attribute conflict too
+
+    Returns:
+        dict: Maps each of `people` who has a conflict in `among` to those conflicts
+    """
+    among = set(among)
+    teams = {}
+    if attributes is not None:
+        for name in among:
+            if attributes.get(name) is not None:
+                teams.setdefault(attributes[name], set()).add(name)
+
+    narrowed = {}
+    for person in people:
+        blocked = conflicts.get(person, set()) & among
+        if attributes is not None and attributes.get(person) is not None:
+            blocked = blocked | (teams.get(attributes[person], set()) - {person})
+        if blocked:
+            narrowed[person] = blocked
+    return narrowed
+
+
+def _pair_shard(names, size, conflicts, seed, max_steps):
+    # Pair as many people as make whole groups of `size`, setting aside the rest (or everyone, if
+    # the shard can't be paired at all)
+    rng = random.Random(seed)
+    names = list(names)
+    rng.shuffle(names)
+    whole = len(names) - len(names) % size
+    groups = partition(names[:whole], size, conflicts, rng=rng, max_steps=max_steps)
+    if groups is None:
+        return [], names
+    return groups, names[whole:]
+
+
+def _neighbour_groups(people, size, conflicts):
+    # Group people in the order given, each with the nearest people after them they haven't met,
+    # or None if somebody is left without a whole group
+    waiting = list(people)
+    groups = []
+    while waiting:
+        group = [waiting.pop(0)]
+        for other in list(waiting):
+            if len(group) == size:
+                break
+            if not any(
+                other in conflicts.get(m, ()) or m in conflicts.get(other, ()) for m in group
+            ):
+                group.append(other)
+                waiting.remove(other)
+        if len(group) < size:
+            return None
+        groups.append(frozenset(group))
+    return groups
+
+
+def sharded_partition(
+    names,
+    size,
+    attributes,
+    conflicts=None,
+    shard_size=PAIRING_SHARD_SIZE,
+    across=False,
+    workers=None,
+    rng=None,
+    max_steps=MAX_SEARCH_STEPS,
+    stats=None,
+):
+    """Split `names` into groups shard by shard, pairing the shards in parallel processes.
+
+    Each shard (see `shard_names`) is split into groups of exactly `size`, with whoever doesn't
+    fit set aside. Everyone set aside, and everyone in a shard that couldn't be paired, is then
+    split into groups of `size` across shards, and the last few each join a different group, the
+    same way `group_sizes` hands out leftovers. Unless `across` is set, leftovers are grouped with
+    the people left over in the nearest shards first, and the last few join the nearest groups,
+    so they meet people from the next band over rather than anyone. If the leftovers can't be
+    placed, everyone is paired in one pool with `partition`, so no grouping is only returned when
+    none exists.
+
+    Args:
+        names (list): People to split into groups
+        size (int): Pair size
+        attributes (dict): Maps a name to the attribute they're sharded by
+        conflicts (Optional[dict]): Maps a name to the names they must not be grouped with
+        shard_size (Optional[int]): The most people in a shard, defaults to PAIRING_SHARD_SIZE
+        across (Optional[bool]): Mix every attribute in each shard, and keep people with the same
+            one out of each other's groups (until everyone is paired in one pool)
+        workers (Optional[int]): Processes to pair shards in, defaults to one per core
+        rng (Optional[random.Random]): Source of randomness, defaults to the `random` module
+        max_steps (Optional[int]): Give up on a shard after trying this many groups
+        stats (Optional[dict]): If given, the number of `shards` and `leftovers` are recorded, as
+            is `partition`'s if the whole roster had to be paired in one pool
+
+    Returns:
+        list: A list of frozensets (one per group), or None if no valid grouping was found
+    """
+    rng = rng or random
+    conflicts = conflicts or {}
+    teams = attributes if across else None
+    shards = shard_names(names, attributes, shard_size, across, rng)
+    searches = [
+        (
+            shard,
+            size,
+            conflicts_among(shard, shard, conflicts, teams),
+            rng.getrandbits(64),
+            max_steps,
+        )
+        for shard in shards
+    ]
+    workers = min(workers or os.cpu_count() or 1, len(searches))
+    if workers <= 1:
+        logging.disable(logging.INFO)
+        try:
+            results = [_pair_shard(*search) for search in searches]
+        finally:
+            logging.disable(logging.NOTSET)
+    else:
+        with ProcessPoolExecutor(workers, initializer=quiet_worker) as pool:
+            results = list(pool.map(_pair_shard, *zip(*searches)))
+
+    groups = [group for shard_groups, _ in results for group in shard_groups]
+    leftovers = [name for _, left in results for name in left]
+    if stats is not None:
+        stats["shards"] = len(shards)
+        stats["leftovers"] = len(leftovers)
+    logging.info(
+        "Paired %s shards, leaving %s people to pair across them.", len(shards), len(leftovers)
+    )
+
+    # Shards (and so their leftovers and groups) are in order of their attribute, see `_order`
+    if across:
+        rng.shuffle(leftovers)
+    whole = len(leftovers) - len(leftovers) % size
+    if whole:
+        leftover_conflicts = conflicts_among(leftovers, leftovers, conflicts, teams)
+        regrouped = None
+        if not across:
+            regrouped = _neighbour_groups(leftovers[:whole], size, leftover_conflicts)
+        if regrouped is None:
+            regrouped = partition(leftovers[:whole], size, leftover_conflicts, rng=rng)
+        groups = None if regrouped is None else groups + regrouped
+    if groups is not None:
+        rest = leftovers[whole:]
+        # The last few are from the last shards, so they try the groups from there first
+        groups = join_groups(
+            groups[::-1], rest, size, conflicts_among(rest, names, conflicts, teams)
+        )
+    if groups is not None:
+        rng.shuffle(groups)
+        return groups
+
+    logging.info("Couldn't place everyone left over, pairing the whole roster in one pool.")
+    return partition(names, size, conflicts, rng=rng, max_steps=max_steps, stats=stats)
@@ -0,0 +1,231 @@
+"""
+Bagelbot's Slack Web API client - pooled keep-alive connections, retries with backoff, response
+checking and pagination on top of SlackClient.
+"""
+import logging
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from slackclient import SlackClient
+from urllib3.exceptions import NewConnectionError
+
+import metrics
+from config import OUTBOX_WORKERS
+from outbox import URGENT_WORKERS
+
+PAGE_SIZE = 200
+SLACK_API_URL = "https://slack.com/api/"
+API_TIMEOUT = 30
+MAX_RETRIES = 5
+MAX_BACKOFF = 30
+# Methods that are safe to call again if we can't tell whether Slack got the first call
+IDEMPOTENT_METHODS = ("conversations.", "users.", "auth.test", "rtm.connect")
+
+
+class SlackAPIError(Exception):
+    """A Slack API call didn't return ok.
+
+    Args:
+        method (str): The Slack API method that was called
+        response (dict): The API response
+    """
+
+    def __init__(self, method, response):
+        super().__init__("{} failed: {}".format(method, response.get("error")))
+        self.method = method
+        self.response = response
+
+
+class SlackAPI(SlackClient):
+    """A SlackClient whose Web API calls reuse pooled keep-alive connections and are retried.
+
+    Calls that Slack rate limits are retried after the `Retry-After` it asks for (unless the caller
+    paces its own calls, see `request`), and calls that hit a server or connection error are retried
+    with a jittered exponential backoff, up to `retries` times. Only IDEMPOTENT_METHODS are retried
+    after a timeout or server error, when Slack may have already acted on the call - anything else
+    (like posting a message) is only retried if it never reached Slack. Every attempt is timed in the
+    metrics. RTM connects with 'rtm.connect' through the same Web API, and is read with SlackClient's
+    own `rtm_read`.
+
+    Args:
+        token (str): The Slack API token
+        retries (Optional[int]): How many times to retry a call before giving up
+        url (Optional[str]): Where the Web API is, defaults to SLACK_API_URL
+    """
+
+    def __init__(self, token, retries=MAX_RETRIES, url=SLACK_API_URL):
+        super().__init__(token)
+        self.retries = retries
+        self.url = url
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = "Bearer " + token
+        # A connection for each of the outbox's workers
+        self.session.mount(url, HTTPAdapter(pool_maxsize=OUTBOX_WORKERS + URGENT_WORKERS))
+
+    def api_call(self, method, **kwargs):
+        """Call a Slack Web API method.
+
+        Args:
+            method (str): The Slack API method, e.g. 'chat.postMessage'
+            **kwargs: Arguments for the API method
+
+        Returns:
+            dict: The API response - check `ok`. If the call still failed after every retry, `error` is
+            'ratelimited' (with the last `Retry-After` in `headers`) or describes the HTTP error.
+        """
+        return self.request(method, kwargs)
+
+    def rtm_connect(self):
+        """Connect to the RTM API over a websocket.
+
+        Returns:
+            bool: True if it connected
+        """
+        response = self.api_call("rtm.connect")
+        if not response.get("ok"):
+            logging.warning("rtm.connect failed: %s", response.get("error"))
+            return False
+        try:
+            self.server.connect_slack_websocket(response["url"])
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Couldn't connect to the RTM websocket at %s.", response["url"])
+            return False
+        return True
+
+    def rtm_read(self):
+        """Read whatever RTM events have arrived since the last read, without blocking.
+
+        Returns:
+            list: The events
+        """
+        try:
+            return super().rtm_read()
+        except BlockingIOError:
+            # What an unencrypted ws:// connection (like fake_slack's) raises when there's nothing
+            # to read, rather than the SSLError SlackClient expects
+            return []
+
+    def request(self, method, data, wait_ratelimited=True):
+        """Call a Slack Web API method, choosing whether rate limited calls are retried here.
+
+        Args:
+            method (str): The Slack API method, e.g. 'chat.postMessage'
+            data (dict): Arguments for the API method
+            wait_ratelimited (Optional[bool]): Retry a rate limited call after its `Retry-After`.
+                Callers that pace their own calls (like the outbox) turn this off, so a rate
+                limited response comes straight back for them to hold off every call like it.
+
+        Returns:
+            dict: The API response, as from `api_call`
+        """
+        idempotent = method.startswith(IDEMPOTENT_METHODS)
+        for attempt in range(self.retries + 1):
+            headers = {}
+            try:
+                with metrics.timer("slack_api_seconds", method=method):
+                    http = self.session.post(self.url + method, data=data, timeout=API_TIMEOUT)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response = {"ok": False, "error": "connection_error", "detail": str(e)}
+                if not idempotent and not never_sent(e):
+                    break
+            else:
+                if http.status_code == 429:
+                    headers = {"Retry-After": http.headers.get("Retry-After", 1)}
+                    response = {"ok": False, "error": "ratelimited", "headers": headers}
+                    if not wait_ratelimited:
+                        break
+                elif http.status_code >= 500:
+                    response = {"ok": False, "error": "http_{}".format(http.status_code)}
+                    if not idempotent:
+                        break
+                else:
+                    try:
+                        response = http.json()
+                    except ValueError:
+                        # e.g. an HTML error page for a 404 or 413
+                        response = {"ok": False, "error": "http_{}".format(http.status_code)}
+                    break
+
+            if attempt < self.retries:
+                delay = float(headers.get("Retry-After") or backoff(attempt))
+                logging.warning(
+                    "%s failed (%s), retrying in %.1fs.", method, response["error"], delay
+                )
+                metrics.inc("slack_api_retries_total", method=method)
+                time.sleep(delay)
+
+        if not response.get("ok"):
+            metrics.inc("slack_api_errors_total", method=method, error=response.get("error"))
+        return response
+
+    def call(self, method, **kwargs):
+        """Call a Slack Web API method, making sure it worked.
+
+        Args:
+            method (str): The Slack API method, e.g. 'users.info'
+            **kwargs: Arguments for the API method
+
+        Returns:
+            dict: The API response
+
+        Raises:
+            SlackAPIError: If the response isn't ok
+        """
+        response = self.api_call(method, **kwargs)
+        if not response.get("ok"):
+            raise SlackAPIError(method, response)
+        return response
+
+    def paginate(self, method, key, **kwargs):
+        """Call a paginated Slack API method, following its cursors until every page is read.
+
+        Args:
+            method (str): The Slack API method, e.g. 'users.list'
+            key (str): The key in each response that holds the page's items
+            **kwargs: Any other arguments to pass to the API method
+
+        Yields:
+            Each item from every page
+
+        Raises:
+            SlackAPIError: If a page couldn't be read
+        """
+        cursor = None
+        while True:
+            if cursor:
+                kwargs["cursor"] = cursor
+            response = self.call(method, limit=PAGE_SIZE, **kwargs)
+            for item in response[key]:
+                yield item
+            cursor = response.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                break
+
+
+def never_sent(error):
+    """Check if a failed request never reached Slack, so it can't have been acted on.
+
+    Args:
+        error (RequestException): What the request failed with
+
+    Returns:
+        bool: True if it failed to connect, False if it may have been sent (e.g. a read timeout)
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def backoff(attempt):
+    """How long to wait before retrying a failed call.
+
+    Args:
+        attempt (int): How many times the call has failed before, starting at 0
+
+    Returns:
+        float: Seconds to wait, doubling with each attempt up to MAX_BACKOFF, with jitter
+    """
+    return min(MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1)
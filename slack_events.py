@@ -0,0 +1,225 @@
+"""
+Bagelbot event sources - deliver Slack events to an asyncio queue as they arrive, either from an
+Events API endpoint or from the legacy RTM connection.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+
+from config import EVENTS_HOST, EVENTS_PORT, SLACK_SIGNING_SECRET
+
+MAX_REQUEST_AGE = 60 * 5
+RTM_IDLE_WAIT = 0.1
+
+
+def sign_request(signing_secret, timestamp, body):
+    """Sign a request the way Slack does.
+
+    Args:
+        signing_secret (str): The app's signing secret
+        timestamp (str): The request's X-Slack-Request-Timestamp header
+        body (bytes): The raw request body
+
+    Returns:
+        str: The X-Slack-Signature header
+    """
+    base = b"v0:" + timestamp.encode() + b":" + body
+    return "v0=" + hmac.new(signing_secret.encode(), base, hashlib.sha256).hexdigest()
+
+
+def verify_signature(signing_secret, timestamp, body, signature):
+    """Check that a request to the Events API endpoint really came from Slack.
+
+    Note:
+        https://api.slack.com/authentication/verifying-requests-from-slack
+
+    Args:
+        signing_secret (str): The app's signing secret
+        timestamp (str): The request's X-Slack-Request-Timestamp header
+        body (bytes): The raw request body
+        signature (str): The request's X-Slack-Signature header
+
+    Returns:
+        bool: True if the signature is valid and the request is recent
+    """
+    try:
+        if abs(time.time() - int(timestamp)) > MAX_REQUEST_AGE:
+            return False
+    except (TypeError, ValueError):
+        return False
+    return hmac.compare_digest(sign_request(signing_secret, timestamp, body), signature or "")
+
+
+class EventHub:
+    """Hands every event it's given to each subscribed queue, whatever event loop the queue is on.
+
+    Lets attendance checks for several channels, each running its own event loop, share one
+    event source. It can be used as an `EventsServer` queue.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+
+    def subscribe(self, loop, queue):
+        """Start receiving events.
+
+        Args:
+            loop (asyncio.AbstractEventLoop): The event loop `queue` belongs to
+            queue (asyncio.Queue): Where received events are put
+        """
+        with self.lock:
+            self.subscribers[queue] = loop
+
+    def unsubscribe(self, queue):
+        """Stop receiving events.
+
+        Args:
+            queue (asyncio.Queue): A previously subscribed queue
+        """
+        with self.lock:
+            self.subscribers.pop(queue, None)
+
+    def put_nowait(self, event):
+        """Hand an event to every subscriber.
+
+        Args:
+            event (dict): A Slack event
+        """
+        with self.lock:
+            subscribers = list(self.subscribers.items())
+        for queue, loop in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+
+class EventsServer:
+    """A small asyncio HTTP server for Slack's Events API.
+
+    Every verified `event_callback` has its event put on `queue` as soon as it arrives, and Slack
+    gets its 200 straight away so it doesn't retry. Requests signed with any of the signing secrets
+    are accepted, so one endpoint can serve apps in several workspaces.
+
+    Args:
+        queue (asyncio.Queue): Where received events are put
+        signing_secret (Optional[str or list]): The app's signing secret, or a list of them for
+            several apps, defaults to SLACK_SIGNING_SECRET
+        host (Optional[str]): Address to listen on, defaults to EVENTS_HOST
+        port (Optional[int]): Port to listen on, defaults to EVENTS_PORT
+    """
+
+    def __init__(self, queue, signing_secret=None, host=None, port=None):
+        self.queue = queue
+        signing_secret = signing_secret or SLACK_SIGNING_SECRET
+        if isinstance(signing_secret, str):
+            signing_secret = [signing_secret]
+        self.signing_secrets = list(signing_secret)
+        self.host = host or EVENTS_HOST
+        self.port = EVENTS_PORT if port is None else port
+        self.server = None
+        self.seen = set()
+
+    async def start(self):
+        """Start listening for events."""
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info("Listening for Slack events on %s:%s", self.host, self.port)
+
+    async def close(self):
+        """Stop listening for events."""
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            status, response = self._dispatch(headers, body)
+        except (ValueError, asyncio.IncompleteReadError):
+            status, response = "400 Bad Request", b""
+
+        writer.write(
+            "HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+            "Connection: close\r\n\r\n".format(status, len(response)).encode()
+            + response
+        )
+        await writer.drain()
+        writer.close()
+
+    def _dispatch(self, headers, body):
+        if not any(
+            verify_signature(
+                secret,
+                headers.get("x-slack-request-timestamp"),
+                body,
+                headers.get("x-slack-signature"),
+            )
+            for secret in self.signing_secrets
+        ):
+            logging.warning("Ignoring an event request with a bad signature.")
+            return "401 Unauthorized", b""
+
+        payload = json.loads(body.decode())
+        if payload.get("type") == "url_verification":
+            return "200 OK", json.dumps({"challenge": payload["challenge"]}).encode()
+        if payload.get("type") == "event_callback" and payload.get("event_id") not in self.seen:
+            self.seen.add(payload.get("event_id"))
+            self.queue.put_nowait(payload["event"])
+        return "200 OK", b""
+
+
+def serve_events_in_background(hub, **options):
+    """Run an `EventsServer` on its own thread and event loop, handing events to `hub`.
+
+    Args:
+        hub (EventHub): Where received events are put
+        **options: Any other arguments for `EventsServer`
+
+    Returns:
+        EventsServer: The running server
+    """
+    ready = threading.Event()
+    server = EventsServer(hub, **options)
+
+    async def serve():
+        await server.start()
+        ready.set()
+        await server.server.serve_forever()
+
+    threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+    ready.wait()
+    return server
+
+
+async def rtm_events(sc, queue):
+    """Read events from an already connected RTM session and put them on `queue`.
+
+    Runs until cancelled. The blocking reads happen in a worker thread, so the event loop is
+    free to handle everything else in the meantime.
+
+    Args:
+        sc (SlackClient): An instance of SlackClient, after `rtm_connect()`
+        queue (asyncio.Queue): Where received events are put
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            events = await loop.run_in_executor(None, sc.rtm_read)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Something went wrong reading Slack RTM Events.")
+            events = []
+        for event in events:
+            queue.put_nowait(event)
+        if not events:
+            await asyncio.sleep(RTM_IDLE_WAIT)
@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+"""
+Bagelbot Slack record/replay - records every Slack API call and event with its timing, and replays
+a recording in place of Slack at real speed or faster, so production-shaped traffic can be run
+offline to catch latency regressions.
+"""
+import atexit
+import gzip
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+import metrics
+from config import ATTENDANCE_TIME_LIMIT, PAIRING_SIZE, SLACK_REPLAY_SPEED
+from slack_api import SlackAPI
+from slack_events import EventHub
+
+FORMAT_VERSION = 1
+FLUSH_SECONDS = 1
+# Replayed responses are matched on the method and these arguments, falling back to recorded order
+MATCH_ARGS = ("channel", "user", "cursor")
+DEFAULT_TOLERANCE = 1.25
+
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+
+class Recorder:
+    """Writes timestamped Slack traffic to a gzipped JSON lines file.
+
+    The first line is a header, and every line after it is a record with `t`, the seconds since
+    recording started, and one of:
+
+    - `api`: a Web API call, with its `args`, `response` and how many `seconds` it took
+    - `rtm_connect`: whether connecting to RTM worked
+    - `rtm`: a list of events read over RTM
+    - `event`: an event delivered through the Events API
+
+    Args:
+        path (str): Where to write the recording, it's overwritten if it exists
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.flushed = self.started
+        self.file = gzip.open(path, "wt")
+        self.file.write(json.dumps({"version": FORMAT_VERSION, "recorded": time.time()}) + "\n")
+        atexit.register(self.close)
+
+    def write(self, record, at=None):
+        """Add a record.
+
+        Args:
+            record (dict): What happened
+            at (Optional[float]): When it happened by `time.monotonic()`, defaults to now
+        """
+        now = time.monotonic()
+        record = dict(record, t=round((at or now) - self.started, 4))
+        line = json.dumps(record, default=str, separators=(",", ":")) + "\n"
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(line)
+            if now - self.flushed >= FLUSH_SECONDS:
+                self.file.flush()
+                self.flushed = now
+
+    def close(self):
+        """Finish the recording."""
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+def get_recorder(path):
+    """Get the shared Recorder for a file, creating it the first time.
+
+    Args:
+        path (str): Where the recording is written
+
+    Returns:
+        Recorder: The file's recorder
+    """
+    with _recorders_lock:
+        if path not in _recorders:
+            logging.info("Recording Slack traffic to %s.", path)
+            _recorders[path] = Recorder(path)
+        return _recorders[path]
+
+
+class RecordingSlackAPI(SlackAPI):
+    """A SlackAPI that records every Web API call and RTM read.
+
+    Args:
+        token (str): The Slack API token
+        recorder (Recorder): Where to record
+        **options: Any other `SlackAPI` options
+    """
+
+    def __init__(self, token, recorder, **options):
+        super().__init__(token, **options)
+        self.recorder = recorder
+
+    def request(self, method, data, wait_ratelimited=True):
+        started = time.monotonic()
+        response = super().request(method, data, wait_ratelimited)
+        record = {
+            "api": method,
+            "args": data,
+            "response": response,
+            "seconds": round(time.monotonic() - started, 4),
+        }
+        self.recorder.write(record, started)
+        return response
+
+    def rtm_connect(self, *args, **kwargs):
+        connected = super().rtm_connect(*args, **kwargs)
+        self.recorder.write({"rtm_connect": bool(connected)})
+        return connected
+
+    def rtm_read(self):
+        events = super().rtm_read()
+        if events:
+            self.recorder.write({"rtm": events})
+        return events
+
+
+class RecordingHub(EventHub):
+    """An EventHub that records every event it hands out.
+
+    Args:
+        recorder (Recorder): Where to record
+    """
+
+    def __init__(self, recorder):
+        super().__init__()
+        self.recorder = recorder
+
+    def put_nowait(self, event):
+        self.recorder.write({"event": event})
+        super().put_nowait(event)
+
+
+def read_recording(path):
+    """Read a recording written by `Recorder`.
+
+    Args:
+        path (str): The recording
+
+    Returns:
+        tuple: (header dict, list of records)
+
+    Raises:
+        ValueError: If the file isn't a recording this version can read
+    """
+    with gzip.open(path, "rt") as f:
+        header = json.loads(f.readline())
+        if header.get("version") != FORMAT_VERSION:
+            raise ValueError("{} isn't a version {} recording.".format(path, FORMAT_VERSION))
+        records = []
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # A recording that was cut off mid-line is still good up to there
+                logging.warning("Ignoring a truncated record at the end of %s.", path)
+                break
+    return header, records
+
+
+class ReplaySlackAPI(SlackAPI):
+    """A SlackAPI that answers from a recording instead of Slack.
+
+    Each call gets the unused recorded response for the same method and `MATCH_ARGS`, or failing
+    that the method's next unused one, after the time the recorded call took (divided by `speed`).
+    Recorded events are handed out by `rtm_read`, or to a hub given to `feed`, once the replay
+    reaches their time. The replay clock runs `speed` times faster than real time, and jumps ahead
+    to a call's recorded time when the replayed code gets there sooner, so events never arrive
+    long before the calls they answer.
+
+    Args:
+        path (str): A recording written by `Recorder`
+        speed (Optional[float]): How much faster than recorded to replay, defaults to
+            SLACK_REPLAY_SPEED
+    """
+
+    def __init__(self, path, speed=SLACK_REPLAY_SPEED):
+        super().__init__("replay")
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.responses = {}
+        self.by_method = {}
+        events = []
+        _, records = read_recording(path)
+        for record in records:
+            if "api" in record:
+                key = _match_key(record["api"], record["args"])
+                self.responses.setdefault(key, deque()).append(record)
+                self.by_method.setdefault(record["api"], deque()).append(record)
+            elif "rtm" in record:
+                events.extend((record["t"], event) for event in record["rtm"])
+            elif "event" in record:
+                events.append((record["t"], record["event"]))
+        self.events = deque(sorted(events, key=lambda e: e[0]))
+        self.started = time.monotonic()
+        self.skew = 0.0
+        self.unmatched = 0
+
+    def clock(self):
+        """Where the replay is up to, in seconds of the recording."""
+        return (time.monotonic() - self.started) * self.speed + self.skew
+
+    def request(self, method, data, wait_ratelimited=True):
+        record = self._match(method, data)
+        if record is None:
+            logging.warning("No recorded response left for %s, answering not ok.", method)
+            with self.lock:
+                self.unmatched += 1
+            return {"ok": False, "error": "not_recorded"}
+        with self.lock:
+            self.skew += max(0.0, record["t"] - self.clock())
+        with metrics.timer("slack_api_seconds", method=method):
+            time.sleep(record["seconds"] / self.speed)
+        return record["response"]
+
+    def rtm_connect(self, *args, **kwargs):
+        return True
+
+    def rtm_read(self):
+        due = []
+        with self.lock:
+            now = self.clock()
+            while self.events and self.events[0][0] <= now:
+                due.append(self.events.popleft()[1])
+        return due
+
+    def feed(self, hub, interval=0.01):
+        """Hand recorded events to `hub` as the replay reaches them, from a thread of its own.
+
+        Args:
+            hub (EventHub): Where to put the events
+            interval (Optional[float]): Seconds between checks for due events
+        """
+
+        def work():
+            while True:
+                for event in self.rtm_read():
+                    hub.put_nowait(event)
+                time.sleep(interval)
+
+        threading.Thread(target=work, name="replay", daemon=True).start()
+
+    def _match(self, method, kwargs):
+        key = _match_key(method, kwargs)
+        with self.lock:
+            for queue in (self.responses.get(key), self.by_method.get(method)):
+                while queue:
+                    record = queue.popleft()
+                    if not record.get("used"):
+                        record["used"] = True
+                        return record
+        return None
+
+
+def _match_key(method, args):
+    return (method,) + tuple(str(args.get(arg)) for arg in MATCH_ARGS)
+
+
+def recorded_channel_id(path):
+    """Find the channel whose members were read in a recording.
+
+    Args:
+        path (str): The recording
+
+    Returns:
+        str: The channel's ID, or None if its members were never read
+    """
+    _, records = read_recording(path)
+    for record in records:
+        if record.get("api") == "conversations.members":
+            return record["args"].get("channel")
+    return None
+
+
+def replay(path, speed=SLACK_REPLAY_SPEED, size=PAIRING_SIZE):
+    """Replay a recording through a directory refresh, an attendance check and a meeting.
+
+    Everything runs against a new store in a temporary directory, and the attendance window is
+    ATTENDANCE_TIME_LIMIT shortened by `speed`.
+
+    Args:
+        path (str): A recording written by `Recorder`
+        speed (Optional[float]): How much faster than recorded to replay
+        size (Optional[int]): Pair size
+
+    Returns:
+        dict: `measure` results for each step, and how many calls had no recorded response
+    """
+    # These pull in the whole bot, so they're only imported when replaying
+    from benchmark import measure
+    from check_attendance import check_attendance
+    from generate_meeting import create_meetings
+    from storage import Store
+    from utils import update_everyone_from_slack
+
+    sc = ReplaySlackAPI(path, speed)
+    hub = EventHub()
+    sc.feed(hub)
+    channel_id = recorded_channel_id(path)
+    results = {"speed": speed}
+    with tempfile.TemporaryDirectory() as workdir:
+        store = Store(os.path.join(workdir, "replay.sqlite3"))
+        try:
+            results["update_everyone_from_slack"] = measure(
+                lambda: update_everyone_from_slack(store, sc, channel_id), memory=False
+            )
+
+            def attendance():
+                meeting = check_attendance(
+                    store, sc, hub=hub, time_limit=ATTENDANCE_TIME_LIMIT / speed
+                )
+                return {"available": len(meeting["available"]), "out": len(meeting["out"])}
+
+            results["check_attendance"] = measure(attendance, memory=False)
+
+            def generate():
+                if not create_meetings(store, sc, size=size, force_create=True):
+                    create_meetings(store, sc, size=size, force_create=True, any_pair=True)
+                return {"groups": len(store["history"][-1]["attendees"])}
+
+            results["create_meetings"] = measure(generate, memory=False)
+        finally:
+            store.close()
+    results["unmatched"] = sc.unmatched
+    return results
+
+
+def compare(baseline, results, tolerance=DEFAULT_TOLERANCE):
+    """Print how a replay's timings compare to a baseline replay of the same recording.
+
+    Args:
+        baseline (dict): Results from a previous `replay`
+        results (dict): Results from this one
+        tolerance (Optional[float]): How many times slower than the baseline a step may be
+
+    Returns:
+        bool: True if no step was slower than the tolerance allows
+    """
+    ok = True
+    print("{:<28} {:>10} {:>10} {:>8}".format("step", "before", "after", "change"))
+    for step, result in results.items():
+        old = baseline.get(step)
+        if not isinstance(result, dict) or not isinstance(old, dict):
+            continue
+        change = result["seconds"] / old["seconds"] if old["seconds"] else float("inf")
+        slower = change > tolerance
+        ok = ok and not slower
+        print(
+            "{:<28} {:>9.3f}s {:>9.3f}s {:>7.2f}x{}".format(
+                step, old["seconds"], result["seconds"], change, "  REGRESSION" if slower else ""
+            )
+        )
+    return ok
+
+
+def main(args):
+    """
+    Replay a recording, print the results as JSON, and compare them to a baseline.
+
+    Args:
+        args (ArgumentParser args): Parsed arguments naming the recording and how to replay it
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    results = replay(args.recording, args.speed, args.size)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f)
+    if args.compare:
+        with open(args.compare) as f:
+            if not compare(json.load(f), results, args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Replay recorded Slack traffic through an attendance check and a meeting."
+    )
+    parser.add_argument("recording", help="a recording made with SLACK_RECORD_FILE")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=SLACK_REPLAY_SPEED,
+        help="how much faster than recorded to replay (default set in config.py)",
+    )
+    parser.add_argument("--size", type=int, default=PAIRING_SIZE, help="pair size")
+    parser.add_argument("--output", "-o", help="where to write the results as JSON")
+    parser.add_argument("--compare", "-c", help="results of a previous replay to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="how many times slower than the previous replay a step may be before failing",
+    )
+    main(parser.parse_args())
@@ -0,0 +1,700 @@
+"""
+Bagelbot storage - a SQLite backed, dictionary-like store for meeting history and everything else
+the scripts need to remember.
+"""
+import dbm
+import gzip
+import json
+import logging
+import os
+import pickle
+import shelve
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping, Sequence
+from datetime import date
+from itertools import chain, groupby
+
+try:
+    import fcntl
+except ImportError:  # Windows - writers aren't leased there
+    fcntl = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS members (
+    id INTEGER PRIMARY KEY,
+    slack_id TEXT UNIQUE,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS meetings (
+    id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL,
+    canceled INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS attendance (
+    meeting INTEGER NOT NULL REFERENCES meetings (id),
+    grp INTEGER NOT NULL,
+    member INTEGER NOT NULL REFERENCES members (id)
+);
+CREATE INDEX IF NOT EXISTS attendance_meeting ON attendance (meeting);
+CREATE TABLE IF NOT EXISTS pairs (
+    a INTEGER NOT NULL REFERENCES members (id),
+    b INTEGER NOT NULL REFERENCES members (id),
+    meeting INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    times INTEGER NOT NULL,
+    PRIMARY KEY (a, b)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS pairs_meeting ON pairs (meeting);
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS archive (
+    segment TEXT PRIMARY KEY,
+    first INTEGER NOT NULL,
+    count INTEGER NOT NULL
+);
+"""
+# Stores from before members were numbered kept usernames in attendance and pairs
+MIGRATE_MEMBERS = """
+BEGIN;
+INSERT OR IGNORE INTO members (name)
+    SELECT username FROM attendance UNION SELECT a FROM pairs UNION SELECT b FROM pairs;
+DROP INDEX attendance_meeting;
+DROP INDEX pairs_meeting;
+ALTER TABLE attendance RENAME TO attendance_names;
+ALTER TABLE pairs RENAME TO pairs_names;
+{schema}
+INSERT INTO attendance (meeting, grp, member)
+    SELECT x.meeting, x.grp, m.id FROM attendance_names x JOIN members m ON m.name = x.username;
+INSERT INTO pairs (a, b, meeting, date, times)
+    SELECT ma.id, mb.id, x.meeting, x.date, x.times FROM pairs_names x
+    JOIN members ma ON ma.name = x.a JOIN members mb ON mb.name = x.b;
+DROP TABLE attendance_names;
+DROP TABLE pairs_names;
+COMMIT;
+""".format(schema=SCHEMA)
+HISTORY = "history"
+SEGMENT_SIZE = 52
+LEASE_POLL_SECONDS = 0.1
+
+
+class StoreLocked(Exception):
+    """Another process is holding a store's writer lease."""
+
+
+class History(Sequence):
+    """A read-only list-like view of past meetings, with `append` to add a new one.
+
+    Each meeting looks the same as it always has in the shelf::
+
+        {"date": date, "attendees": [frozenset, ...]}  # plus "canceled": True for canceled meetings
+
+    Attendees are stored as member ids, so they always show up under their current username.
+
+    Older meetings can be moved out of the store into compressed archive segments with `archive`.
+    The view then only covers the meetings still in the store - `offset` of them came before it,
+    and `iter_all` reads through every meeting, archived or not.
+
+    Args:
+        store (Store): The store the meetings are kept in
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.query("SELECT COUNT(*) FROM meetings")[0][0]
+
+    @property
+    def offset(self):
+        """How many meetings have been archived, which is also the number of `history[0]`."""
+        return self.store.query("SELECT COALESCE(SUM(count), 0) FROM archive")[0][0]
+
+    @property
+    def total(self):
+        """How many meetings there have ever been, archived or not."""
+        return self.offset + len(self)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            positions = range(len(self))[index]
+            if not positions:
+                return []
+            start, stop = min(positions), max(positions) + 1
+            meetings = list(self._meetings(stop - start, start))
+            return [meetings[position - start] for position in positions]
+
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("history index out of range")
+        return next(self._meetings(1, index))
+
+    def __iter__(self):
+        return self._meetings(-1, 0)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def append(self, meeting):
+        """Add a meeting - this writes its rows and updates the pair index in one transaction.
+
+        Args:
+            meeting (dict): The meeting to add
+        """
+        with self.store.transaction() as db:
+            # Meeting ids are their number plus one, and carry on counting after archived meetings
+            number = self.total
+            db.execute(
+                "INSERT INTO meetings (id, date, canceled) VALUES (?, ?, ?)",
+                (number + 1, meeting["date"].isoformat(), int(bool(meeting.get("canceled")))),
+            )
+            ids = self.store.intern(db, set().union(*meeting.get("attendees", [])))
+            for grp, group in enumerate(meeting.get("attendees", [])):
+                group = [ids[person] for person in group]
+                db.executemany(
+                    "INSERT INTO attendance (meeting, grp, member) VALUES (?, ?, ?)",
+                    [(number + 1, grp, person) for person in group],
+                )
+                db.executemany(
+                    "INSERT INTO pairs (a, b, meeting, date, times) VALUES (?, ?, ?, ?, 1)"
+                    " ON CONFLICT (a, b) DO UPDATE SET meeting = excluded.meeting,"
+                    " date = excluded.date, times = times + 1",
+                    [
+                        (a, b, number, meeting["date"].isoformat())
+                        for a in group
+                        for b in group
+                        if a != b
+                    ],
+                )
+
+    def archive(self, keep, segment_size=SEGMENT_SIZE):
+        """Move the oldest meetings out of the store into compressed, immutable archive segments.
+
+        Note:
+            Only whole segments of `segment_size` meetings are archived, so between `keep` and
+            `keep + segment_size - 1` meetings stay in the store. The pair index isn't touched, so
+            who has met whom (and when) is still known for archived meetings.
+
+        Args:
+            keep (int): How many of the most recent meetings to keep in the store, at least 1
+            segment_size (Optional[int]): How many meetings go in each segment
+
+        Returns:
+            list: Paths of the segments that were written
+        """
+        if keep < 1:
+            raise ValueError("At least the last meeting has to stay in the store.")
+        written = []
+        while len(self) - keep >= segment_size:
+            first = self.offset
+            name = "meetings-{:06d}-{:06d}.jsonl.gz".format(first, first + segment_size - 1)
+            path = os.path.join(self.store.archive_dir, name)
+            os.makedirs(self.store.archive_dir, exist_ok=True)
+            partial = path + ".tmp"
+            with gzip.open(partial, "wt") as f:
+                for meeting in self._meetings(segment_size, 0, names=False):
+                    f.write(json.dumps(_to_json(meeting)) + "\n")
+            os.replace(partial, path)
+
+            with self.store.transaction() as db:
+                db.execute(
+                    "INSERT INTO archive (segment, first, count) VALUES (?, ?, ?)",
+                    (name, first, segment_size),
+                )
+                ids = (first + 1, first + segment_size)
+                db.execute("DELETE FROM attendance WHERE meeting BETWEEN ? AND ?", ids)
+                db.execute("DELETE FROM meetings WHERE id BETWEEN ? AND ?", ids)
+            written.append(path)
+            logging.info("Archived meetings %s to %s.", ids, path)
+        return written
+
+    def segments(self):
+        """Paths of every archive segment, oldest first."""
+        rows = self.store.query("SELECT segment FROM archive ORDER BY first")
+        return [os.path.join(self.store.archive_dir, segment) for segment, in rows]
+
+    def archived(self):
+        """Read the archived meetings, oldest first, one segment at a time.
+
+        Yields:
+            Each archived meeting
+        """
+        names = self.store.member_names()
+        for path in self.segments():
+            with gzip.open(path, "rt") as f:
+                for line in f:
+                    yield _from_json(json.loads(line), names)
+
+    def iter_all(self):
+        """Read every meeting there has ever been, archived ones first.
+
+        Yields:
+            Each meeting
+        """
+        return chain(self.archived(), iter(self))
+
+    def _meetings(self, limit, offset, names=True):
+        rows = self.store.query(
+            "SELECT m.id, m.date, m.canceled, a.grp, {}"
+            " FROM (SELECT * FROM meetings ORDER BY id LIMIT ? OFFSET ?) m"
+            " LEFT JOIN attendance a ON a.meeting = m.id"
+            " LEFT JOIN members u ON u.id = a.member ORDER BY m.id, a.grp".format(
+                "u.name" if names else "a.member"
+            ),
+            (limit, offset),
+        )
+        for (_, day, canceled), members in groupby(rows, key=lambda r: r[:3]):
+            meeting = {"date": date.fromisoformat(day), "attendees": []}
+            for _, group in groupby((m for m in members if m[3] is not None), key=lambda r: r[3]):
+                meeting["attendees"].append(frozenset(m[4] for m in group))
+            if canceled:
+                meeting["canceled"] = True
+            yield meeting
+
+
+def archive_dir(path):
+    """Get the directory a store's archive segments are kept in, e.g. `meetings.sqlite3.archive`.
+
+    Args:
+        path (str): The store's SQLite file
+
+    Returns:
+        str: The directory
+    """
+    return path + ".archive"
+
+
+def _to_json(meeting):
+    return dict(
+        meeting,
+        date=meeting["date"].isoformat(),
+        attendees=[sorted(group) for group in meeting["attendees"]],
+    )
+
+
+def _from_json(meeting, names):
+    return dict(
+        meeting,
+        date=date.fromisoformat(meeting["date"]),
+        attendees=[frozenset(names.get(m, m) for m in group) for group in meeting["attendees"]],
+    )
+
+
+class Store(MutableMapping):
+    """A dictionary-like store backed by a single SQLite file.
+
+    `store["history"]` is a `History` view over the append-only meetings and attendance tables,
+    so adding a meeting writes only that meeting's rows. Every other key is pickled into a
+    key/value table, and is written when it's assigned (not when it's changed in place).
+
+    People are numbered in a members table, keyed by their Slack user id once it's known, and
+    meetings and the pair index refer to them by number.
+
+    Only one process at a time can open a store for writing - it holds the store's writer lease
+    (see `acquire_lease`) until it's closed. The file is in WAL mode, so any number of read-only
+    opens can read it at the same time without waiting for, or holding up, the writer.
+
+    Args:
+        path (str): The SQLite file to open (or create)
+        readonly (Optional[bool]): If True, open the store read-only and without taking the lease
+        timeout (Optional[float]): Seconds to wait for the writer lease, None to wait forever
+
+    Raises:
+        StoreLocked: If the writer lease couldn't be taken within `timeout`
+    """
+
+    def __init__(self, path, readonly=False, timeout=None):
+        self.path = path
+        self.readonly = readonly
+        self.archive_dir = archive_dir(path)
+        self.lock = threading.RLock()
+        self.lease = None
+        if readonly:
+            self.db = sqlite3.connect(_readonly_uri(path), uri=True, check_same_thread=False)
+        else:
+            self.lease = acquire_lease(path, timeout)
+            try:
+                self.db = sqlite3.connect(path, check_same_thread=False)
+                self.db.execute("PRAGMA journal_mode = WAL")
+                self.db.executescript(SCHEMA)
+            except Exception:
+                release_lease(self.lease)
+                raise
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info (attendance)")]
+        if "username" in columns:
+            if readonly:
+                self.close()
+                raise StoreLocked(
+                    "{} has to be opened for writing once to upgrade it.".format(path)
+                )
+            logging.info("Numbering the members of %s.", path)
+            self.db.executescript(MIGRATE_MEMBERS)
+            self.db.execute("VACUUM")
+        self.history = History(self)
+
+    def query(self, sql, params=()):
+        """Run a read query and return all of its rows.
+
+        Args:
+            sql (str): The query
+            params (tuple): Parameters for the query
+
+        Returns:
+            list: The rows
+        """
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def transaction(self):
+        """A context that runs everything in it in a single transaction.
+
+        Returns:
+            context: Yields the SQLite connection, commits on success and rolls back on error
+        """
+        return _Transaction(self)
+
+    def __getitem__(self, key):
+        if key == HISTORY:
+            return self.history
+        rows = self.query("SELECT value FROM kv WHERE key = ?", (key,))
+        if not rows:
+            raise KeyError(key)
+        return pickle.loads(rows[0][0])
+
+    def __setitem__(self, key, value):
+        with self.transaction() as db:
+            if key == HISTORY:
+                db.execute("DELETE FROM attendance")
+                db.execute("DELETE FROM pairs")
+                db.execute("DELETE FROM meetings")
+                db.execute("DELETE FROM archive")
+            else:
+                # Don't touch the file if nothing changed, so unchanged stores aren't re-uploaded
+                blob = pickle.dumps(value)
+                if db.execute(
+                    "SELECT 1 FROM kv WHERE key = ? AND value = ?", (key, blob)
+                ).fetchone():
+                    return
+                db.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, blob))
+        if key == HISTORY:
+            for meeting in value:
+                self.history.append(meeting)
+
+    def __delitem__(self, key):
+        with self.transaction() as db:
+            if db.execute("DELETE FROM kv WHERE key = ?", (key,)).rowcount == 0:
+                raise KeyError(key)
+
+    def __iter__(self):
+        return iter([HISTORY] + [row[0] for row in self.query("SELECT key FROM kv ORDER BY key")])
+
+    def __len__(self):
+        return 1 + self.query("SELECT COUNT(*) FROM kv")[0][0]
+
+    def intern(self, db, names):
+        """Get the member ids for some usernames, numbering anyone who doesn't have one yet.
+
+        Args:
+            db (sqlite3.Connection): The connection of the transaction this is part of
+            names (iterable): Slack usernames
+
+        Returns:
+            dict: Maps each username to its member id
+        """
+        names = set(names)
+        db.executemany(
+            "INSERT OR IGNORE INTO members (name) VALUES (?)", [(name,) for name in names]
+        )
+        ids = {}
+        chunk = sorted(names)
+        # SQLite limits how many parameters a query can have
+        for start in range(0, len(chunk), 500):
+            part = chunk[start : start + 500]
+            ids.update(
+                db.execute(
+                    "SELECT name, id FROM members WHERE name IN ({})".format(
+                        ", ".join("?" * len(part))
+                    ),
+                    part,
+                )
+            )
+        return ids
+
+    def member_names(self):
+        """Get everyone's current username.
+
+        Returns:
+            dict: Maps each member id to a username
+        """
+        return dict(self.query("SELECT id, name FROM members"))
+
+    def update_members(self, members):
+        """Bring the members table up to date with Slack, so renamed people keep their history.
+
+        Someone already known by their Slack id takes their new username. Someone only known by
+        username (from before Slack ids were recorded) gets their Slack id. If a username now
+        belongs to someone else, whoever had it before is renamed to their Slack id.
+
+        Args:
+            members (dict): Maps Slack user ids to their current usernames
+        """
+        with self.transaction() as db:
+            for slack_id, name in members.items():
+                row = db.execute("SELECT id, name FROM members WHERE slack_id = ?", (slack_id,))
+                known = row.fetchone()
+                if known and known[1] == name:
+                    continue
+                holder = db.execute(
+                    "SELECT id, slack_id FROM members WHERE name = ?", (name,)
+                ).fetchone()
+                if holder and holder[1] is None and not known:
+                    db.execute(
+                        "UPDATE members SET slack_id = ? WHERE id = ?", (slack_id, holder[0])
+                    )
+                    continue
+                if holder:
+                    stale = holder[1] or "member-{}".format(holder[0])
+                    logging.info("%s now belongs to %s, renaming its old owner.", name, slack_id)
+                    db.execute("UPDATE members SET name = ? WHERE id = ?", (stale, holder[0]))
+                if known:
+                    logging.info("%s was renamed from %s to %s.", slack_id, known[1], name)
+                    db.execute("UPDATE members SET name = ? WHERE id = ?", (name, known[0]))
+                else:
+                    db.execute(
+                        "INSERT INTO members (slack_id, name) VALUES (?, ?)", (slack_id, name)
+                    )
+
+    def met(self, since=None):
+        """Look up who has met whom, without the rest of the pair index.
+
+        Args:
+            since (Optional[int]): Only include pairs whose last meeting number is at least this
+
+        Returns:
+            dict: Maps each username to the set of usernames they have met
+        """
+        names = self.member_names()
+        rows = self.query(
+            "SELECT a, b FROM pairs WHERE meeting >= ?", (since if since is not None else -1,)
+        )
+        met = {}
+        for a, b in rows:
+            met.setdefault(a, set()).add(names[b])
+        return {names[a]: others for a, others in met.items()}
+
+    def pairs(self, since=None):
+        """Rows of the pair index - who has met whom, and when they last met.
+
+        Args:
+            since (Optional[int]): Only include pairs whose last meeting number is at least this
+
+        Returns:
+            list: (person, other person, last meeting number, last meeting date, times met) tuples
+        """
+        names = self.member_names()
+        rows = self.query(
+            "SELECT a, b, meeting, date, times FROM pairs WHERE meeting >= ?",
+            (since if since is not None else -1,),
+        )
+        return [
+            (names[a], names[b], number, date.fromisoformat(day), times)
+            for a, b, number, day, times in rows
+        ]
+
+    def last_met(self, a, b):
+        """Look up when two people last met in the pair index.
+
+        Args:
+            a (str): A slack username
+            b (str): Another slack username
+
+        Returns:
+            tuple: (meeting number, date, times met), or None if they have never met
+        """
+        rows = self.query(
+            "SELECT p.meeting, p.date, p.times FROM pairs p"
+            " JOIN members ma ON ma.id = p.a JOIN members mb ON mb.id = p.b"
+            " WHERE ma.name = ? AND mb.name = ?",
+            (a, b),
+        )
+        return (rows[0][0], date.fromisoformat(rows[0][1]), rows[0][2]) if rows else None
+
+    def sync(self):
+        """Make sure nothing is left uncommitted, and the SQLite file itself is complete.
+
+        Everything is written as it happens, but in WAL mode recent writes live in a `-wal` file
+        next to the store until they're checkpointed into it - this checkpoints them, so the store
+        file can be copied (e.g. to S3) on its own.
+        """
+        with self.lock:
+            self.db.commit()
+            if not self.readonly:
+                self.db.execute("PRAGMA wal_checkpoint (TRUNCATE)")
+
+    def close(self):
+        """Close the SQLite file, and give up the writer lease."""
+        with self.lock:
+            self.db.close()
+            release_lease(self.lease)
+            self.lease = None
+
+
+class _Transaction:
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        self.store.lock.acquire()
+        return self.store.db
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type:
+                self.store.db.rollback()
+            else:
+                self.store.db.commit()
+        finally:
+            self.store.lock.release()
+
+
+def migrate_shelve(shelve_file, store):
+    """Copy everything from an old `meetings.shelve` into a SQLite store.
+
+    Args:
+        shelve_file (str): The shelf to read from
+        store (Store): The store to copy into
+    """
+    old = shelve.open(shelve_file, flag="r")
+    try:
+        for key in old:
+            if key == "pair_index":
+                # Rebuilt by the store as history is copied over
+                continue
+            store[key] = old[key]
+        logging.info(
+            "Migrated %s meetings from %s to %s.", len(store[HISTORY]), shelve_file, store.path
+        )
+    finally:
+        old.close()
+
+
+def lease_file(path):
+    """Get the file a store's writer lease is held on, e.g. `meetings.sqlite3.lock`.
+
+    Args:
+        path (str): The store's SQLite file
+
+    Returns:
+        str: The lock file
+    """
+    return path + ".lock"
+
+
+def acquire_lease(path, timeout=None):
+    """Take the exclusive writer lease on a store, waiting for whoever has it to let go.
+
+    The lease is an exclusive `flock` on the store's lock file, so it's let go of automatically if
+    the process holding it dies. The holder's pid is written in the file.
+
+    Args:
+        path (str): The store's SQLite file
+        timeout (Optional[float]): Seconds to wait for the lease, None to wait forever
+
+    Returns:
+        file: The open lock file that holds the lease, pass it to `release_lease` to let go of it.
+            None on platforms without `flock`.
+
+    Raises:
+        StoreLocked: If the lease couldn't be taken within `timeout`
+    """
+    if fcntl is None:
+        return None
+    lease = open(lease_file(path), "a+")
+    deadline = None if timeout is None else time.monotonic() + timeout
+    waited = False
+    while True:
+        try:
+            fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            if deadline is not None and time.monotonic() >= deadline:
+                lease.seek(0)
+                holder = lease.read().strip() or "another process"
+                lease.close()
+                raise StoreLocked("{} is being written by {}.".format(path, holder))
+            if not waited:
+                logging.info("Waiting for the writer lease on %s.", path)
+                waited = True
+            time.sleep(LEASE_POLL_SECONDS)
+    lease.seek(0)
+    lease.truncate()
+    lease.write("pid {}".format(os.getpid()))
+    lease.flush()
+    return lease
+
+
+def release_lease(lease):
+    """Let go of a writer lease taken with `acquire_lease`.
+
+    Args:
+        lease (file): The lease, or None
+    """
+    if lease is not None and not lease.closed:
+        lease.close()
+
+
+def _readonly_uri(path):
+    # urllib is slow to import, and SQLite only needs these escaped in a file URI
+    path = os.path.abspath(path).replace(os.sep, "/")
+    for char, escaped in (("%", "%25"), ("?", "%3f"), ("#", "%23")):
+        path = path.replace(char, escaped)
+    if not path.startswith("/"):  # Windows drive letters
+        path = "/" + path
+    return "file:{}?mode=ro".format(path)
+
+
+def snapshot(path, destination):
+    """Copy a consistent snapshot of a store with SQLite's backup API, even while it's being written.
+
+    Args:
+        path (str): The store's SQLite file
+        destination (str): Where to write the snapshot, it's overwritten if it exists
+    """
+    source = sqlite3.connect(_readonly_uri(path), uri=True)
+    try:
+        if os.path.exists(destination):
+            os.remove(destination)
+        target = sqlite3.connect(destination)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+
+def open_sqlite_store(path, shelve_file=None, readonly=False, timeout=None):
+    """Open a SQLite store, migrating an existing shelf into it the first time.
+
+    Args:
+        path (str): The SQLite file to open (or create)
+        shelve_file (Optional[str]): An old shelf to migrate from if `path` doesn't exist yet
+        readonly (Optional[bool]): If True, open the store read-only and without the writer lease
+        timeout (Optional[float]): Seconds to wait for the writer lease, None to wait forever
+
+    Returns:
+        Store: The open store
+
+    Raises:
+        StoreLocked: If the writer lease couldn't be taken within `timeout`
+    """
+    migrate = not readonly and not os.path.exists(path) and shelve_file and dbm.whichdb(shelve_file)
+    store = Store(path, readonly=readonly, timeout=timeout)
+    if migrate:
+        migrate_shelve(shelve_file, store)
+    return store
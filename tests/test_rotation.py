@@ -0,0 +1,41 @@
+"""
+Tests for following planned rotations in rotation.py, meeting after meeting.
+"""
+
+import random
+from datetime import date, timedelta
+
+import pytest
+
+from history import record_meeting
+from rotation import ROTATION, advance_rotation, planned_groups
+from storage import Store
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = Store(str(tmp_path / "rotation.sqlite3"))
+    yield store
+    store.close()
+
+
+@pytest.mark.parametrize("people, size", [(6, 2), (7, 2), (9, 3)])
+def test_back_to_back_rotations_keep_planning_weeks(store, people, size):
+    random.seed(people)
+    names = ["user{}".format(i) for i in range(people)]
+    store["everyone"] = names
+    starts = set()
+    for week in range(40):
+        # What create_meetings asks for: no repeats from the last nCr meetings
+        window = min(people * (people - 1) // size, store["history"].total)
+        groups = planned_groups(store, names, size, window=window)
+        assert groups is not None, "no groups in week {}".format(week)
+        assert sorted(n for group in groups for n in group) == sorted(names)
+        last = store["history"][-1]["attendees"] if store["history"].total else []
+        assert not set(groups) & set(last)
+        record_meeting(
+            store, {"date": date(2024, 1, 1) + timedelta(weeks=week), "attendees": groups}
+        )
+        advance_rotation(store)
+        starts.add(store[ROTATION]["start"])
+    assert len(starts) >= 3
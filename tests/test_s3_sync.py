@@ -0,0 +1,137 @@
+"""
+Tests for syncing stores with S3 - the conditional upload and download in utils.py, against moto.
+"""
+import logging
+import os
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+import utils
+
+BUCKET = "bagelbot-test"
+STORE = "team.sqlite3"
+
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    """An empty bucket in a mocked S3, with every store file kept under `tmp_path`."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(utils, "S3_BUCKET", BUCKET)
+    monkeypatch.setattr(utils, "S3_PREFIX", None)
+    with mock_aws():
+        boto3.setup_default_session()
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+
+        def if_match(params, **_):
+            # moto (up to its last release for Python 3.8) ignores IfMatch on put_object, so the
+            # check S3 makes is made here
+            if "IfMatch" not in params:
+                return
+            try:
+                etag = client.head_object(Bucket=params["Bucket"], Key=params["Key"])["ETag"]
+            except ClientError:
+                etag = None
+            if etag != params["IfMatch"]:
+                raise ClientError(
+                    {
+                        "Error": {
+                            "Code": "PreconditionFailed",
+                            "Message": "At least one of the pre-conditions did not hold",
+                        }
+                    },
+                    "PutObject",
+                )
+
+        boto3.DEFAULT_SESSION.events.register("provide-client-params.s3.PutObject", if_match)
+        yield client
+    boto3.DEFAULT_SESSION = None
+
+
+def write_store(filename, **items):
+    store = utils.open_store(filename)
+    try:
+        for key, value in items.items():
+            store[key] = value
+        store.sync()
+    finally:
+        store.close()
+
+
+def read_store(filename, key):
+    store = utils.open_store(filename, readonly=True)
+    try:
+        return store.get(key)
+    finally:
+        store.close()
+
+
+def other_run(tmp_path, owner):
+    """Another run, on another machine, that downloads the store, changes it and uploads it."""
+    other = tmp_path / "other"
+    other.mkdir(exist_ok=True)
+    here = os.getcwd()
+    os.chdir(other)
+    try:
+        utils.download_store_from_s3(STORE)
+        write_store(STORE, owner=owner)
+        assert utils.upload_store_to_s3(STORE)
+    finally:
+        os.chdir(here)
+
+
+def test_upload_refuses_to_overwrite_someone_elses_changes(s3, tmp_path):
+    write_store(STORE, owner="first")
+    assert utils.upload_store_to_s3(STORE)
+    other_run(tmp_path, "second")
+    theirs = s3.head_object(Bucket=BUCKET, Key=STORE + ".gz")["ETag"]
+
+    # Our copy is now out of date, so our change must not replace theirs
+    write_store(STORE, owner="third")
+    assert not utils.upload_store_to_s3(STORE)
+    assert s3.head_object(Bucket=BUCKET, Key=STORE + ".gz")["ETag"] == theirs
+
+    # Once we've caught up with their change, we can upload again
+    utils.download_store_from_s3(STORE)
+    assert read_store(STORE, "owner") == "second"
+    write_store(STORE, owner="third")
+    assert utils.upload_store_to_s3(STORE)
+
+
+def test_first_upload_doesnt_overwrite_an_existing_store(s3, tmp_path):
+    other_run(tmp_path, "theirs")
+    write_store(STORE, owner="ours")
+    assert not utils.upload_store_to_s3(STORE)
+
+
+def test_download_is_skipped_when_nothing_changed(s3, tmp_path, caplog):
+    write_store(STORE, owner="first")
+    assert utils.upload_store_to_s3(STORE)
+    mtime = os.path.getmtime(STORE)
+
+    with caplog.at_level(logging.INFO):
+        utils.download_store_from_s3(STORE)
+    assert "already up to date" in caplog.text
+    assert os.path.getmtime(STORE) == mtime
+
+    # Once someone else changes it in S3, it's downloaded again
+    other_run(tmp_path, "second")
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        utils.download_store_from_s3(STORE)
+    assert "already up to date" not in caplog.text
+    assert read_store(STORE, "owner") == "second"
+
+
+def test_unchanged_upload_is_skipped(s3):
+    write_store(STORE, owner="first")
+    assert utils.upload_store_to_s3(STORE)
+    etag = s3.head_object(Bucket=BUCKET, Key=STORE + ".gz")["ETag"]
+    assert utils.upload_store_to_s3(STORE)
+    assert s3.head_object(Bucket=BUCKET, Key=STORE + ".gz")["ETag"] == etag
@@ -0,0 +1,34 @@
+"""
+Tests for catching up on missed scheduled runs in scheduler.py.
+"""
+
+from datetime import datetime, timedelta
+
+import pytz
+
+from config import ATTENDANCE_TIME_LIMIT
+from scheduler import Job, Scheduler
+
+TZ = pytz.timezone("US/Central")
+ATTENDANCE = Job("attendance", 0, 11, 0)
+MEETING = Job("meeting", 0, 11, 5)
+
+
+def test_run_held_up_by_a_long_attendance_check_isnt_stale():
+    scheduler = Scheduler([ATTENDANCE, MEETING], TZ, TZ.localize(datetime(2024, 1, 1, 10)))
+    when, job = scheduler.next_due()
+    assert job == ATTENDANCE
+    finished = when + timedelta(seconds=ATTENDANCE_TIME_LIMIT, minutes=1)
+    scheduler.handled(when, finished=finished)
+
+    when, job = scheduler.next_due()
+    assert job == MEETING
+    assert not scheduler.is_stale(when, finished + timedelta(seconds=1))
+    assert scheduler.is_stale(when, finished + scheduler.grace + timedelta(seconds=1))
+
+
+def test_run_missed_while_the_service_was_down_is_stale():
+    scheduler = Scheduler([MEETING], TZ, TZ.localize(datetime(2024, 1, 1, 10)))
+    when, _ = scheduler.next_due()
+    assert not scheduler.is_stale(when, when + scheduler.grace)
+    assert scheduler.is_stale(when, when + scheduler.grace + timedelta(seconds=1))
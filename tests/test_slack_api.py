@@ -0,0 +1,56 @@
+"""
+Tests for retrying failed Slack API calls in slack_api.py.
+"""
+
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+import slack_api
+from slack_api import SlackAPI
+
+
+@pytest.fixture
+def slack(monkeypatch):
+    """A SlackAPI that doesn't sleep between retries, and whose calls are answered by `posts`."""
+    monkeypatch.setattr(slack_api.time, "sleep", lambda seconds: None)
+    sc = SlackAPI("token", retries=3)
+    sc.posts = []
+
+    def post(url, **kwargs):
+        sc.posts.append(url)
+        raise sc.error
+
+    monkeypatch.setattr(sc.session, "post", post)
+    return sc
+
+
+def refused():
+    reason = NewConnectionError(None, "Connection refused")
+    return requests.ConnectionError(MaxRetryError(None, "/", reason))
+
+
+def test_post_that_times_out_isnt_sent_again(slack):
+    slack.error = requests.ReadTimeout("Read timed out.")
+    response = slack.api_call("chat.postMessage", channel="C1", text="hi")
+    assert response["error"] == "connection_error"
+    assert len(slack.posts) == 1
+
+
+def test_post_dropped_mid_request_isnt_sent_again(slack):
+    slack.error = requests.ConnectionError("Connection reset by peer")
+    slack.api_call("chat.postMessage", channel="C1", text="hi")
+    assert len(slack.posts) == 1
+
+
+@pytest.mark.parametrize("error", [requests.ConnectTimeout("Connect timed out."), refused()])
+def test_post_that_never_connected_is_retried(slack, error):
+    slack.error = error
+    slack.api_call("chat.postMessage", channel="C1", text="hi")
+    assert len(slack.posts) == 4
+
+
+def test_read_that_times_out_is_retried(slack):
+    slack.error = requests.ReadTimeout("Read timed out.")
+    slack.api_call("conversations.history", channel="D1")
+    assert len(slack.posts) == 4
@@ -0,0 +1,113 @@
+"""
+Bagelbot background uploader - uploads stores to S3 from a thread of its own, so a slow or failing
+upload never holds up the next scheduled job.
+"""
+import logging
+import threading
+import time
+
+import metrics
+from config import UPLOAD_DELAY, UPLOAD_MAX_DELAY
+from utils import upload_store_to_s3
+
+
+class Uploader:
+    """Uploads stores to S3 in the background, merging bursts of changes into one upload.
+
+    An upload waits until its store has gone `delay` seconds without another request, but never
+    more than `max_delay` seconds after the first one. Uploads that raise are retried, uploads
+    that lose to someone else's change in S3 are not, and both are counted in
+    `s3_upload_failures_total`. Everything still waiting is uploaded right away on `close`.
+
+    Args:
+        upload (Optional[callable]): Uploads a store given its file name, returning False if S3
+            was changed by someone else, defaults to `upload_store_to_s3`
+        delay (Optional[float]): Seconds to wait for more changes before uploading
+        max_delay (Optional[float]): The most seconds an upload waits after it's first requested
+    """
+
+    def __init__(self, upload=upload_store_to_s3, delay=UPLOAD_DELAY, max_delay=UPLOAD_MAX_DELAY):
+        self.upload = upload
+        self.delay = delay
+        self.max_delay = max_delay
+        self.pending = {}  # file name: (first requested, last requested)
+        self.since = {}  # file name: first requested since it was last uploaded
+        self.changed = threading.Condition()
+        self.closing = False
+        self.thread = threading.Thread(target=self._work, name="uploader", daemon=True)
+        self.thread.start()
+
+    def request(self, filename):
+        """Ask for a store to be uploaded soon.
+
+        Args:
+            filename (str): The store's file name
+        """
+        now = time.monotonic()
+        with self.changed:
+            first, _ = self.pending.get(filename, (now, now))
+            self.pending[filename] = (first, now)
+            self.since.setdefault(filename, now)
+            metrics.set_gauge("s3_upload_pending", len(self.pending))
+            self.changed.notify()
+
+    def close(self, timeout=None):
+        """Upload everything still waiting, then stop.
+
+        Args:
+            timeout (Optional[float]): The most seconds to wait for the uploads
+        """
+        with self.changed:
+            self.closing = True
+            self.changed.notify()
+        self.thread.join(timeout)
+
+    def _next(self):
+        # The store whose upload is due soonest, and how many seconds until it is
+        now = time.monotonic()
+        soonest = None
+        for filename, (first, last) in self.pending.items():
+            due = 0 if self.closing else min(last + self.delay, first + self.max_delay) - now
+            if soonest is None or due < soonest[1]:
+                soonest = (filename, due)
+        return soonest
+
+    def _work(self):
+        while True:
+            with self.changed:
+                while True:
+                    soonest = self._next()
+                    if soonest is None and self.closing:
+                        return
+                    if soonest is not None and soonest[1] <= 0:
+                        break
+                    self.changed.wait(soonest[1] if soonest else None)
+                filename = soonest[0]
+                del self.pending[filename]
+                since = self.since.pop(filename)
+                metrics.set_gauge("s3_upload_pending", len(self.pending))
+
+            logging.info("Uploading %s to s3.", filename)
+            try:
+                uploaded = self.upload(filename)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Uploading %s to s3 failed.", filename)
+                metrics.inc("s3_upload_failures_total", reason="error")
+                self._retry(filename, since)
+                continue
+
+            if uploaded:
+                metrics.observe("s3_upload_lag_seconds", time.monotonic() - since)
+            else:
+                metrics.inc("s3_upload_failures_total", reason="conflict")
+
+    def _retry(self, filename, since):
+        # Try again after `delay` (or sooner if more changes come in), keeping when the wait began
+        with self.changed:
+            if self.closing:
+                logging.error("Not retrying the upload of %s, shutting down.", filename)
+                return
+            now = time.monotonic()
+            self.pending.setdefault(filename, (now, now))
+            self.since[filename] = min(since, self.since.get(filename, since))
+            metrics.set_gauge("s3_upload_pending", len(self.pending))
@@ -3,47 +3,87 @@ Bagelbot utility functions used by the different scripts.
 """
 import logging
 import contextlib
+import gzip
+import hashlib
+import json
 import os
+import shutil
 import sys
-import shelve
-
-import boto3
-from botocore.exceptions import ClientError
-from slackclient import SlackClient
-
-from config import EMAIL_DOMAIN, S3_BUCKET, S3_PREFIX, SLACK_TOKEN, SHELVE_FILE, SLACK_CHANNEL_ID
+import time
+
+from config import (
+    DIRECTORY_MAX_AGE,
+    EMAIL_DOMAIN,
+    PAIRING_SHARD_BY,
+    S3_BUCKET,
+    S3_PREFIX,
+    SLACK_TOKEN,
+    SHELVE_FILE,
+    SLACK_CHANNEL_ID,
+    SLACK_RECORD_FILE,
+    SLACK_REPLAY_FILE,
+    SLACK_REPLAY_SPEED,
+    STORE_FILE,
+    STORE_LOCK_TIMEOUT,
+)
+from storage import acquire_lease, archive_dir, open_sqlite_store, release_lease, snapshot
+import metrics
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(message)s")
 
 YES = frozenset(["yes", "y", "ye", ""])
 NO = frozenset(["no", "n"])
+DIRECTORY = "directory"
+# Stale profiles read one by one with 'users.info' before paging through all of 'users.list' pays off
+DIRECTORY_LOOKUPS = 20
+# Slack user (or profile) fields cached in the directory for sharded pairing, see PAIRING_SHARD_BY
+DIRECTORY_ATTRIBUTES = ("tz", "tz_offset", "title")
 
+# boto3 and the Slack client are slow to import, so they're only imported by the functions that use
+# them - scripts that just read the store start quickly.
 
-def get_slack_client():
+
+def get_slack_client(token=SLACK_TOKEN):
     """Initializes SlackClient for bagelbot's use.
 
     Note:
-        It pulls the required Slack API token from config.py
+        With SLACK_REPLAY_FILE set, the client answers from that recording instead of Slack, and
+        with SLACK_RECORD_FILE set, it records all its traffic there, see slack_replay.py.
+
+    Args:
+        token (Optional[str]): The Slack API token, defaults to SLACK_TOKEN in config.py
 
     Returns:
-        sc: A SlackClient instance
+        sc: A SlackAPI instance
     """
-    if not SLACK_TOKEN or SLACK_TOKEN == "yourtoken":
+    if SLACK_REPLAY_FILE:
+        from slack_replay import ReplaySlackAPI
+
+        return ReplaySlackAPI(SLACK_REPLAY_FILE, SLACK_REPLAY_SPEED)
+
+    if not token or token == "yourtoken":
         sys.exit("Exiting... SLACK_TOKEN was empty or not updated from the default in config.py.")
 
-    return SlackClient(SLACK_TOKEN)
+    if SLACK_RECORD_FILE:
+        from slack_replay import RecordingSlackAPI, get_recorder
+
+        return RecordingSlackAPI(token, get_recorder(SLACK_RECORD_FILE))
+
+    from slack_api import SlackAPI
+
+    return SlackAPI(token)
 
 
 def initialize(update_everyone=False):
-    """Used to initalize resources - both the 'shelf' store and slack client - and return them.
+    """Used to initalize resources - both the store and slack client - and return them.
 
     Args:
         update_everyone (Optional[bool]): If True, updates all users in the EMAIL_DOMAIN
             from slack. Defaults to False.
 
     Returns:
-        store: A shelve instance
-        sc: A SlackClient instance
+        store: A Store instance
+        sc: A SlackAPI instance
     """
     store = open_store()
     sc = get_slack_client()
@@ -52,30 +92,308 @@ def initialize(update_everyone=False):
     return store, sc
 
 
-def open_store():
-    """Open the SHELVE_FILE and return an open shelf instance.
+def open_store(filename=STORE_FILE, readonly=False):
+    """Open the STORE_FILE and return an open store.
+
+    Note:
+        The first time the default STORE_FILE is opened, anything in an old SHELVE_FILE is migrated into it.
+        Opening a store for writing waits up to STORE_LOCK_TIMEOUT for any other writer to close it,
+        read-only opens never wait.
+
+    Args:
+        filename (Optional[str]): The store to open, defaults to STORE_FILE
+        readonly (Optional[bool]): If True, open the store read-only, for inspecting it
+
+    Returns:
+        store: A Store instance
+
+    Raises:
+        StoreLocked: If another process kept the store open for writing for too long
+    """
+    shelve_file = SHELVE_FILE if filename == STORE_FILE else None
+    if readonly:
+        return open_sqlite_store(filename, shelve_file, readonly=True)
+    with metrics.timer("store_lease_seconds"):
+        return open_sqlite_store(filename, shelve_file, timeout=STORE_LOCK_TIMEOUT)
+
+
+def sync_store(store):
+    """Make sure everything in the store is on disk, recording how long it took and its size.
+
+    Args:
+        store (instance): A persistent, dictionary-like object used to keep information about past/future meetings
+    """
+    with metrics.timer("store_sync_seconds"):
+        store.sync()
+    metrics.set_gauge("store_bytes", os.path.getsize(store.path))
+
+
+def s3_key(filename):
+    """Get the S3 key a file is stored under in S3_BUCKET.
+
+    Args:
+        filename (str): The local file name
+
+    Returns:
+        str: The key, including S3_PREFIX
+    """
+    return os.path.join(S3_PREFIX, filename) if S3_PREFIX else filename
+
+
+def s3_store_key(filename):
+    """Get the S3 key a store is uploaded to, gzipped, in S3_BUCKET.
+
+    Args:
+        filename (str): The store's file name
+
+    Returns:
+        str: The key, including S3_PREFIX
+    """
+    return s3_key(filename) + ".gz"
+
+
+def _sync_state_file(filename):
+    return filename + ".s3sync.json"
+
+
+def read_sync_state(filename=STORE_FILE):
+    """Read what a store looked like the last time it was synced with S3.
+
+    Args:
+        filename (Optional[str]): The store, defaults to STORE_FILE
+
+    Returns:
+        dict: The object's `key` and `etag` in S3 and the `sha256` of a snapshot of the local
+            store, or an empty dict
+    """
+    try:
+        with open(_sync_state_file(filename)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_sync_state(etag, sha256, filename=STORE_FILE, key=None):
+    """Remember what a store looks like in S3 and locally after a sync.
+
+    Args:
+        etag (str): The object's ETag in S3
+        sha256 (str): The hex digest of a snapshot of the local store
+        filename (Optional[str]): The store, defaults to STORE_FILE
+        key (Optional[str]): The object's key, defaults to `s3_store_key(filename)`
+    """
+    with open(_sync_state_file(filename), "w") as f:
+        json.dump({"key": key or s3_store_key(filename), "etag": etag, "sha256": sha256}, f)
+
+
+def file_sha256(filename):
+    """Hash a file's contents.
+
+    Args:
+        filename (str): The file to hash
 
     Returns:
-        store: A shelve instance
+        str: The hex digest, or None if the file doesn't exist
     """
-    return shelve.open(SHELVE_FILE, writeback=True)
+    if not os.path.exists(filename):
+        return None
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 
+def store_sha256(filename):
+    """Hash a snapshot of a store, which (unlike the file itself) only changes with its contents.
 
-def download_shelve_from_s3():
-    """Download the SHELVE_FILE from S3_BUCKET & S3_PREFIX.
+    Args:
+        filename (str): The store to hash
+
+    Returns:
+        str: The hex digest, or None if the store doesn't exist
     """
-    s3 = boto3.resource("s3")
-    key = os.path.join(S3_PREFIX, SHELVE_FILE) if S3_PREFIX else SHELVE_FILE
-    s3.meta.client.download_file(S3_BUCKET, key, SHELVE_FILE)
+    if not os.path.exists(filename):
+        return None
+    snapshot_file = filename + ".snapshot"
+    try:
+        snapshot(filename, snapshot_file)
+        return file_sha256(snapshot_file)
+    finally:
+        if os.path.exists(snapshot_file):
+            os.remove(snapshot_file)
 
 
-def upload_shelve_to_s3():
-    """Upload the SHELVE_FILE to S3_BUCKET & S3_PREFIX.
+def download_store_from_s3(filename=STORE_FILE):
+    """Download a store from S3_BUCKET & S3_PREFIX.
+
+    Note:
+        The download is skipped if the local store hasn't changed since the last sync and the
+        object in S3 still has the same ETag. Stores are kept gzipped in S3, but one that was
+        uploaded before that is read from its plain key. If there's no STORE_FILE in S3 at all,
+        the old SHELVE_FILE is downloaded instead so it can be migrated.
+
+    Args:
+        filename (Optional[str]): The store to download, defaults to STORE_FILE
+    """
+    import boto3
+    from botocore.exceptions import ClientError
+
+    s3 = boto3.client("s3")
+    state = read_sync_state(filename)
+    key = s3_store_key(filename)
+    options = {}
+    if (
+        state.get("etag")
+        and state.get("key") == key
+        and state.get("sha256") == store_sha256(filename)
+    ):
+        options["IfNoneMatch"] = state["etag"]
+
+    response = None
+    for key, compressed in ((s3_store_key(filename), True), (s3_key(filename), False)):
+        try:
+            response = s3.get_object(Bucket=S3_BUCKET, Key=key, **options)
+            break
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in ("304", "NotModified"):
+                logging.info("Local storage is already up to date with S3.")
+                metrics.inc("s3_skipped_total", direction="download")
+                return
+            if code not in ("404", "NoSuchKey"):
+                raise
+            options = {}
+    if response is None:
+        if filename != STORE_FILE:
+            logging.info("No %s in S3 yet, starting a new one.", filename)
+            return
+        logging.info("No %s in S3 yet, downloading %s to migrate it.", STORE_FILE, SHELVE_FILE)
+        s3.download_file(S3_BUCKET, s3_key(SHELVE_FILE), SHELVE_FILE)
+        return
+
+    downloading = filename + ".download"
+    with metrics.timer("s3_seconds", direction="download"), open(downloading, "wb") as f:
+        body = gzip.GzipFile(fileobj=response["Body"]) if compressed else response["Body"]
+        shutil.copyfileobj(body, f, 1 << 20)
+    # Nobody may be writing the store while it's swapped out, and its old WAL must not be replayed
+    lease = acquire_lease(filename, STORE_LOCK_TIMEOUT)
+    try:
+        for leftover in (filename + "-wal", filename + "-shm"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        os.replace(downloading, filename)
+    finally:
+        release_lease(lease)
+    metrics.inc("s3_bytes_total", response["ContentLength"], direction="download")
+    write_sync_state(response["ETag"], store_sha256(filename), filename, key)
+    logging.info("Storage downloaded from S3 (%s bytes)", response["ContentLength"])
+    sync_archive_with_s3(s3, filename)
+
+
+def upload_store_to_s3(filename=STORE_FILE):
+    """Upload a store to S3_BUCKET & S3_PREFIX.
+
+    Note:
+        A snapshot of the store is taken with SQLite's backup API, so it's consistent even if the
+        store is being written, and uploaded gzipped. The upload is skipped if the snapshot hasn't
+        changed since the last sync. Otherwise it's a conditional write that only succeeds if the
+        object in S3 is still the one we last synced with, so a run can't clobber another run's
+        changes.
+
+    Args:
+        filename (Optional[str]): The store to upload, defaults to STORE_FILE
+
+    Returns:
+        bool: True if S3 is up to date with the local file, False if someone else changed it first
     """
-    s3 = boto3.resource("s3")
-    key = os.path.join(S3_PREFIX, SHELVE_FILE) if S3_PREFIX else SHELVE_FILE
-    s3.meta.client.upload_file(SHELVE_FILE, S3_BUCKET, key)
-    logging.info("Storage uploaded to S3 successfully")
+    snapshot_file = filename + ".snapshot"
+    compressed_file = snapshot_file + ".gz"
+    try:
+        snapshot(filename, snapshot_file)
+        state = read_sync_state(filename)
+        sha256 = file_sha256(snapshot_file)
+        if sha256 == state.get("sha256"):
+            logging.info("Storage hasn't changed, not uploading to S3.")
+            metrics.inc("s3_skipped_total", direction="upload")
+            return True
+        with open(snapshot_file, "rb") as f, gzip.open(compressed_file, "wb") as gz:
+            shutil.copyfileobj(f, gz, 1 << 20)
+        return _put_store(filename, compressed_file, sha256, state)
+    finally:
+        for leftover in (snapshot_file, compressed_file):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def _put_store(filename, compressed_file, sha256, state):
+    import boto3
+    from botocore.exceptions import ClientError
+
+    s3 = boto3.client("s3")
+    # Segments go first, so the store in S3 never lists one that isn't there
+    sync_archive_with_s3(s3, filename)
+    key = s3_store_key(filename)
+    if state.get("etag") and state.get("key") == key:
+        condition = {"IfMatch": state["etag"]}
+    else:
+        condition = {"IfNoneMatch": "*"}
+    try:
+        with metrics.timer("s3_seconds", direction="upload"), open(compressed_file, "rb") as f:
+            response = s3.put_object(Bucket=S3_BUCKET, Key=key, Body=f, **condition)
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in (
+            "412",
+            "PreconditionFailed",
+            "ConditionalRequestConflict",
+        ):
+            raise
+        logging.error(
+            "%s was changed in S3 by someone else since we last synced, NOT uploading over it.",
+            filename,
+        )
+        return False
+
+    write_sync_state(response["ETag"], sha256, filename, key)
+    size = os.path.getsize(compressed_file)
+    metrics.inc("s3_bytes_total", size, direction="upload")
+    logging.info("Storage uploaded to S3 successfully (%s bytes gzipped)", size)
+    return True
+
+
+def sync_archive_with_s3(s3, filename=STORE_FILE):
+    """Copy a store's archive segments to and from S3, wherever they're missing.
+
+    Note:
+        Segments are never changed once they're written, so a segment with the same name is the
+        same segment and only missing ones are copied.
+
+    Args:
+        s3 (boto3 client): An S3 client
+        filename (Optional[str]): The store whose archive to sync, defaults to STORE_FILE
+    """
+    directory = archive_dir(filename)
+    prefix = s3_key(directory) + "/"
+    remote = set()
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=S3_BUCKET, Prefix=prefix):
+        remote.update(item["Key"][len(prefix) :] for item in page.get("Contents", []))
+    local = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+    local = {name for name in local if not name.endswith(".tmp")}
+
+    for name in sorted(local - remote):
+        s3.upload_file(os.path.join(directory, name), S3_BUCKET, prefix + name)
+        metrics.inc(
+            "s3_bytes_total", os.path.getsize(os.path.join(directory, name)), direction="upload"
+        )
+        logging.info("Uploaded archive segment %s to S3.", name)
+    for name in sorted(remote - local):
+        os.makedirs(directory, exist_ok=True)
+        s3.download_file(S3_BUCKET, prefix + name, os.path.join(directory, name + ".tmp"))
+        os.replace(os.path.join(directory, name + ".tmp"), os.path.join(directory, name))
+        metrics.inc(
+            "s3_bytes_total", os.path.getsize(os.path.join(directory, name)), direction="download"
+        )
+        logging.info("Downloaded archive segment %s from S3.", name)
 
 
 class DummyFile:
@@ -117,31 +435,129 @@ def nostdout():
     sys.stdout = save_stdout
 
 
-def update_everyone_from_slack(store, sc):
+def directory_attributes():
+    """Get the Slack user fields cached in the directory.
+
+    Returns:
+        tuple: DIRECTORY_ATTRIBUTES, plus PAIRING_SHARD_BY if it's set
+    """
+    if PAIRING_SHARD_BY and PAIRING_SHARD_BY not in DIRECTORY_ATTRIBUTES:
+        return DIRECTORY_ATTRIBUTES + (PAIRING_SHARD_BY,)
+    return DIRECTORY_ATTRIBUTES
+
+
+def user_attribute(user, attribute):
+    """Look up a field of a Slack user, e.g. `tz_offset`, or failing that of their profile.
+
+    Args:
+        user (dict): A Slack user object
+        attribute (str): The field's name
+
+    Returns:
+        The field's value, or None if the user has no such field
+    """
+    if attribute in user:
+        return user[attribute]
+    return user.get("profile", {}).get(attribute)
+
+
+def directory_entry(user, attributes=()):
+    """Slim a Slack user object down to what we need to decide if they should be in meetings.
+
+    Args:
+        user (dict): A Slack user object, as returned by 'users.list' or 'users.info'
+        attributes (Optional[iterable]): Other fields of the user to keep, see `user_attribute`
+
+    Returns:
+        dict: The user's `updated` timestamp, name, whether they're eligible for meetings, and
+            their `attributes`
+    """
+    email = user.get("profile", {}).get("email")
+    return {
+        "updated": user.get("updated"),
+        "name": user["name"],
+        "attributes": {attribute: user_attribute(user, attribute) for attribute in attributes},
+        "eligible": bool(
+            not user.get("deleted")
+            and not user.get("is_restricted")
+            and not user.get("is_bot")
+            and email
+            and email.endswith("@" + EMAIL_DOMAIN)
+        ),
+    }
+
+
+def update_everyone_from_slack(
+    store, sc, channel_id=SLACK_CHANNEL_ID, attributes=None, max_age=DIRECTORY_MAX_AGE
+):
     """Updates our store's list of `everyone`.
 
     This list is comprised of all slack users with
     the specified EMAIL_DOMAIN in config.py that are not deleted or single-channel guests.
 
+    Note:
+        The channel's members are fetched in pages with 'conversations.members'. A slim copy of each
+        member's profile is cached in the store under `directory` and trusted for `max_age` seconds.
+        Only members whose copy is older than that (or missing, or missing one of the `attributes`)
+        are re-read: one by one with 'users.info' when there are a few of them, otherwise by paging
+        through 'users.list', which refreshes every listed member at once.
+
     Args:
         store (instance): A persistent, dictionary-like object used to keep
         information about past/future meetings.
-        sc (SlackClient): An instance of SlackClient
+        sc (SlackAPI): An instance of SlackAPI
+        channel_id (Optional[str]): The channel whose members are in meetings, defaults to SLACK_CHANNEL_ID
+        attributes (Optional[iterable]): User fields to cache, defaults to `directory_attributes()`
+        max_age (Optional[float]): Seconds a cached profile is trusted, defaults to DIRECTORY_MAX_AGE
+
+    Raises:
+        SlackAPIError: If the channel's members or the user directory couldn't be read
     """
+    from slack_api import SlackAPIError
+
     if not sc:
         sc = get_slack_client()
-
-    users = sc.api_call( "conversations.members",channel=SLACK_CHANNEL_ID)
-    fullusers = [
-        sc.api_call( "users.info",user=member)
-        for member in users["members"]
-    ]
+    if attributes is None:
+        attributes = directory_attributes()
+
+    now = time.time()
+    members = list(sc.paginate("conversations.members", "members", channel=channel_id))
+    cache = store.get(DIRECTORY, {})
+    directory = {}
+    for member in members:
+        cached = cache.get(member)
+        if (
+            cached
+            and now - cached.get("fetched", 0) < max_age
+            and all(attribute in cached.get("attributes", {}) for attribute in attributes)
+        ):
+            directory[member] = cached
+    stale = [member for member in members if member not in directory]
+
+    refreshed = 0
+    if len(stale) > DIRECTORY_LOOKUPS:
+        in_channel = set(members)
+        for user in sc.paginate("users.list", "members"):
+            if user["id"] in in_channel:
+                directory[user["id"]] = dict(directory_entry(user, attributes), fetched=now)
+                refreshed += 1
+
+    # Members from other workspaces (shared channels) aren't listed by 'users.list'
+    for member in stale:
+        if member in directory:
+            continue
+        try:
+            user = sc.call("users.info", user=member)["user"]
+            directory[member] = dict(directory_entry(user, attributes), fetched=now)
+            refreshed += 1
+        except SlackAPIError as e:
+            logging.warning("Couldn't look up %s: %s", member, e)
+
+    logging.info("Refreshed %s of %s channel member profiles.", refreshed, len(directory))
+    store[DIRECTORY] = directory
+    store.update_members({member: entry["name"] for member, entry in directory.items()})
     store["everyone"] = [
-        m["user"]["name"]
-        for m in fullusers
-        if not m["user"]["deleted"]
-        and not m["user"]["is_restricted"]
-        and not m["user"]["is_bot"]
-        and m["user"]["profile"].get("email")
-        and m["user"]["profile"]["email"].endswith("@" + EMAIL_DOMAIN)
+        directory[member]["name"]
+        for member in members
+        if member in directory and directory[member]["eligible"]
     ]